@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
-import autoshots
-import job
+# The modules are not imported here: a job worker imports autoshots.job
+# alone and shouldn't load Flask and SQLAlchemy with the web app.
+# Import autoshots.autoshots for the app.
 
 __all__ = ['autoshots', 'job']
@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CEZARY KRZYŻANOWSKI OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+"""
+.. module: accounts
+    :platform: Unix, Windows
+    :synopsis: The pool of browsershots accounts the jobs are spread over.
+
+.. moduleauthor: Cezary Krzyżanowski <cezary.krzyzanowski@gmail.com>
+
+Every account has a session of its own, one cookie jar logged in once
+and shared by all of its jobs until SESSION_TTL passes or an
+extension fails, and optionally a token bucket keeping its requests
+under a rate.
+
+A job goes to an account by consistent hashing of its URL: each
+account owns REPLICAS points on a ring of hashes and a URL belongs to
+the first point after its own hash. Adding or removing an account
+moves only the jobs between its points and their neighbours, about
+one in (number of accounts) of them.
+
+The requests, extensions, failures and rate limit waits are counted
+per account, to show if the pool is balanced.
+
+The engine processes of a host share the sessions and the rate limits
+through a directory (Pool.share): the session of an account is saved
+to a cookie file when logged in, and loaded by the other processes
+instead of logging in again, the token bucket is kept in a file, and
+both are guarded by file locks.
+"""
+
+import bisect
+import cookielib
+import errno
+import hashlib
+import os
+import threading
+import time
+import urllib
+import urllib2
+
+try:
+    import fcntl
+except ImportError:
+    # The sessions are kept per process then.
+    fcntl = None
+
+import metrics
+
+#: Points of each account on the hash ring. More spread the jobs
+#: more evenly.
+REPLICAS = 100
+#: Seconds a login of an account is used before logging in again.
+SESSION_TTL = 3600
+#: Seconds between tries of a lock held by another thread or process.
+LOCK_POLL = 0.05
+
+#: Requests made to browsershots, by account.
+account_requests = metrics.registry.counter(
+    'autoshots_account_requests_total',
+    'Requests made to browsershots, by account.', ['account'])
+#: Successful extensions, by account.
+account_extensions = metrics.registry.counter(
+    'autoshots_account_extensions_total',
+    'Successful extensions, by account.', ['account'])
+#: Failed extensions, by account.
+account_failures = metrics.registry.counter(
+    'autoshots_account_failures_total',
+    'Failed extensions, by account.', ['account'])
+#: Time the requests waited for the rate limit, by account.
+account_throttled = metrics.registry.counter(
+    'autoshots_account_throttled_seconds_total',
+    'Seconds the requests waited for the rate limit, by account.',
+    ['account'])
+
+class TokenBucket(object):
+    """ A rate limit allowing bursts.
+
+        Attrs:
+            rate (float): Tokens added per second.
+            burst (float): Most tokens kept.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def take(self, limit=None):
+        """ Take a token, in advance if there is none.
+
+            Args:
+                limit (float): Most seconds to wait, None for no limit.
+            Returns:
+                Seconds to wait before using it, None when that is
+                over the limit and no token was taken.
+        """
+        with self.lock:
+            return self.spend(limit)
+
+    def spend(self, limit=None):
+        """ Take a token, with the lock held. """
+        now = time.time()
+        self.tokens = min(self.burst,
+            self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        wait = -self.tokens / self.rate
+        if limit is not None and wait > limit:
+            self.tokens += 1
+            return None
+        return wait
+
+def wait_for(condition, deadline):
+    """ Poll a condition until it holds or the deadline passes.
+
+        Returns:
+            True if the condition held in time.
+    """
+    while not condition():
+        left = deadline - time.time()
+        if left <= 0:
+            return False
+        time.sleep(min(LOCK_POLL, left))
+    return True
+
+class FileLock(object):
+    """ A lock held by one thread of the processes sharing a file.
+
+        Attrs:
+            path (string): The lock file, None for a lock of this
+                process only.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+
+    def acquire(self, timeout=None):
+        """ Take the lock.
+
+            Args:
+                timeout (float): Most seconds to wait, None to wait as
+                    long as it takes.
+            Returns:
+                True if the lock was taken.
+        """
+        if timeout is None:
+            self.lock.acquire()
+        elif not wait_for(lambda: self.lock.acquire(False),
+                time.time() + timeout):
+            return False
+        if self.path is None:
+            return True
+        try:
+            self.file = open(self.path, 'a+')
+            if timeout is None:
+                fcntl.flock(self.file, fcntl.LOCK_EX)
+                return True
+            if wait_for(self.try_flock, time.time() + timeout):
+                return True
+        except Exception:
+            self.release()
+            raise
+        self.release()
+        return False
+
+    def try_flock(self):
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        return True
+
+    def release(self):
+        if self.file is not None:
+            # Closing the file releases the lock.
+            self.file.close()
+            self.file = None
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self.file
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+class SharedTokenBucket(TokenBucket):
+    """ A token bucket kept in a file, shared by processes. """
+
+    def __init__(self, rate, burst, path):
+        super(SharedTokenBucket, self).__init__(rate, burst)
+        self.lock = FileLock(path)
+
+    def take(self, limit=None):
+        with self.lock as state:
+            state.seek(0)
+            saved = state.read().split()
+            if len(saved) == 2:
+                self.tokens, self.updated = map(float, saved)
+            wait = self.spend(limit)
+            state.truncate(0)
+            state.write('%r %r' % (self.tokens, self.updated))
+        return wait
+
+class Account(object):
+    """ A browsershots account and its session.
+
+        Attrs:
+            auth_data (list): The login form fields.
+            username (string): Names the account in the metrics.
+            opener (OpenerDirector): Makes the requests with the
+                cookies of the session.
+            signed_in (float): When the session logged in, None when
+                it has to log in.
+            lock (FileLock): Held while logging in.
+            bucket (TokenBucket): Rate limit of the requests, None for
+                no limit.
+            session_path (string): Cookie file of the session shared
+                with other processes, None when not shared.
+    """
+
+    def __init__(self, auth_data, rate=None, burst=1):
+        self.auth_data = list(auth_data)
+        self.username = dict(self.auth_data)['username']
+        self.cookiejar = cookielib.LWPCookieJar()
+        self.opener = urllib2.build_opener(
+            urllib2.HTTPCookieProcessor(self.cookiejar),
+            urllib2.HTTPRedirectHandler)
+        self.signed_in = None
+        self.lock = FileLock()
+        self.rate = rate
+        self.burst = burst
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.session_path = None
+
+    def __repr__(self):
+        return '<Account %s>' % self.username
+
+    def share(self, directory):
+        """ Share the session and the rate limit with the processes
+            using the same directory. Call before using the account.
+        """
+        if fcntl is None:
+            return
+        path = os.path.join(directory, urllib.quote(self.username, ''))
+        self.session_path = path + '.cookies'
+        self.lock = FileLock(path + '.lock')
+        if self.rate:
+            self.bucket = SharedTokenBucket(self.rate, self.burst,
+                path + '.bucket')
+
+    def session_valid(self):
+        """ Is the session usable? A shared session logged in by
+            another process is loaded. Call with the lock held.
+        """
+        if (self.signed_in is not None
+                and time.time() - self.signed_in < SESSION_TTL):
+            return True
+        if self.session_path is None:
+            return False
+        try:
+            signed_in = os.path.getmtime(self.session_path)
+            if time.time() - signed_in >= SESSION_TTL:
+                return False
+            self.cookiejar.load(self.session_path, ignore_discard=True)
+        except (IOError, OSError, cookielib.LoadError):
+            return False
+        self.signed_in = signed_in
+        return True
+
+    def remember_session(self):
+        """ Note a login, saving the session for the other processes.
+            Call with the lock held.
+        """
+        self.signed_in = time.time()
+        if self.session_path is not None:
+            self.cookiejar.save(self.session_path, ignore_discard=True)
+            self.signed_in = os.path.getmtime(self.session_path)
+
+    def sign_out(self):
+        """ Drop the session, the next extension logs in again. A
+            shared session is dropped unless another process logged in
+            again already.
+        """
+        signed_in, self.signed_in = self.signed_in, None
+        self.cookiejar.clear()
+        if self.session_path is None or signed_in is None:
+            return
+        try:
+            if os.path.getmtime(self.session_path) == signed_in:
+                os.unlink(self.session_path)
+        except OSError:
+            pass
+
+    def throttle(self, timeout=None):
+        """ Wait for the rate limit before a request.
+
+            Args:
+                timeout (float): Most seconds to wait, None to wait as
+                    long as it takes.
+            Returns:
+                True if the request may go, False if it would have to
+                wait longer.
+        """
+        wait = self.bucket.take(timeout) if self.bucket else 0
+        if wait is None:
+            return False
+        account_requests.inc(account=self.username)
+        if wait > 0:
+            account_throttled.inc(wait, account=self.username)
+            time.sleep(wait)
+        return True
+
+def ring_hash(key):
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+class Pool(object):
+    """ The accounts, on a consistent hash ring.
+
+        Attrs:
+            accounts (dict): The accounts, by username.
+            replicas (int): Points of each account on the ring.
+    """
+
+    def __init__(self, accounts=(), replicas=REPLICAS):
+        self.replicas = replicas
+        self.accounts = {}
+        self.ring = []
+        self.lock = threading.Lock()
+        for account in accounts:
+            self.add(account)
+
+    def add(self, account):
+        with self.lock:
+            self.accounts[account.username] = account
+            self.build()
+
+    def remove(self, username):
+        with self.lock:
+            del self.accounts[username]
+            self.build()
+
+    def build(self):
+        """ Put the points of the accounts on the ring, sorted. """
+        self.ring = sorted((ring_hash('%s#%d' % (username, i)), username)
+            for username in self.accounts for i in range(self.replicas))
+        self.hashes = [point for point, username in self.ring]
+
+    def account_for(self, url):
+        """ The account extending the job of an URL. """
+        with self.lock:
+            if not self.ring:
+                raise LookupError('No browsershots accounts')
+            i = bisect.bisect(self.hashes, ring_hash(url)) % len(self.ring)
+            return self.accounts[self.ring[i][1]]
+
+    def sign_out(self):
+        """ Drop the sessions of all the accounts. """
+        for account in list(self.accounts.values()):
+            account.sign_out()
+
+    def share(self, directory):
+        """ Share the sessions and rate limits of the accounts with the
+            processes using the same directory.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for account in list(self.accounts.values()):
+            account.share(directory)
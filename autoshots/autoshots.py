@@ -39,55 +39,44 @@
 .. moduleauthor: Cezary Krzyżanowski <cezary.krzyzanowski@gmail.com>
 """
 
-from flask import (Flask, url_for, request,
-    render_template, redirect, flash)
+from flask import (Flask, url_for, request, abort, Response,
+    render_template, redirect, flash, jsonify)
 from flaskext.sqlalchemy import SQLAlchemy
 
-from datetime import datetime
+from datetime import datetime, timedelta
+import functools
+import json
 import multiprocessing
 import os.path
+import signal
+import socket
+import sys
+import threading
+import time
 
-import job
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    # Not running under uwsgi, started at the import.
+    postfork = None
 
-class Config(object):
-    """ Default configuration.
-
-        Put all values here, and override in other classes.
-    """
-    #: Run framework in debug mode?
-    DEBUG = False
-    #: Are we testing?
-    TESTING = False
-    #: URI for the database.
-    DATABASE_URI = ('sqlite:///' + os.path.join(os.path.dirname(
-        os.path.abspath( __file__)), 'autoshots.db'))
-    #: URL root
-    URL_ROOT = None
-
-class ProductionConfig(Config):
-    """ How we're working on production. """
-    #: This elaborate setting makes the sqlite database file
-    #: reside in the same dir as this file. Needs to be an absolute path.
-    URL_ROOT = '/autoshots'
-
-class DevelopmentConfig(Config):
-    """ Developement settings. """
-    DEBUG = True
-
-class TestingConfig(Config):
-    """ Test environemtn settings. """
-    TESTING = True
-
-#: This maps the correct config class in regard to the environmental mode.
-mode_mapping = {
-    'DEV': DevelopmentConfig,
-    'PROD': ProductionConfig,
-    'TEST': TestingConfig,
-}
+import cassette
+import daemon
+import job
+import leader
+import memory
+import metrics
+import mule
+import profiler
+import settings
+import storage
+import tracing
+from settings import (Config, ProductionConfig, DevelopmentConfig,
+    TestingConfig, mode_mapping)
 
 #: The config class with values depending on the
 #: environmental variable AUTOSHOTS_MODE
-config = mode_mapping[os.getenv('AUTOSHOTS_MODE', 'DEV')]()
+config = settings.from_environment()
 
 app = Flask(__name__)
 app.debug = config.DEBUG
@@ -97,8 +86,41 @@ app.config['SQLALCHEMY_DATABASE_URI'] = config.DATABASE_URI
 app.secret_key = \
     '\x8b\x90\xd39\xfa\t\xa9m9#\xd0!\xac<\x81\xe3\xee\xc7e\x8b 7\xf3\xa1'
 
+class Storage(SQLAlchemy):
+    """ The Flask-SQLAlchemy database configured by
+        storage.engine_options.
+
+        Works both for SQLite files and server database URIs.
+    """
+
+    def __init__(self, app, config):
+        self.config = config
+        SQLAlchemy.__init__(self, app)
+
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        storage.engine_options(info, options, self.config)
+
 #: Database object, an SQLAlchemy instance.
-db = SQLAlchemy(app)
+db = Storage(app, config)
+
+tracing.configure(config.TRACE_DIR)
+profiler.directory = config.PROFILE_DIR
+memory.frames = config.MEMORY_TRACE_FRAMES
+memory.directory = config.MEMORY_DIR
+memory.start()
+cassette.directory = config.CASSETTE_DIR
+if config.BROWSERSHOTS_ACCOUNTS:
+    job.use_accounts(config.BROWSERSHOTS_ACCOUNTS, config.ACCOUNT_RATE,
+        config.ACCOUNT_BURST)
+metrics.registry.directory = config.METRICS_DIR
+metrics.registry.flush_interval = config.METRICS_FLUSH_INTERVAL
+#: Web requests served, by handler.
+http_requests = metrics.registry.counter('autoshots_http_requests_total',
+    'Web requests served.', ['handler'])
+#: Web request latency, by handler.
+http_seconds = metrics.registry.histogram('autoshots_http_request_seconds',
+    'Web request latency.', ['handler'])
 
 #: BS has a simple API, i.e.
 #: http://browsershots.org/http://your.site/address?here=value
@@ -121,6 +143,26 @@ class Job(db.Model):
     timestamp = db.Column(db.DateTime)
     #: Is the job still running (boolean)?
     running = db.Column(db.Boolean)
+    #: The last reported state (string), one of the STATE_* values.
+    state = db.Column(db.String(20))
+    #: Change sequence number (integer), taken from the 'job'
+    #: Counter on every change of the job.
+    version = db.Column(db.Integer, index=True)
+    #: Timestamp (datetime) of the job being done.
+    finished = db.Column(db.DateTime)
+    #: The daemon (string) extending the job, see daemon.py.
+    lease_owner = db.Column(db.String(100))
+    #: Until when (datetime) the lease of the owner holds. A running
+    #: job is claimed by a daemon when it is empty or in the past.
+    lease_expires = db.Column(db.DateTime, index=True)
+    #: Start (datetime) of the last successful extension, as
+    #: checkpointed by the daemon.
+    last_success = db.Column(db.DateTime)
+    #: When (datetime) the daemon is to extend the job next.
+    next_due = db.Column(db.DateTime)
+    #: The trace (string) of the last /add, restored by the daemon
+    #: extending the job.
+    trace_id = db.Column(db.String(32))
 
     def __init__(self, url):
         """ Create a job.
@@ -134,26 +176,615 @@ class Job(db.Model):
         self.url = url
         self.timestamp = datetime.utcnow()
         self.running = False
+        self.version = 0
 
     def __repr__(self):
         return '<Job %r>' % self.url
 
+    def touch(self, state):
+        """ Mark the job as changed.
+
+            Sets the state and a new change sequence number. The
+            change needs to be committed by the caller.
+
+            Attrs:
+                state (string): One of the STATE_* values.
+        """
+        self.state = state
+        self.version = next_value('job')
+
+    def as_dict(self):
+        """ The job as a JSON serializable dictionary. """
+        return {
+            'url': self.url,
+            'timestamp': self.timestamp.isoformat(),
+            'running': self.running,
+            'state': self.state,
+            'version': self.version,
+        }
+
+class EngineLease(db.Model):
+    """ A daemon extending jobs, announced with its heartbeats.
+
+        The daemons spread the running jobs over those alive, see
+        daemon.py.
+    """
+    #: The lease owner name (string) of the daemon.
+    owner = db.Column(db.String(100), primary_key=True)
+    #: Until when (datetime) the daemon is taken for alive.
+    expires = db.Column(db.DateTime)
+
+class ArchivedJob(db.Model):
+    """ A finished job moved out of the Job table.
+
+        Keeps the Job table as small as the set of active jobs.
+        The jobs are moved by archive_jobs.
+    """
+    #: Primary key (integer), unrelated to the id of the job.
+    id = db.Column(db.Integer, primary_key=True)
+    #: Full qualified url (string) being checked by BS.
+    url = db.Column(db.String(200), unique=True)
+    #: Timestamp (datetime) of the system addition.
+    timestamp = db.Column(db.DateTime)
+    #: Always False, for displaying together with jobs.
+    running = False
+    #: The last reported state (string).
+    state = db.Column(db.String(20))
+    #: Change sequence number (integer) of the last change.
+    version = db.Column(db.Integer)
+    #: Timestamp (datetime) of the job being done.
+    finished = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<ArchivedJob %r>' % self.url
+
+    def restore(self):
+        """ Make a Job, to be run again, out of the archived one.
+
+            The caller adds the job and deletes the archived one.
+        """
+        restored = Job(self.url)
+        restored.timestamp = self.timestamp
+        restored.state = self.state
+        restored.version = self.version
+        restored.finished = self.finished
+        return restored
+
+def archive_jobs(older_than):
+    """ Move the jobs finished before a given time to the archive.
+
+        Works in batches of ARCHIVE_BATCH jobs, each batch one
+        multi-row insert and one delete.
+
+        Args:
+            older_than (datetime): Jobs finished before are archived.
+                Those finished before the finished column was kept
+                go by when they were added.
+        Returns:
+            The number of archived jobs.
+    """
+    archived = 0
+    columns = ('url', 'timestamp', 'state', 'version', 'finished')
+    while True:
+        jobs = (Job.query.filter(Job.running == False)
+            .filter(db.func.coalesce(Job.finished, Job.timestamp)
+                < older_than)
+            .order_by(Job.id).limit(config.ARCHIVE_BATCH).all())
+        if not jobs:
+            return archived
+        db.session.execute(ArchivedJob.__table__.insert(),
+            [dict((c, getattr(j, c)) for c in columns) for j in jobs])
+        deleted = (Job.query.filter(Job.id.in_([j.id for j in jobs]))
+            .filter(Job.running == False)
+            .delete(synchronize_session=False))
+        if deleted != len(jobs):
+            # Some of the jobs were re-run in the meantime.
+            db.session.rollback()
+            continue
+        db.session.commit()
+        archived += len(jobs)
+
+def archive_old_jobs():
+    """ Archive the jobs finished more than ARCHIVE_AFTER ago. """
+    return archive_jobs(datetime.utcnow()
+        - timedelta(seconds=config.ARCHIVE_AFTER))
+
+#: Attempt column holding the time of each extend procedure phase.
+PHASE_COLUMNS = {
+    'get_CSRF': 'csrf_time',
+    'login': 'login_time',
+    'get_request_id': 'request_id_time',
+    'extend_session': 'extend_time',
+}
+
+class Attempt(db.Model):
+    """ One run of the extend procedure of a job, as reported by
+        the job.
+
+        Only the newest ATTEMPT_KEEP attempts of a job are kept, the
+        older ones are summed up into AttemptDay rows by
+        compact_attempts.
+    """
+    #: Primary key (integer), increasing with every attempt.
+    id = db.Column(db.Integer, primary_key=True)
+    #: The url (string) of the job.
+    url = db.Column(db.String(200), index=True)
+    #: Timestamp (datetime) of the attempt start.
+    started = db.Column(db.DateTime)
+    #: The state (string) the attempt ended with.
+    outcome = db.Column(db.String(20))
+    #: Class name (string) of the error the attempt failed with.
+    error = db.Column(db.String(50))
+    #: The phase (string) the attempt failed in.
+    failed_phase = db.Column(db.String(20))
+    #: Seconds (float) spent getting the CSRF token.
+    csrf_time = db.Column(db.Float)
+    #: Seconds (float) spent logging in.
+    login_time = db.Column(db.Float)
+    #: Seconds (float) spent getting the request id.
+    request_id_time = db.Column(db.Float)
+    #: Seconds (float) spent extending the session.
+    extend_time = db.Column(db.Float)
+    #: Bytes (integer) sent and received.
+    bytes = db.Column(db.Integer)
+
+    def __repr__(self):
+        return '<Attempt %r %r>' % (self.url, self.started)
+
+class AttemptDay(db.Model):
+    """ The sums over the compacted attempts of a job from one day. """
+    __table_args__ = (db.UniqueConstraint('url', 'day'), )
+    #: Primary key (integer), just the id.
+    id = db.Column(db.Integer, primary_key=True)
+    #: The url (string) of the job.
+    url = db.Column(db.String(200))
+    #: The day (date) of the attempts.
+    day = db.Column(db.Date)
+    #: Number (integer) of attempts.
+    attempts = db.Column(db.Integer)
+    #: Number (integer) of failed attempts.
+    failures = db.Column(db.Integer)
+    #: Total seconds (float) spent getting the CSRF token.
+    csrf_time = db.Column(db.Float)
+    #: Total seconds (float) spent logging in.
+    login_time = db.Column(db.Float)
+    #: Total seconds (float) spent getting the request id.
+    request_id_time = db.Column(db.Float)
+    #: Total seconds (float) spent extending the session.
+    extend_time = db.Column(db.Float)
+    #: Total bytes (integer) sent and received.
+    bytes = db.Column(db.Integer)
+
+    def __init__(self, url, day):
+        self.url = url
+        self.day = day
+        self.attempts = self.failures = self.bytes = 0
+        for column in PHASE_COLUMNS.values():
+            setattr(self, column, 0.0)
+
+    def __repr__(self):
+        return '<AttemptDay %r %r>' % (self.url, self.day)
+
+    def add(self, attempt):
+        """ Sum an attempt up. """
+        self.attempts += 1
+        if attempt.outcome == STATE_FAILED:
+            self.failures += 1
+        self.bytes += attempt.bytes or 0
+        for column in PHASE_COLUMNS.values():
+            setattr(self, column, getattr(self, column)
+                + (getattr(attempt, column) or 0.0))
+
+def record_attempts(url, data):
+    """ Store the attempts reported by a job.
+
+        All of them go in one multi-row insert, committed by the
+        caller.
+
+        Args:
+            url (string): The URL of the job.
+            data (string): JSON list of job.AttemptStats dictionaries.
+    """
+    attempts = json.loads(data or '[]')
+    rows = []
+    for attempt in attempts:
+        row = {
+            'url': url,
+            'started': datetime.utcfromtimestamp(attempt['started']),
+            'outcome': attempt['outcome'],
+            'error': attempt['error'],
+            'failed_phase': attempt['failed_phase'],
+            'bytes': attempt['bytes'],
+        }
+        for phase, column in PHASE_COLUMNS.items():
+            row[column] = attempt['phases'].get(phase)
+        rows.append(row)
+    if rows:
+        db.session.execute(Attempt.__table__.insert(), rows)
+
+def compact_attempts():
+    """ Bound the attempt history.
+
+        Keeps the newest ATTEMPT_KEEP attempts of every job and sums
+        the older ones up into AttemptDay rows. Those are kept for
+        ATTEMPT_DAYS_KEEP days.
+
+        Returns:
+            The number of compacted attempts.
+    """
+    compacted = 0
+    crowded = (db.session.query(Attempt.url).group_by(Attempt.url)
+        .having(db.func.count(Attempt.id) > config.ATTEMPT_KEEP).all())
+    for (url, ) in crowded:
+        old = (Attempt.query.filter_by(url=url)
+            .order_by(Attempt.id.desc())
+            .offset(config.ATTEMPT_KEEP).all())
+        days = {}
+        for attempt in old:
+            day = attempt.started.date()
+            if day not in days:
+                days[day] = (AttemptDay.query.filter_by(url=url, day=day)
+                    .first() or AttemptDay(url, day))
+                db.session.add(days[day])
+            days[day].add(attempt)
+        Attempt.query.filter(Attempt.id.in_([a.id for a in old])
+            ).delete(synchronize_session=False)
+        db.session.commit()
+        compacted += len(old)
+    oldest = (datetime.utcnow()
+        - timedelta(days=config.ATTEMPT_DAYS_KEEP)).date()
+    AttemptDay.query.filter(AttemptDay.day < oldest
+        ).delete(synchronize_session=False)
+    db.session.commit()
+    return compacted
+
+#: When (timestamp) this process last ran each periodic task.
+last_run = {}
+
+def run_periodically(task, interval):
+    """ Run a task, unless this process did so in the last interval
+        seconds.
+
+        Args:
+            task (callable): The task, called without arguments.
+            interval (float): Seconds between the runs.
+    """
+    now = time.time()
+    if now - last_run.get(task, 0) < interval:
+        return
+    last_run[task] = now
+    task()
+
+#: The periodic tasks of a web process, run by its housekeeping
+#: thread, with the names of the settings of their intervals.
+PERIODIC_TASKS = [
+    (archive_old_jobs, 'ARCHIVE_INTERVAL'),
+    (compact_attempts, 'ATTEMPT_COMPACT_INTERVAL'),
+]
+
+def run_periodic_tasks():
+    """ Run the PERIODIC_TASKS due. A failing task is reported and
+        tried again after its interval.
+    """
+    for task, interval in PERIODIC_TASKS:
+        try:
+            run_periodically(task, getattr(config, interval))
+        except Exception as e:
+            db.session.rollback()
+            sys.stderr.write('%s failed: %s\n' % (task.__name__, e))
+        finally:
+            db.session.remove()
+
+def housekeeping():
+    """ Run the periodic tasks until the process exits. """
+    while True:
+        run_periodic_tasks()
+        time.sleep(config.HOUSEKEEPING_INTERVAL)
+
+#: Guards the start of the housekeeping thread.
+housekeeping_lock = threading.Lock()
+#: The process the housekeeping thread runs in.
+housekeeping_pid = None
+
+def start_housekeeping():
+    """ Run the periodic tasks in a thread of this process, off the
+        requests, unless it runs already or HOUSEKEEPING_INTERVAL turns
+        them off.
+    """
+    global housekeeping_pid
+    if config.HOUSEKEEPING_INTERVAL is None:
+        return
+    with housekeeping_lock:
+        if housekeeping_pid == os.getpid():
+            return
+        housekeeping_pid = os.getpid()
+        thread = threading.Thread(target=housekeeping,
+            name='autoshots-housekeeping')
+        thread.daemon = True
+        thread.start()
+
+class Counter(db.Model):
+    """ A named, monotonically increasing counter. """
+    #: Name (string) of the counter.
+    name = db.Column(db.String(20), primary_key=True)
+    #: Last value (integer) given out.
+    value = db.Column(db.Integer)
+
+    def __init__(self, name, value=0):
+        self.name = name
+        self.value = value
+
+def next_value(name):
+    """ Increment a counter and return its new value.
+
+        The increment is an UPDATE, so it takes the write lock
+        and concurrent writers get their values in commit order.
+
+        Args:
+            name (string): Name of the counter.
+    """
+    updated = Counter.query.filter_by(name=name).update(
+        {Counter.value: Counter.value + 1}, synchronize_session=False)
+    if not updated:
+        db.session.add(Counter(name, 1))
+        db.session.flush()
+        return 1
+    return (db.session.query(Counter.value).filter_by(name=name)
+        .scalar())
+
+#: Event state of a job just added or re-run.
+STATE_ADDED = 'added'
+#: Event state of a successful session extension.
+STATE_EXTENDED = job.STATE_EXTENDED
+#: Event state of a finished job.
+STATE_DONE = 'done'
+#: Event state of a failed extension.
+STATE_FAILED = job.STATE_FAILED
+
+class Event(db.Model):
+    """ A change of a job state.
+
+        The sequence is the cursor clients of the event stream use to
+        resume where they left off. Unlike the id, it is given out in
+        commit order, so a client never moves past an event committed
+        later.
+    """
+    #: Primary key (integer), increasing with every event.
+    id = db.Column(db.Integer, primary_key=True)
+    #: Change sequence number (integer), taken from the 'event'
+    #: Counter when the event is recorded.
+    sequence = db.Column(db.Integer, index=True)
+    #: The url (string) of the job that changed.
+    url = db.Column(db.String(200))
+    #: One of the STATE_* values (string).
+    state = db.Column(db.String(20))
+    #: Timestamp (datetime) of the change.
+    timestamp = db.Column(db.DateTime)
+
+    def __init__(self, url, state):
+        self.url = url
+        self.state = state
+        self.timestamp = datetime.utcnow()
+
+    def __repr__(self):
+        return '<Event %r %r>' % (self.url, self.state)
+
+class EventFeed(object):
+    """ Wakes up the event streams of this process.
+
+        Events recorded by this process wake the waiting streams
+        right away. Events from other processes are discovered by a
+        single primary key lookup every EVENT_POLL_INTERVAL, shared
+        by all the streams of the process, so the database load does
+        not grow with the number of listening clients.
+    """
+
+    def __init__(self, poll_interval):
+        self.poll_interval = poll_interval
+        self.condition = threading.Condition()
+        #: Sequence of the newest event known to this process.
+        self.latest = 0
+        self.checked = 0
+
+    def notify(self, sequence):
+        """ Announce a new event recorded in this process. """
+        with self.condition:
+            self.latest = max(self.latest, sequence)
+            self.condition.notify_all()
+
+    def wait(self, cursor, timeout):
+        """ Wait for an event newer than cursor.
+
+            Args:
+                cursor (int): Sequence of the last event the client
+                    has seen.
+                timeout (float): Maximum number of seconds to wait.
+            Returns:
+                True if there is something new for the client.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.latest <= cursor:
+                now = time.time()
+                if now >= deadline:
+                    return False
+                if now - self.checked >= self.poll_interval:
+                    self.checked = now
+                    newest = (db.session.query(
+                        db.func.max(Event.sequence)).scalar())
+                    db.session.remove()
+                    self.latest = max(self.latest, newest or 0)
+                    continue
+                self.condition.wait(min(deadline,
+                    self.checked + self.poll_interval) - now)
+        return True
+
+#: The event feed of this process.
+event_feed = EventFeed(config.EVENT_POLL_INTERVAL)
+
+def record_event(url, state):
+    """ Store a job state change and wake up the event streams.
+
+        Commits the current session, together with the job changes
+        made in it.
+
+        Args:
+            url (string): The URL of the job.
+            state (string): One of the STATE_* values.
+    """
+    event = Event(url, state)
+    event.sequence = next_value('event')
+    db.session.add(event)
+    db.session.commit()
+    if event.sequence % 100 == 0:
+        # Trim the backlog every now and then.
+        Event.query.filter(Event.sequence
+            <= event.sequence - config.EVENT_BACKLOG
+            ).delete(synchronize_session=False)
+        db.session.commit()
+    event_feed.notify(event.sequence)
+
+def stream_events(cursor, timeout):
+    """ Generate server-sent events newer than the cursor.
+
+        Args:
+            cursor (int): Sequence of the last event the client has
+                seen.
+            timeout (float): For how long to keep streaming.
+    """
+    deadline = time.time() + timeout
+    # Let the browser reconnect right away when we close the stream.
+    yield 'retry: 1000\n\n'
+    while True:
+        events = (Event.query.filter(Event.sequence > cursor)
+            .order_by(Event.sequence).limit(100).all())
+        db.session.remove()
+        for event in events:
+            cursor = event.sequence
+            yield 'id: %d\nevent: %s\ndata: %s\n\n' % (
+                event.sequence, event.state, event.url)
+        if len(events) == 100:
+            continue
+        if not events:
+            # Nothing newer is stored, whatever the feed says.
+            cursor = max(cursor, event_feed.latest)
+        remaining = deadline - time.time()
+        if remaining <= 0 or not event_feed.wait(cursor, remaining):
+            return
+
+def start_job_process(url, trace_id):
+    """ Start a new daemon process which will extend the
+        browsershots session from time to time.
+    """
+    p = multiprocessing.Process(target=job.bs_job_with_callback,
+            name=PROCESS_NAME + url, kwargs={
+                'url': BROWSERSHOTS_URL + url,
+                'callback_url': url_for('done', _external=True),
+                'status_url': url_for('status', _external=True),
+                'trace_id': trace_id})
+    p.daemon = True
+    p.start()
+
+def start_no_job(url, trace_id):
+    """ Only record the job. The autoshots daemon, or the leader
+        process, picks it up from the database, or nothing does, e.g.
+        when benchmarking the web tier.
+    """
+
+def start_mule_job(url, trace_id):
+    """ Wake the uwsgi mule extending the job, see mule.py. """
+    mule.notify(Job.query.filter_by(url=url).first().id)
+
+#: This maps the JOB_BACKEND values to the functions starting
+#: the extension of an added job.
+job_backends = {
+    'process': start_job_process,
+    'daemon': start_no_job,
+    'leader': start_no_job,
+    'mule': start_mule_job,
+    'none': start_no_job,
+}
+
+#: The campaign of this process for running the scheduler of the
+#: host, with the 'leader' JOB_BACKEND.
+election = leader.Election(config.LEADER_LOCK_FILE,
+    config.LEADER_RETRY_INTERVAL)
+
+def run_scheduler():
+    """ Extend the running jobs, in the leader process of the host.
+
+        The leaders of a host share one lease owner name, so a new
+        leader takes the jobs of the last one over right away instead
+        of waiting for their leases to expire.
+    """
+    daemon.Daemon(db.engine, config.DAEMON_WEB_URL, config.DAEMON_WORKERS,
+        config.DAEMON_POLL_INTERVAL, config.CHANGES_LIMIT,
+        '%s:leader' % socket.gethostname(), config.DAEMON_LEASE_PERIOD,
+        config.DAEMON_MAX_JOBS).run()
+
+def start_process():
+    """ Start the housekeeping of the process, and the election in
+        the processes of the 'leader' backend. Each runs once per
+        process, however often this is called.
+    """
+    if config.JOB_BACKEND == 'leader':
+        election.start(run_scheduler)
+    start_housekeeping()
+
+if postfork is not None:
+    # Every worker uwsgi forks starts its own, without waiting for
+    # a request.
+    postfork(start_process)
+else:
+    start_process()
+
+@app.before_request
+def campaign():
+    """ Start the process, if forked by a server without a post fork
+        hook.
+    """
+    start_process()
+
+def job_url(url):
+    """ The job URL, as stored in the database, of an URL reported by
+        the browsershots job.
+
+        The job works on browsershots URLs, i.e. the job URL prefixed
+        with BROWSERSHOTS_URL.
+    """
+    if url.startswith(BROWSERSHOTS_URL):
+        return url[len(BROWSERSHOTS_URL):]
+    return url
+
 @app.route('/')
+@metrics.registry.timed(http_requests, http_seconds, handler='home')
 def home():
     """ Main landing page.
 
         Displays a big input box to add a job and lists previous jobs,
-        both running and finished.
+        both running and finished. The archived jobs are listed only
+        when asked for with the history=all query argument.
     """
     running_jobs = (Job.query.filter_by(running=True)
         .order_by(Job.timestamp.desc())).all()
     history_jobs = (Job.query.filter_by(running=False)
         .order_by(Job.timestamp.desc())).all()
+    all_history = request.args.get('history') == 'all'
+    if all_history:
+        history_jobs = sorted(history_jobs + ArchivedJob.query.all(),
+            key=lambda j: j.timestamp, reverse=True)
+        has_archive = False
+    else:
+        has_archive = (db.session.query(ArchivedJob.id).first()
+            is not None)
     return render_template('home.html', now=datetime.utcnow(),
         base_url=BROWSERSHOTS_URL,
-        running_jobs=running_jobs, history_jobs=history_jobs)
+        running_jobs=running_jobs, history_jobs=history_jobs,
+        has_archive=has_archive)
 
 @app.route('/add', methods=['POST'])
+@metrics.registry.timed(http_requests, http_seconds, handler='add')
+@tracing.traced('add')
 def add():
     """ The POST handler for adding a new job. """
     if not request.method == 'POST':
@@ -161,10 +792,25 @@ def add():
 
     url = request.form['url']
     new_job = Job.query.filter_by(url=url).first()
+    archived_job = None
+    if not new_job:
+        archived_job = ArchivedJob.query.filter_by(url=url).first()
     if new_job:
         # Update existing entry.
         new_job.running = True
-        db.session.commit()
+        if new_job.lease_owner is None:
+            # A job given up on is claimed again right away, and
+            # extended from scratch.
+            new_job.lease_expires = None
+            new_job.last_success = new_job.next_due = None
+
+        flash('Url %s re-run.' % url)
+    elif archived_job:
+        # Bring the entry back from the archive.
+        new_job = archived_job.restore()
+        new_job.running = True
+        db.session.delete(archived_job)
+        db.session.add(new_job)
 
         flash('Url %s re-run.' % url)
     else:
@@ -172,35 +818,200 @@ def add():
         new_job = Job(url)
         new_job.running = True
         db.session.add(new_job)
-        db.session.commit()
 
         flash('Url %s added.' % url)
+    trace_id = tracing.new_trace_id() if tracing.enabled else None
+    new_job.trace_id = trace_id
+    new_job.touch(STATE_ADDED)
+    record_event(url, STATE_ADDED)
 
-    # Start a new daemon process which will extend the
-    # browsershots session from time to time.
-    p = multiprocessing.Process(target=job.bs_job_with_callback,
-            name=PROCESS_NAME + url, kwargs={
-                'url': BROWSERSHOTS_URL + url,
-                'callback_url': url_for('done')})
-    p.daemon = True
-    p.start()
+    job_backends[config.JOB_BACKEND](url, trace_id)
 
     return redirect(url_for('home'))
 
 @app.route('/done', methods=['POST'])
+@metrics.registry.timed(http_requests, http_seconds, handler='done')
+@tracing.traced('done')
 def done():
     """ The POST handler for job done signal. """
     if not request.method == 'POST':
         abort(401)
 
-    url = request.form['url']
+    url = job_url(request.form['url'])
+    tracing.context.trace_id = request.form.get('trace_id')
     job = Job.query.filter_by(url=url).first()
     if not job:
         abort(401)
     job.running = False
-    db.session.commit()
+    job.finished = datetime.utcnow()
+    job.touch(STATE_DONE)
+    record_attempts(url, request.form.get('attempts'))
+    record_event(url, STATE_DONE)
     return redirect(url_for('home'))
 
+@app.route('/status', methods=['POST'])
+def status():
+    """ The POST handler for the progress reports of a job.
+
+        The job reports each extension, successful or not.
+    """
+    url = job_url(request.form['url'])
+    state = request.form['state']
+    if state not in (STATE_EXTENDED, STATE_FAILED):
+        abort(400)
+    job = Job.query.filter_by(url=url).first()
+    if not job:
+        abort(401)
+    job.touch(state)
+    record_attempts(url, request.form.get('attempts'))
+    record_event(url, state)
+    return ''
+
+def admin_only(f):
+    """ Decorator refusing the requests not from ADMIN_ADDRESSES. """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        if request.remote_addr not in config.ADMIN_ADDRESSES:
+            abort(403)
+        return f(*args, **kwargs)
+    return wrapper
+
+@app.route('/admin/profile', methods=['POST'])
+@admin_only
+def profile():
+    """ Starts profiling the web worker serving the request.
+
+        Takes the seconds to profile for as a form value. With jobs
+        set, the jobs started by this worker are signalled to profile
+        themselves as well.
+
+        Returns the path of the profile to be written, as JSON.
+    """
+    if not config.PROFILE_DIR:
+        abort(404)
+    try:
+        seconds = float(request.form.get('seconds', 30))
+    except ValueError:
+        abort(400)
+    path = profiler.start(seconds)
+    if path is None:
+        abort(409)
+    signalled = []
+    if request.form.get('jobs'):
+        for child in multiprocessing.active_children():
+            if child.name.startswith(PROCESS_NAME):
+                os.kill(child.pid, signal.SIGUSR2)
+                signalled.append(child.pid)
+    return jsonify(path=path, jobs=signalled)
+
+@app.route('/admin/memory', methods=['POST'])
+@admin_only
+def memory_report():
+    """ Reports the top allocation sites of the web worker serving
+        the request, as JSON.
+
+        The sites are diffed against the baseline taken by a previous
+        call with baseline set, if any. Needs MEMORY_TRACE_FRAMES and
+        tracemalloc.
+    """
+    if not memory.available():
+        abort(501)
+    if request.form.get('baseline'):
+        memory.take_baseline()
+        return jsonify(baseline=True)
+    try:
+        limit = int(request.form.get('limit', 20))
+    except ValueError:
+        abort(400)
+    return jsonify(pid=os.getpid(), top=memory.top(limit))
+
+@app.route('/health')
+def health():
+    """ Reports, as JSON, whether the extensions of the node fire in
+        time to keep the sessions.
+
+        Degraded, with the status code 503, when the rolling p99 lag
+        of any process eats more than HEALTH_LAG_FRACTION of the
+        slack between the extensions and the session expiry, or when
+        more than HEALTH_MAX_QUEUE_DEPTH jobs wait for a thread.
+    """
+    collected = dict((m.name, m) for m in metrics.registry.collect())
+    lag = max(collected['autoshots_scheduler_lag_p99_seconds']
+        .values.values() or [0.0])
+    depth = sum(collected['autoshots_scheduler_queue_depth']
+        .values.values())
+    slack = job.SESSION_TIMEOUT - job.HAMMER_FREQUENCY
+    degraded = (lag > slack * config.HEALTH_LAG_FRACTION
+        or depth > config.HEALTH_MAX_QUEUE_DEPTH)
+    rv = jsonify(status='degraded' if degraded else 'ok',
+        lag_p99=lag, queue_depth=depth, slack=slack)
+    if degraded:
+        rv.status_code = 503
+    return rv
+
+@app.route('/metrics')
+def scrape():
+    """ Exposes the metrics of all the processes of the node in the
+        Prometheus text format, along with the job counts.
+    """
+    active = metrics.Gauge('autoshots_active_jobs', 'Running jobs.')
+    active.set(Job.query.filter_by(running=True).count())
+    states = metrics.Gauge('autoshots_jobs', 'Jobs by their last state.',
+        ['state'])
+    for state, count in (db.session.query(Job.state, db.func.count(Job.id))
+            .group_by(Job.state)):
+        states.set(count, state=state or 'none')
+    return Response(metrics.registry.render([active, states]),
+        mimetype='text/plain; version=0.0.4')
+
+@app.route('/changes')
+def changes():
+    """ Returns, as JSON, the jobs changed since a given version.
+
+        The client passes the version from its previous call as the
+        since query argument (0 for everything) and gets the changed
+        jobs, oldest change first, together with the version to ask
+        for the next time. When more is true the result was cut at
+        CHANGES_LIMIT and the client should ask again right away.
+    """
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        abort(400)
+    jobs = (Job.query.filter(Job.version > since)
+        .order_by(Job.version).limit(config.CHANGES_LIMIT + 1).all())
+    more = len(jobs) > config.CHANGES_LIMIT
+    jobs = jobs[:config.CHANGES_LIMIT]
+    if jobs:
+        since = jobs[-1].version
+    return jsonify(version=since, more=more,
+        jobs=[j.as_dict() for j in jobs])
+
+@app.route('/events')
+def events():
+    """ Streams the job state changes as server-sent events.
+
+        Each event carries its sequence as the id, the job state as
+        the event type and the job url as data. A reconnecting client
+        sends the id
+        of the last event it got in the Last-Event-ID header (or the
+        cursor query argument) and receives only what it missed.
+        Without a cursor only new events are streamed.
+    """
+    cursor = request.headers.get('Last-Event-ID',
+        request.args.get('cursor'))
+    if cursor is None:
+        cursor = (db.session.query(db.func.max(Event.sequence))
+            .scalar() or 0)
+    else:
+        try:
+            cursor = int(cursor)
+        except ValueError:
+            abort(400)
+    return Response(stream_events(cursor, config.EVENT_STREAM_TIMEOUT),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache'})
+
 
 #@app.route('/<path:url>')
 #def url_details(url):
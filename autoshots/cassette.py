@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CEZARY KRZYŻANOWSKI OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+"""
+.. module: cassette
+    :platform: Unix, Windows
+    :synopsis: Records and replays the HTTP traffic of the jobs.
+
+.. moduleauthor: Cezary Krzyżanowski <cezary.krzyzanowski@gmail.com>
+
+The jobs make their requests to browsershots through `transport`. A
+Recorder in its place writes every request with the response and the
+seconds it took to a cassette: gzipped JSON, one request per line.
+A Player serves the responses of a cassette instead, after the
+recorded latency times `scale`, so a slow production cycle can be run
+again offline, as many times as needed. The requests timed out are
+recorded as such, and a replayed latency over the timeout of a request
+times it out. The password and the CSRF token of the requests are
+not written, a cassette being copied around to be replayed.
+
+With CASSETTE_DIR set, every job records to <pid>.cassette in it.
+A cassette is replayed through the extend procedure with::
+
+    python autoshots/cassette.py CASSETTE [--scale 1.0]
+
+which prints the phase timings of every recorded attempt.
+"""
+
+import collections
+import gzip
+import json
+import optparse
+import os
+import socket
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+from StringIO import StringIO
+
+#: Where the jobs record their traffic, None for not at all.
+directory = None
+#: Bytes read at once, the deadline of a request being checked in
+#: between.
+READ_SIZE = 16384
+#: Form fields of the requests written to the cassettes as REDACTED.
+REDACTED_FIELDS = ('password', 'csrfmiddlewaretoken')
+REDACTED = 'REDACTED'
+
+class CassetteError(Exception):
+    """ There is no recorded response for a request. """
+
+def urlopen(req, opener=None, timeout=None):
+    """ Make a request and read the whole response.
+
+        Args:
+            req (Request): The request to make.
+            opener (OpenerDirector): Makes the request, the installed
+                urllib2 one by default.
+            timeout (float): Seconds the whole request may take, None
+                for no limit.
+        Returns:
+            The response code and the body (string).
+        Raises:
+            socket.timeout, or URLError with it as the reason, when
+            the request takes longer.
+    """
+    if timeout is None:
+        deadline = None
+        timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+    else:
+        # The socket timeout holds for every connect and read, the
+        # deadline for all of them.
+        deadline = time.time() + timeout
+    if opener is None:
+        response = urllib2.urlopen(req, timeout=timeout)
+    else:
+        response = opener.open(req, timeout=timeout)
+    if deadline is not None:
+        limit_reads(response, deadline)
+    try:
+        chunks = []
+        while True:
+            chunk = response.read(READ_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if deadline is not None and time.time() > deadline:
+                raise socket.timeout('Reading %s took over %.1fs'
+                    % (req.get_full_url(), timeout))
+    finally:
+        response.close()
+    return response.getcode(), ''.join(chunks)
+
+class DeadlineSocket(object):
+    """ A socket whose every read times out at a deadline, so that a
+        response trickling in can't outlive it.
+
+        Attrs:
+            sock (socket): The socket read.
+            deadline (float): When (timestamp) the reads time out.
+    """
+
+    def __init__(self, sock, deadline):
+        self.sock = sock
+        self.deadline = deadline
+
+    def recv(self, *args):
+        left = self.deadline - time.time()
+        if left <= 0:
+            raise socket.timeout('timed out')
+        self.sock.settimeout(left)
+        return self.sock.recv(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+def limit_reads(response, deadline):
+    """ Make the reads of the socket of an urllib2 response time out at
+        the deadline. Other responses are left alone, the deadline is
+        still checked between their reads.
+    """
+    # The urllib2 response reads the httplib one, which reads a file
+    # of the socket.
+    sockfile = getattr(getattr(response.fp, '_sock', None), 'fp', None)
+    if sockfile is not None and hasattr(sockfile, '_sock'):
+        sockfile._sock = DeadlineSocket(sockfile._sock, deadline)
+
+#: Makes the requests of the jobs: called with a Request, an opener
+#: and a timeout, returns the response code and body.
+transport = urlopen
+
+def redact(data):
+    """ Form data with the values of the REDACTED_FIELDS replaced. """
+    if not data:
+        return data
+    fields = urlparse.parse_qsl(data, keep_blank_values=True)
+    if not any(name in REDACTED_FIELDS for name, value in fields):
+        return data
+    return urllib.urlencode([(name,
+        REDACTED if name in REDACTED_FIELDS else value)
+        for name, value in fields])
+
+def request_key(req):
+    """ The method, the URL and the redacted data of a request. """
+    return req.get_method(), req.get_full_url(), redact(req.get_data())
+
+class Recorder(object):
+    """ A transport writing the traffic of another one to a cassette.
+
+        The file is flushed after every request, so the cassette of a
+        killed job is complete up to its last request.
+    """
+
+    def __init__(self, transport, path):
+        self.transport = transport
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+
+    def __call__(self, req, opener=None, timeout=None):
+        method, url, data = request_key(req)
+        entry = {'method': method, 'url': url, 'data': data}
+        started = time.time()
+        try:
+            code, body = self.transport(req, opener, timeout)
+        except urllib2.HTTPError as e:
+            body = e.read()
+            entry.update(code=e.code, body=body.decode('latin-1'),
+                seconds=time.time() - started)
+            self.write(entry)
+            raise urllib2.HTTPError(e.filename, e.code, e.msg, e.hdrs,
+                StringIO(body))
+        except urllib2.URLError as e:
+            entry.update(error=str(e.reason), seconds=time.time() - started,
+                timeout=isinstance(e.reason, socket.timeout))
+            self.write(entry)
+            raise
+        except socket.timeout as e:
+            entry.update(error=str(e), seconds=time.time() - started,
+                timeout=True)
+            self.write(entry)
+            raise
+        entry.update(code=code, body=body.decode('latin-1'),
+            seconds=time.time() - started)
+        self.write(entry)
+        return code, body
+
+    def write(self, entry):
+        with self.lock:
+            if self.file is None:
+                self.file = gzip.open(self.path, 'ab')
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+def read(path):
+    """ The entries of a cassette, in the recorded order. """
+    with gzip.open(path, 'rb') as cassette:
+        return [json.loads(line) for line in cassette if line.strip()]
+
+class Player(object):
+    """ A transport serving the responses from a cassette.
+
+        A request gets the first unused response recorded for the same
+        method, URL and data; failing that, for the same method and
+        URL.
+
+        Attrs:
+            scale (float): Factor of the recorded latencies, 0 for
+                no waiting.
+    """
+
+    def __init__(self, path, scale=1.0):
+        self.scale = scale
+        self.lock = threading.Lock()
+        self.exact = collections.defaultdict(collections.deque)
+        self.loose = collections.defaultdict(collections.deque)
+        for entry in read(path):
+            key = (entry['method'], entry['url'], entry['data'])
+            self.exact[key].append(entry)
+            self.loose[key[:2]].append(entry)
+
+    def remaining(self):
+        """ Number of the responses not played yet. """
+        with self.lock:
+            return sum(1 for entries in self.exact.values()
+                for entry in entries if not entry.get('played'))
+
+    def take(self, req):
+        key = request_key(req)
+        with self.lock:
+            for entries in (self.exact[key], self.loose[key[:2]]):
+                while entries:
+                    entry = entries.popleft()
+                    if not entry.get('played'):
+                        entry['played'] = True
+                        return entry
+        raise CassetteError('No recorded response for %s %s'
+            % key[:2])
+
+    def __call__(self, req, opener=None, timeout=None):
+        entry = self.take(req)
+        seconds = entry['seconds'] * self.scale
+        if timeout is not None and seconds > timeout:
+            time.sleep(timeout)
+            raise socket.timeout('Replayed %s took over %.1fs'
+                % (entry['url'], timeout))
+        if seconds:
+            time.sleep(seconds)
+        if entry.get('timeout'):
+            raise socket.timeout(entry['error'])
+        if 'error' in entry:
+            raise urllib2.URLError(entry['error'])
+        body = entry['body'].encode('latin-1')
+        if entry['code'] >= 400:
+            raise urllib2.HTTPError(entry['url'], entry['code'],
+                'Recorded error', {}, StringIO(body))
+        return entry['code'], body
+
+def record(path):
+    """ Record the traffic of this process to a cassette. """
+    global transport
+    transport = Recorder(transport, path)
+
+def replay(path, scale=1.0):
+    """ Serve the requests of this process from a cassette. """
+    global transport
+    transport = Player(path, scale)
+
+def start():
+    """ Record the traffic of a job to CASSETTE_DIR, if set. """
+    if not directory:
+        return
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    record(os.path.join(directory, '%d.cassette' % os.getpid()))
+
+def job_url(entries):
+    """ The browsershots URL a cassette extends: the page requested
+        other than the home page of the first request.
+    """
+    home = entries[0]['url']
+    for entry in entries:
+        if entry['method'] == 'GET' and entry['url'] != home:
+            return entry['url']
+    return None
+
+def main():
+    # Run as a script this is __main__, the job uses the module.
+    import cassette
+    import job
+
+    parser = optparse.OptionParser(usage='%prog [options] CASSETTE')
+    parser.add_option('--scale', type='float', default=1.0,
+        help='factor of the recorded latencies [%default]')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Give the cassette to replay.')
+    entries = cassette.read(args[0])
+    url = cassette.job_url(entries)
+    job.use_browsershots(entries[0]['url'])
+    cassette.replay(args[0], options.scale)
+    job.install_opener()
+    print('Replaying %s' % url)
+    while cassette.transport.remaining():
+        attempt = job.AttemptStats()
+        started = time.time()
+        try:
+            job.extend_procedure(url, attempt)
+        except cassette.CassetteError:
+            break
+        except Exception as e:
+            attempt.outcome = job.STATE_FAILED
+            print('%s: %s' % (type(e).__name__, str(e).split('\n')[0]))
+        print('%-8s %7.3fs %s' % (attempt.outcome, time.time() - started,
+            ' '.join('%s=%.3fs' % (phase, attempt.phases[phase])
+                for phase in job.PHASES if phase in attempt.phases)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,683 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CEZARY KRZYŻANOWSKI OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+"""
+.. module: daemon
+    :platform: Unix
+    :synopsis: The extension engine as a service of its own.
+
+.. moduleauthor: Cezary Krzyżanowski <cezary.krzyzanowski@gmail.com>
+
+The daemon extends the running jobs of the database, so the web app
+only records them (JOB_BACKEND 'daemon'), and the two can run and
+scale on separate hosts sharing the database.
+
+Several daemons share the jobs through leases: a job is extended only
+by the daemon named in its lease_owner column, until lease_expires.
+Every DAEMON_POLL_INTERVAL seconds a daemon renews the leases of its
+jobs (the heartbeat), drops the jobs stopped or taken over by another
+daemon, and claims up to CHANGES_LIMIT of the running jobs with no
+lease or an expired one, as long as it holds fewer than
+DAEMON_MAX_JOBS. A claim is a conditional update, so of two daemons
+racing for a job only one gets it. The jobs of a crashed daemon are
+claimed by the others when their leases run out, at most
+DAEMON_LEASE_PERIOD seconds after its last heartbeat. A daemon unable
+to renew its leases for that long stops extending, as the jobs may be
+someone else's by then.
+
+To use all the cores of a host, the daemon runs DAEMON_PROCESSES
+engine processes (one per CPU with 0), each claiming only the jobs
+with an id in its partition, the ids modulo the number of processes.
+A process ending is started again. The processes share the sessions
+and the rate limits of the browsershots accounts through
+SESSION_DIR.
+
+The schedule of every job is checkpointed to its row: the start of
+its last successful extension and when it is due next. The request
+id is not kept, the result page is fetched for every extension as it
+tells whether the job is finished. The checkpoints are written in one
+batch with each heartbeat, and read back when a job is claimed, so a daemon started
+again, or taking the jobs of a crashed one over, extends them when
+they are due instead of all at once. The sessions of the accounts are
+kept in SESSION_DIR, so they are not logged in again either.
+
+The progress is reported to the web app, /status after each extension
+and /done when a job is finished, the same way the forked jobs do.
+
+A daemon growing over DAEMON_MAX_RSS drains and exits, to be started
+again by whatever supervises it: systemd, the process running the
+partitions, or uwsgi for the engine in a mule (see mule.py).
+
+SIGTERM or SIGINT drains the daemon: no new extensions are started,
+the running ones are finished and reported, the leases are released
+for the other daemons, then it exits. Run with::
+
+    autoshots [--database URI] [--web-url URL] [--workers N]
+        [--owner NAME] [--lease-period SECONDS] [--processes N]
+
+Only the standard library, SQLAlchemy and the job modules are loaded,
+not Flask.
+"""
+
+import calendar
+import errno
+import math
+import multiprocessing
+import optparse
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+import urllib2
+import urlparse
+from datetime import datetime, timedelta
+
+import sqlalchemy
+from sqlalchemy import exc
+
+import cassette
+import job
+import memory
+import metrics
+import profiler
+import scheduler
+import settings
+import storage
+import tracing
+
+#: Attempts kept for each job while the web app is unreachable, the
+#: oldest dropped first.
+PENDING_LIMIT = 100
+#: Part of its fair share of the running jobs a daemon may hold over
+#: it, so that the daemons don't trade jobs on every change.
+SHARE_SLACK = 0.1
+
+#: The columns of the job table the daemon reads.
+metadata = sqlalchemy.MetaData()
+job_table = sqlalchemy.Table('job', metadata,
+    sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column('url', sqlalchemy.String(1024)),
+    sqlalchemy.Column('running', sqlalchemy.Boolean),
+    sqlalchemy.Column('version', sqlalchemy.Integer),
+    sqlalchemy.Column('lease_owner', sqlalchemy.String(100)),
+    sqlalchemy.Column('lease_expires', sqlalchemy.DateTime),
+    sqlalchemy.Column('last_success', sqlalchemy.DateTime),
+    sqlalchemy.Column('next_due', sqlalchemy.DateTime),
+    sqlalchemy.Column('trace_id', sqlalchemy.String(32)),
+)
+#: The daemons alive, as announced by their heartbeats.
+engine_table = sqlalchemy.Table('engine_lease', metadata,
+    sqlalchemy.Column('owner', sqlalchemy.String(100), primary_key=True),
+    sqlalchemy.Column('expires', sqlalchemy.DateTime),
+)
+
+def to_datetime(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.utcfromtimestamp(timestamp)
+
+def to_timestamp(value):
+    if value is None:
+        return None
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+def default_owner():
+    """ The lease owner name of this process, unique within the nodes. """
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class Daemon(object):
+    """ Follows the job table and extends the running jobs.
+
+        Attrs:
+            engine (Engine): The shared database.
+            web_url (string): Root URL of the web app.
+            extender (Scheduler): Runs the extensions.
+            poll_interval (float): Seconds between the heartbeats.
+            limit (int): Jobs claimed or released in one query.
+            owner (string): The lease owner name of the daemon.
+            lease_period (float): Seconds a lease lasts after a
+                heartbeat.
+            max_jobs (int): Jobs leased at most, None for no limit.
+            owned (set): URLs of the jobs leased, as in the database.
+            renewed (float): Time of the last heartbeat.
+            partition (tuple): The index and the number of the
+                partitions, the daemon claiming only the jobs of its
+                own. None for all the jobs.
+            max_rss (int): Bytes of memory after which the daemon
+                drains, None for no limit.
+            checkpoints (dict): Schedules not written yet, by URL.
+            share (int): Jobs the daemon holds at most, its fair share
+                of the running jobs as of the last heartbeat. None
+                before the first one.
+    """
+
+    def __init__(self, engine, web_url, workers, poll_interval,
+            limit=500, owner=None, lease_period=60, max_jobs=None,
+            partition=None, max_rss=None):
+        self.engine = engine
+        self.web_url = web_url
+        self.status_url = urlparse.urljoin(web_url, 'status')
+        self.done_url = urlparse.urljoin(web_url, 'done')
+        self.poll_interval = poll_interval
+        self.limit = limit
+        self.owner = owner or default_owner()
+        self.lease_period = lease_period
+        self.max_jobs = max_jobs
+        self.partition = partition
+        self.max_rss = max_rss
+        self.owned = set()
+        self.renewed = time.time()
+        self.stopping = threading.Event()
+        self.woken = threading.Event()
+        self.lock = threading.Lock()
+        #: Attempts not reported yet, by browsershots URL.
+        self.pending = {}
+        #: Trace ids of the jobs finished, their /done not sent yet,
+        #: by URL.
+        self.finished = {}
+        self.checkpoints = {}
+        self.share = None
+        self.extender = scheduler.Scheduler(self.extend, self.done,
+            workers=workers, frequency=job.HAMMER_FREQUENCY,
+            checkpoint=self.checkpoint)
+
+    def poll(self):
+        """ Write the checkpoints, renew the leases, then claim more
+            jobs.
+
+            Returns:
+                True if there may be more jobs to claim right away.
+        """
+        self.save_checkpoints()
+        self.resend_done()
+        self.heartbeat()
+        return self.claim()
+
+    def schedule(self, url, last_success, next_due, trace_id=None):
+        """ Extend a job leased, resuming its checkpointed schedule, in
+            the trace it was added in.
+        """
+        scheduled = self.extender.add(job.BROWSERSHOTS_URL + url,
+            to_timestamp(next_due))
+        scheduled.trace_id = trace_id
+        if scheduled.last_success is None:
+            scheduled.last_success = to_timestamp(last_success)
+
+    def checkpoint(self, scheduled):
+        """ Note the schedule of a job, to be written with the next
+            heartbeat.
+        """
+        url = scheduled.url[len(job.BROWSERSHOTS_URL):]
+        with self.lock:
+            self.checkpoints[url] = (scheduled.last_success, scheduled.due)
+
+    def save_checkpoints(self):
+        """ Write the noted schedules, in one batch. """
+        with self.lock:
+            checkpoints, self.checkpoints = self.checkpoints, {}
+        if not checkpoints:
+            return
+        table = job_table
+        try:
+            self.engine.execute(table.update().where(sqlalchemy.and_(
+                    table.c.url == sqlalchemy.bindparam('job_url'),
+                    table.c.lease_owner == self.owner)), [{
+                'job_url': url,
+                'last_success': to_datetime(last_success),
+                'next_due': to_datetime(due),
+            } for url, (last_success, due) in checkpoints.items()])
+        except exc.SQLAlchemyError:
+            # Newer ones noted meanwhile win.
+            with self.lock:
+                checkpoints.update(self.checkpoints)
+                self.checkpoints = checkpoints
+            raise
+
+    def expiry(self):
+        """ When a lease taken or renewed now runs out. """
+        return datetime.utcnow() + timedelta(seconds=self.lease_period)
+
+    def announce(self, connection):
+        """ Renew the entry of the daemon among those alive, dropping
+            those long gone.
+        """
+        table = engine_table
+        expires = self.expiry()
+        updated = connection.execute(table.update()
+            .where(table.c.owner == self.owner), expires=expires)
+        if not updated.rowcount:
+            connection.execute(table.insert(), owner=self.owner,
+                expires=expires)
+        connection.execute(table.delete().where(table.c.expires
+            < datetime.utcnow() - timedelta(seconds=self.lease_period)))
+
+    def fair_share(self, connection):
+        """ The running jobs spread over the daemons alive, with
+            SHARE_SLACK.
+        """
+        running = connection.execute(sqlalchemy.select(
+                [sqlalchemy.func.count(job_table.c.id)])
+            .where(job_table.c.running == True)).scalar()
+        daemons = connection.execute(sqlalchemy.select(
+                [sqlalchemy.func.count(engine_table.c.owner)])
+            .where(engine_table.c.expires > datetime.utcnow())).scalar()
+        share = running / float(max(daemons, 1))
+        return int(math.ceil(share)) + int(share * SHARE_SLACK)
+
+    def heartbeat(self):
+        """ Renew the leases of the daemon and follow its jobs.
+
+            The jobs stopped are dropped and released, so are those
+            leased by another daemon now, its lease having expired
+            before it was renewed here. Jobs leased under the owner
+            name before, by an earlier run, are scheduled. Jobs over
+            the fair share of the daemon are released, for the daemons
+            started since to claim.
+        """
+        table = job_table
+        mine = table.c.lease_owner == self.owner
+        started = time.time()
+        with self.engine.begin() as connection:
+            connection.execute(table.update().where(mine),
+                lease_expires=self.expiry())
+            self.announce(connection)
+            self.share = self.fair_share(connection)
+            rows = connection.execute(sqlalchemy.select(
+                [table.c.url, table.c.running, table.c.last_success,
+                    table.c.next_due, table.c.trace_id])
+                .where(mine)).fetchall()
+        self.renewed = started
+        owned = set(row[0] for row in rows if row[1])
+        stopped = [row[0] for row in rows if not row[1]]
+        for url in stopped:
+            self.extender.remove(job.BROWSERSHOTS_URL + url)
+        self.release(stopped)
+        with self.lock:
+            lost = self.owned - owned - set(stopped)
+            found = owned - self.owned
+            self.owned = owned
+            self.finished = dict((url, trace_id) for url, trace_id
+                in self.finished.items() if url in owned)
+        for url in lost:
+            self.extender.remove(job.BROWSERSHOTS_URL + url)
+        for row in rows:
+            if row[0] in found:
+                self.schedule(row[0], *row[2:])
+        self.shed()
+
+    def shed(self):
+        """ Release the jobs over the share of the daemon, keeping the
+            finished ones still to be reported.
+        """
+        with self.lock:
+            excess = len(self.owned) - self.share
+            if excess <= 0:
+                return
+            shed = sorted(self.owned - set(self.finished))[-excess:]
+        for url in shed:
+            self.extender.remove(job.BROWSERSHOTS_URL + url)
+        self.release(shed)
+
+    def claim(self):
+        """ Lease and schedule running jobs no other daemon holds, up
+            to the share of the daemon.
+
+            Returns:
+                True if there may be more jobs to claim right away.
+        """
+        room = self.limit
+        if self.max_jobs is not None:
+            room = min(room, self.max_jobs - len(self.owned))
+        if self.share is not None:
+            room = min(room, self.share - len(self.owned))
+        if room <= 0:
+            return False
+        table = job_table
+        free = sqlalchemy.and_(table.c.running == True,
+            sqlalchemy.or_(table.c.lease_expires == None,
+                table.c.lease_expires < datetime.utcnow()))
+        if self.partition is not None:
+            index, count = self.partition
+            free = sqlalchemy.and_(free, table.c.id % count == index)
+        with self.engine.begin() as connection:
+            ids = [row[0] for row in connection.execute(
+                sqlalchemy.select([table.c.id]).where(free)
+                .order_by(table.c.id).limit(room))]
+            if not ids:
+                return False
+            # Checking the lease again in the update keeps a job
+            # claimed by another daemon since the select.
+            connection.execute(table.update()
+                .where(sqlalchemy.and_(table.c.id.in_(ids), free)),
+                lease_owner=self.owner, lease_expires=self.expiry())
+            claimed = connection.execute(sqlalchemy.select(
+                    [table.c.url, table.c.last_success, table.c.next_due,
+                        table.c.trace_id])
+                .where(sqlalchemy.and_(table.c.id.in_(ids),
+                    table.c.lease_owner == self.owner))).fetchall()
+        with self.lock:
+            self.owned.update(row[0] for row in claimed)
+        for row in claimed:
+            self.schedule(*row)
+        return len(ids) == self.limit
+
+    def release(self, urls, retry_at=None):
+        """ Give up the leases of jobs.
+
+            Args:
+                urls (list): URLs of the jobs.
+                retry_at (datetime): When the jobs may be claimed
+                    again, right away by default.
+        """
+        table = job_table
+        with self.lock:
+            self.owned.difference_update(urls)
+        for start in range(0, len(urls), self.limit):
+            self.engine.execute(table.update().where(sqlalchemy.and_(
+                    table.c.url.in_(urls[start:start + self.limit]),
+                    table.c.lease_owner == self.owner)),
+                lease_owner=None, lease_expires=retry_at)
+
+    def drop_all(self):
+        """ Stop extending all the jobs, the leases being unsure. """
+        with self.lock:
+            owned, self.owned = self.owned, set()
+        for url in owned:
+            self.extender.remove(job.BROWSERSHOTS_URL + url)
+
+    def extend(self, scheduled):
+        """ Extend a job, tracing it in the trace it was added in. """
+        tracing.context.trace_id = scheduled.trace_id
+        try:
+            return job.extend_job(scheduled, self.report)
+        finally:
+            tracing.context.trace_id = None
+
+    def report(self, scheduled, state, attempt):
+        """ Send the state of an extension to the web app. """
+        self.send(self.status_url, scheduled.url, state, attempt,
+            scheduled.trace_id)
+
+    def done(self, scheduled, error):
+        """ Tell the web app a job is finished, and release it. A job
+            given up on was reported failed already and stays running
+            in the database, to be claimed again by any daemon after a
+            lease period.
+
+            A finished job the web app could not be told about keeps
+            its lease, so it is not claimed and extended again, and the
+            report is sent again with the heartbeats.
+        """
+        url = scheduled.url[len(job.BROWSERSHOTS_URL):]
+        retry_at = None
+        if error is None:
+            if not self.send(self.done_url, scheduled.url,
+                    job.STATE_FINISHED, trace_id=scheduled.trace_id):
+                with self.lock:
+                    self.finished[url] = scheduled.trace_id
+                return
+        else:
+            retry_at = self.expiry()
+        try:
+            self.release([url], retry_at)
+        except exc.SQLAlchemyError as e:
+            # The lease expires on its own without the heartbeats.
+            sys.stderr.write('Releasing a job failed: %s\n' % e)
+
+    def resend_done(self):
+        """ Send the /done reports failed before, releasing the jobs
+            reported.
+        """
+        with self.lock:
+            finished = sorted(self.finished.items())
+        sent = [url for url, trace_id in finished if self.send(
+            self.done_url, job.BROWSERSHOTS_URL + url, job.STATE_FINISHED,
+            trace_id=trace_id)]
+        with self.lock:
+            for url in sent:
+                self.finished.pop(url, None)
+        self.release(sent)
+
+    def send(self, url, bs_url, state, attempt=None, trace_id=None):
+        """ Post a state, with the attempts not sent before.
+
+            Returns:
+                True if the web app got it.
+        """
+        with self.lock:
+            pending = self.pending.setdefault(bs_url, [])
+            if attempt is not None:
+                pending.append(attempt.as_dict())
+                del pending[:-PENDING_LIMIT]
+            attempts = list(pending)
+        try:
+            job.post_state(url, bs_url, state, attempts, trace_id)
+        except (urllib2.URLError, socket.error):
+            # Keep them for the next report.
+            return False
+        with self.lock:
+            sent = set(map(id, attempts))
+            pending[:] = [attempt for attempt in pending
+                if id(attempt) not in sent]
+            if not pending and self.pending.get(bs_url) is pending:
+                del self.pending[bs_url]
+        return True
+
+    def wake(self):
+        """ Poll right away, e.g. for a job just added. """
+        self.woken.set()
+
+    def stop(self, *args):
+        """ Drain: stop starting extensions and return from run. """
+        self.stopping.set()
+        self.woken.set()
+
+    def recycle(self):
+        """ Drain if the process grew over max_rss. """
+        if self.max_rss is None:
+            return
+        rss = memory.rss()
+        if rss is not None and rss > self.max_rss:
+            sys.stderr.write('Using %d MB of memory, recycling\n'
+                % (rss // 2 ** 20))
+            self.stop()
+
+    def run(self):
+        """ Poll the database and extend the jobs until stopped. """
+        runner = threading.Thread(target=self.extender.run,
+            name='autoshots-scheduler')
+        runner.start()
+        try:
+            while not self.stopping.is_set():
+                try:
+                    if self.poll():
+                        continue
+                except exc.SQLAlchemyError as e:
+                    sys.stderr.write('Polling the jobs failed: %s\n' % e)
+                    if time.time() - self.renewed > self.lease_period:
+                        self.drop_all()
+                metrics.registry.maybe_flush()
+                self.recycle()
+                self.woken.wait(self.poll_interval)
+                self.woken.clear()
+        finally:
+            self.extender.stop()
+            # Let the signals through while the extensions finish.
+            while runner.is_alive():
+                runner.join(1)
+            try:
+                self.save_checkpoints()
+                self.resend_done()
+                # Those still not reported wait for another daemon.
+                self.release(sorted(self.finished), self.expiry())
+                self.release(sorted(self.owned))
+                self.engine.execute(engine_table.delete()
+                    .where(engine_table.c.owner == self.owner))
+            except exc.SQLAlchemyError as e:
+                sys.stderr.write('Releasing the jobs failed: %s\n' % e)
+            metrics.registry.flush()
+
+def configure(config):
+    """ Set the job modules up for extending in this process and the
+        engine processes it starts.
+    """
+    metrics.registry.directory = config.METRICS_DIR
+    metrics.registry.flush_interval = config.METRICS_FLUSH_INTERVAL
+    tracing.configure(config.TRACE_DIR)
+    profiler.directory = config.PROFILE_DIR
+    memory.frames = config.MEMORY_TRACE_FRAMES
+    memory.directory = config.MEMORY_DIR
+    memory.start()
+    cassette.directory = config.CASSETTE_DIR
+    job.install_opener()
+    if config.BROWSERSHOTS_ACCOUNTS:
+        job.use_accounts(config.BROWSERSHOTS_ACCOUNTS, config.ACCOUNT_RATE,
+            config.ACCOUNT_BURST)
+    # Shared with the other processes, and kept over a restart.
+    job.pool.share(config.SESSION_DIR)
+
+def start_engine():
+    """ Profile on SIGUSR2, report the memory on SIGUSR1 and record
+        the traffic in an engine process, like in the process of a
+        job. Call in the main thread.
+    """
+    profiler.install_signal_handler()
+    memory.install_signal_handler()
+    cassette.start()
+
+def serve(options, config, partition=None):
+    """ Run a daemon until it is drained by a signal. """
+    web_url = options.web_url
+    if not web_url.endswith('/'):
+        web_url += '/'
+    daemon = Daemon(storage.create_engine(options.database, config),
+        web_url, options.workers, options.poll_interval,
+        config.CHANGES_LIMIT, options.owner, options.lease_period,
+        options.max_jobs, partition, config.DAEMON_MAX_RSS)
+    start_engine()
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.run()
+
+def serve_partitions(options, config, processes):
+    """ Run a daemon process for every partition of the jobs, starting
+        again those ending, until drained by a signal.
+    """
+    children = {}
+    stopping = []
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            status = 1
+            try:
+                # The same owner for a process started again, so it
+                # takes the leases of the one ending over right away.
+                options.owner = '%s/%d' % (options.owner, index)
+                serve(options, config, (index, processes))
+                status = 0
+            except Exception:
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+        children[pid] = index
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(processes):
+        spawn(index)
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        index = children.pop(pid, None)
+        if index is not None and not stopping:
+            sys.stderr.write('Engine %d exited with %d, starting it again\n'
+                % (index, status))
+            # Don't spin on a process failing at the start.
+            time.sleep(1)
+            # A signal during the sleep finds no process to stop.
+            if not stopping:
+                spawn(index)
+
+def main():
+    config = settings.from_environment()
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--database', default=config.DATABASE_URI,
+        help='database URI [%default]')
+    parser.add_option('--web-url', default=config.DAEMON_WEB_URL,
+        help='root URL of the web app [%default]')
+    parser.add_option('--workers', type='int',
+        default=config.DAEMON_WORKERS,
+        help='extension worker threads of a process [%default]')
+    parser.add_option('--poll-interval', type='float',
+        default=config.DAEMON_POLL_INTERVAL,
+        help='seconds between the heartbeats [%default]')
+    parser.add_option('--owner', default=default_owner(),
+        help='lease owner name, unique within the nodes [%default]')
+    parser.add_option('--lease-period', type='float',
+        default=config.DAEMON_LEASE_PERIOD,
+        help='seconds a lease lasts after a heartbeat [%default]')
+    parser.add_option('--max-jobs', type='int',
+        default=config.DAEMON_MAX_JOBS,
+        help='jobs leased at most by a process [%default]')
+    parser.add_option('--processes', type='int',
+        default=config.DAEMON_PROCESSES,
+        help='engine processes, 0 for one per CPU [%default]')
+    options, args = parser.parse_args()
+
+    configure(config)
+    processes = options.processes or multiprocessing.cpu_count()
+    if processes == 1:
+        serve(options, config)
+    else:
+        serve_partitions(options, config, processes)
+
+if __name__ == '__main__':
+    main()
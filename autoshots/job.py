@@ -38,13 +38,26 @@
 .. moduleauthor: Cezary Krzyżanowski <cezary.krzyzanowski@gmail.com>
 """
 
+import contextlib
 import cookielib
 import copy
+import functools
+import json
 import re
+import socket
+import threading
 import time
 import urllib
 import urllib2
 
+import accounts
+import cassette
+import memory
+import metrics
+import profiler
+import scheduler
+import tracing
+
 #: The main URL of browsershots.
 BROWSERSHOTS_URL = 'http://browsershots.org/'
 #: URL for login (POST).
@@ -75,11 +88,15 @@ auth_data = [
     ('fromurl', '/'),
 ]
 
+#: The accounts the jobs are spread over, by default the one of
+#: auth_data. Set with use_accounts.
+pool = accounts.Pool([accounts.Account(auth_data)])
+
 #: Basic headers used in the communication.
 headers = {
     'User-Agent': 'Mozilla/5.0 (Windows; U; Windows NT 5.0; '
         + 'en-GB; rv:1.8.1.12) Gecko/20080201 Firefox/2.0.0.12',
-    'Accept:': 'text/thml,application/hxtml+xml,'
+    'Accept': 'text/html,application/xhtml+xml,'
         + 'application/xml;q=0.9,*/*;q=0.8',
     'Accept-Language': 'en-gb,en;q=0.5',
     'Accept-Charset': 'utf-8,ISO-8859-1;q=0.7,*;q=0.7',
@@ -102,6 +119,57 @@ json_headers = {
 
 #: The frequency of running the extension job. 20min.
 HAMMER_FREQUENCY = 540
+#: For how long (seconds) browsershots keeps a session not extended.
+SESSION_TIMEOUT = 1200
+
+#: Reported state of a successful extension.
+STATE_EXTENDED = 'extended'
+#: Reported state of a failed extension.
+STATE_FAILED = 'failed'
+#: Outcome of the last attempt, finding nothing more to extend.
+STATE_FINISHED = 'finished'
+
+#: Length of the page excerpts put in the error messages.
+EXCERPT_LENGTH = 500
+
+#: The phases of the extend procedure, in order.
+PHASES = ('get_CSRF', 'login', 'get_request_id', 'extend_session')
+#: Seconds an extend procedure may take, waiting for the rate limit
+#: and the login of another job included. A stuck request can't hold
+#: a worker longer.
+CYCLE_DEADLINE = 90
+#: Seconds each phase may take, within the CYCLE_DEADLINE.
+PHASE_TIMEOUTS = {
+    'get_CSRF': 15,
+    'login': 20,
+    'get_request_id': 25,
+    'extend_session': 25,
+}
+#: Seconds a request outside of an extend procedure may take, e.g.
+#: the reports to the web app.
+REQUEST_TIMEOUT = 30
+
+#: Phases of the extend procedure run, by phase.
+phase_runs = metrics.registry.counter('autoshots_extend_attempts_total',
+    'Extend procedure phases run.', ['phase'])
+#: Phases of the extend procedure failed, by phase.
+phase_failures = metrics.registry.counter(
+    'autoshots_extend_failures_total',
+    'Extend procedure phases failed.', ['phase'])
+#: Phases of the extend procedure out of time, by phase.
+phase_timeouts = metrics.registry.counter(
+    'autoshots_extend_timeouts_total',
+    'Extend procedure phases out of time.', ['phase'])
+#: Duration of the extend procedure phases, by phase.
+phase_seconds = metrics.registry.histogram(
+    'autoshots_extend_phase_seconds',
+    'Duration of the extend procedure phases.', ['phase'])
+#: Bytes sent to and received from browsershots.
+outbound_bytes = metrics.registry.counter('autoshots_outbound_bytes_total',
+    'Bytes sent to and received from browsershots.')
+#: Logins to browsershots.
+logins = metrics.registry.counter('autoshots_logins_total',
+    'Logins to browsershots.')
 
 class WrongResponseError(RuntimeError):
     """ Raised when a HTTP request to browsershots returns
@@ -114,59 +182,397 @@ class UnexpectedContentError(RuntimeError):
         content that was expected.
     """
 
-def bs_job_with_callback(url, callback_url):
-    """ Runs the browsershot job and posts the result afterwards. """
+class SignedOutError(UnexpectedContentError):
+    """ Raised when browsershots doesn't take the session: the page
+        has no logout link, or the extension is refused.
+    """
+
+class DeadlineExceeded(RuntimeError):
+    """ Raised when a request to browsershots runs out of the time
+        left to its phase.
+    """
+
+class AttemptStats(object):
+    """ Timings and outcome of one run of the extend procedure.
+
+        Filled in by extend_procedure and the HTTP requests it makes.
+    """
+
+    def __init__(self):
+        #: Start of the attempt (timestamp).
+        self.started = time.time()
+        #: Seconds (float) taken by each of the PHASES that ran.
+        self.phases = {}
+        #: Bytes sent and received.
+        self.bytes = 0
+        #: The state the attempt ended with.
+        self.outcome = None
+        #: Class name of the exception the attempt failed with.
+        self.error = None
+        #: The phase the attempt failed in.
+        self.failed_phase = None
+        #: Username of the account the attempt used.
+        self.account = None
+        #: When (timestamp) the attempt has to be over.
+        self.deadline = self.started + CYCLE_DEADLINE
+        #: When (timestamp) the running phase has to be over.
+        self.phase_deadline = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Time a phase, and note if it fails or runs out of time.
+            The phase gets its PHASE_TIMEOUTS, as far as the deadline
+            of the attempt allows.
+        """
+        start = time.time()
+        self.phase_deadline = min(self.deadline,
+            start + PHASE_TIMEOUTS.get(name, CYCLE_DEADLINE))
+        phase_runs.inc(phase=name)
+        try:
+            with tracing.span(name):
+                yield
+        except Exception as e:
+            self.error = e.__class__.__name__
+            self.failed_phase = name
+            phase_failures.inc(phase=name)
+            if isinstance(e, DeadlineExceeded):
+                phase_timeouts.inc(phase=name)
+            raise
+        finally:
+            self.phase_deadline = None
+            self.phases[name] = time.time() - start
+            phase_seconds.observe(self.phases[name], phase=name)
+
+    def time_left(self):
+        """ Seconds left to the running phase, or to the attempt. """
+        return (self.phase_deadline or self.deadline) - time.time()
+
+    def as_dict(self):
+        """ The attempt as a JSON serializable dictionary. """
+        return {
+            'started': self.started,
+            'phases': self.phases,
+            'bytes': self.bytes,
+            'outcome': self.outcome,
+            'error': self.error,
+            'failed_phase': self.failed_phase,
+        }
+
+#: Thread local state of the running extend procedure.
+current = threading.local()
+
+def bs_job_with_callback(url, callback_url, status_url=None,
+        trace_id=None):
+    """ Runs the browsershot job and posts the result afterwards.
+
+        The statistics of every attempt are sent with the state
+        reports and the final callback. Those failing to be sent are
+        retried with the next one.
+
+        Args:
+            url (string): The browsershots URL to extend.
+            callback_url (string): Where to POST when the job is done.
+            status_url (string): Where to POST the state after each
+                extension. Optional.
+            trace_id (string): The trace the job belongs to. Optional.
+    """
+    tracing.context.trace_id = trace_id
+    profiler.install_signal_handler()
+    memory.install_signal_handler()
+    cassette.start()
+    pending = []
+    def report(state, attempt):
+        pending.append(attempt.as_dict())
+        if not status_url or state == STATE_FINISHED:
+            # Goes with the callback.
+            return
+        try:
+            post_state(status_url, url, state, pending)
+        except (urllib2.URLError, socket.error):
+            # Keep them for the next report.
+            return
+        del pending[:]
+
     # The actual job.
-    finish_browshershot_job(url)
+    finish_browshershot_job(url, report)
+
+    # After the job send the 'done' message via POST.
+    post_state(callback_url, url, STATE_FINISHED, pending)
+
+def post_state(status_url, url, state, attempts=(), trace_id=None):
+    """ Tell the web application about the job progress.
 
-    # Preapre the data.
+        Args:
+            status_url (string): Where to POST the state.
+            url (string): The browsershots URL being extended.
+            state (string): STATE_EXTENDED, STATE_FAILED or
+                STATE_FINISHED.
+            attempts (list): AttemptStats dictionaries to send along.
+            trace_id (string): The trace the job belongs to, the one
+                of this thread by default.
+    """
     data = urllib.urlencode({
         'url': url,
+        'state': state,
+        'attempts': json.dumps(attempts),
+        'trace_id': trace_id or getattr(tracing.context, 'trace_id',
+            None) or '',
     })
-    # After the job send the 'done' message via POST.
-    req = urllib2.Request(callback_url, data)
-    response = urllib2.urlopen(req)
-    result = response.read()
+    req = urllib2.Request(status_url, data)
+    response = urllib2.urlopen(req, timeout=REQUEST_TIMEOUT)
+    response.read()
     response.close()
 
-def finish_browshershot_job(url):
-    """ Main browsershot job. """
-    # Set up the urllib to accept cookies and
-    # redirects.
+def finish_browshershot_job(url, report=None):
+    """ Main browsershot job.
+
+        Extends the session every HAMMER_FREQUENCY seconds, retrying
+        failed extensions, until there is nothing more to extend.
+        Raises the last error if the retries did not help.
+
+        Args:
+            url (string): The browsershots URL to extend.
+            report (callable): Called with the state and the
+                AttemptStats after each attempt. Optional.
+    """
+    install_opener()
+
+    def job_report(scheduled, state, attempt):
+        if report:
+            report(state, attempt)
+
+    outcome = []
+    extender = scheduler.Scheduler(
+        functools.partial(extend_job, report=job_report),
+        lambda scheduled, error: outcome.append(error),
+        workers=1, frequency=HAMMER_FREQUENCY)
+    extender.add(url)
+    try:
+        extender.run(until_idle=True)
+    finally:
+        metrics.registry.flush()
+    if outcome[0] is not None:
+        raise outcome[0]
+
+def install_opener():
+    """ Set up the urllib to accept cookies and redirects. """
     cookiejar = cookielib.CookieJar()
     url_opener = urllib2.build_opener(
         urllib2.HTTPCookieProcessor(cookiejar),
         urllib2.HTTPRedirectHandler)
     urllib2.install_opener(url_opener)
 
-    # Loop while we get a csrf token
-    request_id = extend_procedure(url)
-    while request_id:
-        time.sleep(HAMMER_FREQUENCY)
-        try:
-            request_id = extend_procedure(url)
-        except UnexpectedContentError:
-            # No request id--- it seems we've finished
-            pass
+def use_browsershots(url):
+    """ Talk to the browsershots at another URL, e.g. a local stand-in.
+
+        Args:
+            url (string): The main URL, ending with a slash.
+    """
+    global BROWSERSHOTS_URL, SIGNIN_URL, EXTEND_URL
+    BROWSERSHOTS_URL = url
+    SIGNIN_URL = BROWSERSHOTS_URL + 'accounts/signin'
+    EXTEND_URL = BROWSERSHOTS_URL + 'ajax/requests/extend'
+    pool.sign_out()
 
-def extend_procedure(url):
+def use_accounts(credentials, rate=None, burst=1):
+    """ Spread the jobs over several browsershots accounts.
+
+        Args:
+            credentials (list): (username, password) pairs.
+            rate (float): Requests per second allowed to each account,
+                None for no limit.
+            burst (int): Requests an account may make at once after
+                being idle.
+    """
+    global pool
+    pool = accounts.Pool([accounts.Account(
+            [('username', username), ('password', password)]
+            + [field for field in auth_data
+                if field[0] not in ('username', 'password')],
+            rate, burst)
+        for username, password in credentials])
+
+def extend_job(scheduled, report=None):
+    """ Extend a job of the scheduler, as its extend function.
+
+        The first attempt not finding a request id on the result page
+        fails, the later ones mean the job is finished. Unexpected
+        content in the other phases is a failure, to be retried.
+
+        Args:
+            scheduled (ScheduledJob): The job to extend.
+            report (callable): Called with the job, the state and the
+                AttemptStats of the attempt. Optional.
+        Returns:
+            True if there is more to extend.
+    """
+    attempt = AttemptStats()
+    try:
+        extend_procedure(scheduled.url, attempt)
+    except UnexpectedContentError:
+        if (scheduled.last_success is not None
+                and attempt.failed_phase == 'get_request_id'):
+            # No request id--- it seems we've finished
+            attempt.outcome = STATE_FINISHED
+            finish_attempt(scheduled, STATE_FINISHED, attempt, report)
+            return False
+        attempt.outcome = STATE_FAILED
+        finish_attempt(scheduled, STATE_FAILED, attempt, report)
+        raise
+    except Exception:
+        attempt.outcome = STATE_FAILED
+        finish_attempt(scheduled, STATE_FAILED, attempt, report)
+        raise
+    finish_attempt(scheduled, STATE_EXTENDED, attempt, report)
+    return True
+
+def finish_attempt(scheduled, state, attempt, report):
+    """ Count, flush the metrics and report an attempt. """
+    if state == STATE_EXTENDED:
+        accounts.account_extensions.inc(account=attempt.account)
+    elif state == STATE_FAILED:
+        accounts.account_failures.inc(account=attempt.account)
+    metrics.registry.maybe_flush()
+    if report:
+        report(scheduled, state, attempt)
+
+def extend_procedure(url, attempt=None, account=None):
     """ Execute the full browsershots extend procedure.
 
+        The account logs in only when its session isn't valid any more.
+        Only browsershots not taking the session drops it, the other
+        failures and a finished job keep it for the next jobs. With a
+        session kept from before, which may have expired at
+        browsershots, the extension is tried again once with a fresh
+        login then.
+
         Attrs:
             url (string): The browsershots URL to extend.
+            attempt (AttemptStats): Collects the timings. Optional.
+            account (Account): The account to use, the one of the URL
+                in the pool by default.
     """
-    # Extract the CSRF token from the site to login.
-    csrf = get_CSRF()
-    # Login to get the session id in the cookie.
-    login(csrf)
-    # Get the request id for the extension.
-    request_id = get_request_id(url)
-    # Finally, extend the session with the right id and being
-    # logged in.
-    extend_session(request_id)
-
+    if attempt is None:
+        attempt = AttemptStats()
+    if account is None:
+        account = pool.account_for(url)
+    attempt.account = account.username
+    current.attempt = attempt
+    current.account = account
+    try:
+        with tracing.span('extend_procedure', url=url,
+                account=account.username):
+            for retry in (False, True):
+                fresh = sign_in(account, attempt)
+                session = account.signed_in
+                try:
+                    # Get the request id for the extension.
+                    with attempt.phase('get_request_id'):
+                        request_id = get_request_id(url)
+                    # Finally, extend the session with the right id and
+                    # being logged in.
+                    with attempt.phase('extend_session'):
+                        extend_session(request_id)
+                    break
+                except SignedOutError:
+                    # Unless another job logged in again meanwhile.
+                    if account.signed_in == session:
+                        account.sign_out()
+                    if fresh or retry:
+                        raise
+                    attempt.error = attempt.failed_phase = None
+    finally:
+        current.attempt = None
+        current.account = None
+
+    attempt.outcome = STATE_EXTENDED
     return request_id
 
+def sign_in(account, attempt):
+    """ Log an account in, unless its session is still valid. The
+        other jobs of the account wait for it and share the session.
+
+        Returns:
+            True if logged in now, False for a session kept.
+    """
+    if not account.lock.acquire(max(attempt.time_left(), 0)):
+        raise DeadlineExceeded('No time left to wait for the login of '
+            + account.username)
+    try:
+        if account.session_valid():
+            return False
+        try:
+            # Extract the CSRF token from the site to login.
+            with attempt.phase('get_CSRF'):
+                csrf = get_CSRF()
+            # Login to get the session id in the cookie.
+            with attempt.phase('login'):
+                login(csrf, account.auth_data)
+        except Exception:
+            account.sign_out()
+            raise
+        account.remember_session()
+        return True
+    finally:
+        account.lock.release()
+
+def fetch(req):
+    """ Make a request to browsershots through the cassette transport
+        and read the whole response.
+
+        The request goes through the session of the account of the
+        running attempt, after its rate limit. Waiting for it and the
+        request take the time left to the phase of the attempt at most,
+        the request REQUEST_TIMEOUT without one. The bytes sent and
+        received are counted to the attempt.
+
+        Args:
+            req (Request): The request to make.
+        Returns:
+            The response code and the body (string).
+        Raises:
+            DeadlineExceeded: When the request takes longer.
+    """
+    account = getattr(current, 'account', None)
+    attempt = getattr(current, 'attempt', None)
+    opener = None
+    if account is not None:
+        if not account.throttle(attempt.time_left() if attempt else None):
+            raise DeadlineExceeded('No time left for the rate limit to '
+                'request ' + req.get_full_url())
+        opener = account.opener
+    timeout = REQUEST_TIMEOUT
+    if attempt:
+        timeout = attempt.time_left()
+        if timeout <= 0:
+            raise DeadlineExceeded('No time left to request '
+                + req.get_full_url())
+    try:
+        code, body = cassette.transport(req, opener, timeout)
+    except socket.timeout as e:
+        raise DeadlineExceeded('Requesting %s timed out: %s'
+            % (req.get_full_url(), e))
+    except urllib2.URLError as e:
+        if isinstance(e.reason, socket.timeout):
+            raise DeadlineExceeded('Requesting %s timed out: %s'
+                % (req.get_full_url(), e.reason))
+        raise
+    transferred = len(body) + len(req.get_data() or '')
+    outbound_bytes.inc(transferred)
+    if attempt:
+        attempt.bytes += transferred
+    return code, body
+
+def excerpt(html):
+    """ The beginning of a page, for an error message.
+
+        Keeps the exceptions, and what holds on to them, small.
+    """
+    if len(html) <= EXCERPT_LENGTH:
+        return html
+    return html[:EXCERPT_LENGTH] + '\n[%d more bytes]' % (
+        len(html) - EXCERPT_LENGTH)
+
 def get_CSRF():
     """ Get the CSRF token.
 
@@ -181,24 +587,31 @@ def get_CSRF():
     """
     # Get the HTML from the website.
     req = urllib2.Request(BROWSERSHOTS_URL, None, headers)
-    response = urllib2.urlopen(req)
-    html = response.read()
-    if response.getcode() != 200:
-        response.close()
+    code, html = fetch(req)
+    if code != 200:
         raise WrongResponseError('Error retreiving CSRF token from'
-            + 'browsershots. Got response: ' + str(response.getcode())
-            + ':\n' + html)
+            + 'browsershots. Got response: ' + str(code)
+            + ':\n' + excerpt(html))
+
+    return parse_csrf(html)
+
+def parse_csrf(html):
+    """ Find and extract the CSRF token from the HTML.
 
-    # Find and extract the CSRF token from the HTML.
-    match = re.search(csrf_regex, html)
+        Args:
+            html (string): The browsershots home page.
+        Returns:
+            CSRF token as a string.
+    """
+    match = csrf_regex.search(html)
     if match:
         return match.groupdict()['csrf']
     else:
         raise UnexpectedContentError('Could not find the csrf token'
             + ' on the retreived page. Used regexp:\n'
-            + str(csrf_regex.pattern) + '\nPage:\n' + html)
+            + str(csrf_regex.pattern) + '\nPage:\n' + excerpt(html))
 
-def login(csrf):
+def login(csrf, auth=None):
     """ Login to browsershots.
 
         Uses the csrf token and credentials to login to browsershots.
@@ -206,10 +619,12 @@ def login(csrf):
 
         Args:
             csrf (string): The CSRF token.
+            auth (list): The login form fields, auth_data by default.
     """
-    # Insert the token to the data dict.
-    auth_data.insert(0, ('csrfmiddlewaretoken', csrf))
-    data = urllib.urlencode(auth_data)
+    if auth is None:
+        auth = auth_data
+    # Put the token in front of the credentials.
+    data = urllib.urlencode([('csrfmiddlewaretoken', csrf)] + auth)
 
     # Update headers with json request.
     new_headers = copy.deepcopy(headers)
@@ -217,18 +632,25 @@ def login(csrf):
 
     # Make the login request.
     req = urllib2.Request(SIGNIN_URL, data, new_headers)
-    response = urllib2.urlopen(req)
-    html = response.read()
+    logins.inc()
+    code, html = fetch(req)
+
+    parse_logged_in(html)
 
-    # Search for logout link, won't be there unless successfully
-    # logged in.
-    match = re.search(logged_regex, html)
+def parse_logged_in(html):
+    """ Check a page for the logout link, won't be there unless
+        successfully logged in.
+
+        Args:
+            html (string): The page the login, or a result page,
+                responded with.
+    """
+    match = logged_regex.search(html)
     if not match:
-        response.close()
-        raise UnexpectedContentError('There is no logout link on the'
+        raise SignedOutError('There is no logout link on the'
             + ' browsershots webpage. Regexp used: '
             + logged_regex.pattern + '\nPage:\n'
-            + html)
+            + excerpt(html))
 
 def get_request_id(url):
     """ Gets the request ID for the extension.
@@ -244,21 +666,30 @@ def get_request_id(url):
     """
     # Get the HTML content.
     req = urllib2.Request(url, None, headers)
-    response = urllib2.urlopen(req)
-    html = response.read()
-    if response.getcode() != 200:
+    code, html = fetch(req)
+    if code != 200:
         raise WrongResponseError('Wrong response code on fetching'
-            + ' browsershots page.\nCode: ' + str(response.getcode())
-            + '\nPage:\n' + html)
+            + ' browsershots page.\nCode: ' + str(code)
+            + '\nPage:\n' + excerpt(html))
+
+    parse_logged_in(html)
+    return parse_request_id(html)
+
+def parse_request_id(html):
+    """ Extract the request id for the extension from the HTML.
 
-    # Extract the id for later usage.
-    match = re.search(extend_regex, html)
+        Args:
+            html (string): The browsershots page of the URL.
+        Returns:
+            The id string.
+    """
+    match = extend_regex.search(html)
     if match:
         return  match.groupdict()['id']
     else:
         raise UnexpectedContentError('Unable to fetch the browsershots id'
             + ' from the page. Regexp used:\n' + str(extend_regex.pattern)
-            + '\nPage:\n' + html)
+            + '\nPage:\n' + excerpt(html))
 
 def extend_session(request_id):
     """ Extends the session for a given id.
@@ -280,13 +711,11 @@ def extend_session(request_id):
     new_headers.update(localhost_headers)
     new_headers.update(json_headers)
     req = urllib2.Request(EXTEND_URL, data, new_headers)
-    response = urllib2.urlopen(req)
-    html = response.read()
-    response.close()
+    code, html = fetch(req)
     if not '"success": true' in html:
-        raise UnexpectedContentError('No success string in the'
-            + ' extend response. Response code: ' + response.getcode()
-            + '\nJSON:\n' + html)
+        raise SignedOutError('No success string in the'
+            + ' extend response. Response code: ' + str(code)
+            + '\nJSON:\n' + excerpt(html))
 
 if __name__ == '__main__':
     finish_browshershot_job('http://browsershots.org/'
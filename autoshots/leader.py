@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CEZARY KRZYŻANOWSKI OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+"""
+.. module: leader
+    :platform: Unix
+    :synopsis: Elects the one process of a host running the scheduler.
+
+.. moduleauthor: Cezary Krzyżanowski <cezary.krzyzanowski@gmail.com>
+
+The web processes of a host are equal, and the extensions would be
+made once by each of them if all ran the scheduler. Instead they
+campaign for an exclusive flock on a lock file: the process getting it
+is the leader and runs the scheduler, the others retry every
+`interval` seconds. The kernel releases the lock of a process that
+dies, so another one takes over within that time.
+"""
+
+import errno
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # No process leads then, run the daemon instead.
+    fcntl = None
+
+import metrics
+
+#: Processes leading, 1 on a healthy host.
+leaders = metrics.registry.gauge('autoshots_leader_processes',
+    'Processes of the host running the scheduler.')
+
+class Election(object):
+    """ The campaign of a process for the leadership of the host.
+
+        Attrs:
+            path (string): The lock file shared by the processes.
+            interval (float): Seconds between the campaigns of a
+                process not leading.
+            stopping (Event): Set to end the campaign.
+    """
+
+    def __init__(self, path, interval=2):
+        self.path = path
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.file = None
+        self.pid = None
+
+    @property
+    def leading(self):
+        return self.file is not None
+
+    def campaign(self):
+        """ Try to become the leader.
+
+            Returns:
+                True if leading.
+        """
+        if fcntl is None:
+            return False
+        if self.file is None:
+            lock = open(self.path, 'a')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                lock.close()
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return False
+            self.file = lock
+            leaders.set(1)
+        return True
+
+    def resign(self):
+        """ Let another process lead. """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            leaders.set(0)
+
+    def run(self, lead):
+        """ Campaign until elected, then lead, until stopped.
+
+            Args:
+                lead (callable): Runs while leading. Returning resigns.
+        """
+        while not self.stopping.is_set():
+            if self.campaign():
+                try:
+                    lead()
+                finally:
+                    self.resign()
+            else:
+                self.stopping.wait(self.interval)
+
+    def start(self, lead):
+        """ Run the election in a thread of this process, unless it runs
+            already. Cheap enough to call on every request, so each
+            process forked by the server campaigns for itself.
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            if self.file is not None:
+                # Inherited from the parent, which keeps leading.
+                self.file.close()
+                self.file = None
+            thread = threading.Thread(target=self.run, args=(lead, ),
+                name='autoshots-leader')
+            thread.daemon = True
+            thread.start()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CEZARY KRZYŻANOWSKI OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+"""
+.. module: memory
+    :platform: Unix, Windows
+    :synopsis: tracemalloc snapshots diffed against a baseline.
+
+.. moduleauthor: Cezary Krzyżanowski <cezary.krzyzanowski@gmail.com>
+
+Needs the tracemalloc module (Python 3.4+, or pytracemalloc on a
+patched Python 2.7). Without it the functions here report that memory
+tracing is not available.
+
+The web workers are inspected through /admin/memory. The jobs take
+their baseline when they start and write a report, diffed against it,
+on SIGUSR1, i.e. ``kill -USR1 <pid>``.
+"""
+
+import os
+import signal
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+#: Number of frames kept for each allocation. 0 turns tracing off.
+frames = 0
+#: Where the reports of the jobs are written.
+directory = None
+#: The snapshot the reports are diffed against.
+baseline = None
+
+def available():
+    """ Can memory be traced in this process? """
+    return tracemalloc is not None and frames > 0
+
+def start():
+    """ Start tracing the allocations, if configured. """
+    if available() and not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+def take_baseline():
+    """ Take the snapshot the next reports are diffed against. """
+    global baseline
+    start()
+    baseline = tracemalloc.take_snapshot()
+
+def top(limit=20):
+    """ The top allocation sites.
+
+        Diffed against the baseline, if there is one.
+
+        Args:
+            limit (int): Number of the sites reported.
+        Returns:
+            A list of lines, biggest first.
+    """
+    start()
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    if baseline is None:
+        stats = snapshot.statistics('traceback')
+    else:
+        stats = snapshot.compare_to(baseline, 'traceback')
+    lines = []
+    for stat in stats[:limit]:
+        lines.append(str(stat))
+        lines.extend('    ' + line for line in stat.traceback.format())
+    return lines
+
+def write_report(limit=20):
+    """ Write a report of the top allocation sites to the directory.
+
+        Returns:
+            Path of the report.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, 'memory-%d-%d.txt'
+        % (os.getpid(), time.time()))
+    with open(path, 'w') as f:
+        f.write('\n'.join(top(limit)) + '\n')
+    return path
+
+def rss():
+    """ The resident set size of this process, in bytes. None where
+        /proc is missing.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+def on_signal(signum, frame):
+    """ Signal handler writing a report. """
+    write_report()
+
+def install_signal_handler():
+    """ Take the baseline and report on SIGUSR1, if memory can be
+        traced and reports have a directory.
+    """
+    if available() and directory and hasattr(signal, 'SIGUSR1'):
+        take_baseline()
+        signal.signal(signal.SIGUSR1, on_signal)
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CEZARY KRZYŻANOWSKI OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+"""
+.. module: metrics
+    :platform: Unix, Windows
+    :synopsis: Prometheus style metrics aggregated over processes.
+
+.. moduleauthor: Cezary Krzyżanowski <cezary.krzyzanowski@gmail.com>
+
+Every process (web worker or job) counts into its own registry and
+now and then flushes it to a file named after its pid in the spool
+directory. The process serving a scrape sums up all the files with its
+own values. Files of finished processes are folded into a single
+retired file, so the counters never go back.
+"""
+
+import functools
+import json
+import multiprocessing.util
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # No retiring of the spool files then.
+    fcntl = None
+
+#: Default histogram buckets (seconds).
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+    5.0, 10.0, 30.0, 60.0)
+
+#: Name of the spool file holding the sums of the finished processes.
+RETIRED = 'retired.json'
+
+class Metric(object):
+    """ A named family of values, one per set of label values. """
+
+    #: Prometheus type of the metric.
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        #: Values, by the tuple of label values.
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        """ The values key for the given label keyword arguments. """
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def merge(self, key, value):
+        """ Add the value of another process. """
+        raise NotImplementedError()
+
+    def samples(self):
+        """ Generate the (suffix, labels, value) samples to expose. """
+        for key, value in sorted(self.values.items()):
+            yield '', list(zip(self.labels, key)), value
+
+class Counter(Metric):
+    """ A value only going up. """
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def merge(self, key, value):
+        self.values[key] = self.values.get(key, 0) + value
+
+class Gauge(Metric):
+    """ A value going up and down, dropped with its process.
+
+        The values of the processes are summed up, unless another
+        aggregate function, like max, is given.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), aggregate=None):
+        Metric.__init__(self, name, help, labels)
+        self.aggregate = aggregate
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def merge(self, key, value):
+        if key in self.values and self.aggregate is not None:
+            self.values[key] = self.aggregate(self.values[key], value)
+        else:
+            self.values[key] = self.values.get(key, 0) + value
+
+class Histogram(Metric):
+    """ Observations counted into buckets.
+
+        A value is the list of the bucket counts, followed by the sum
+        and the count of the observations.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def merge(self, key, value):
+        counts = self.values.get(key)
+        if counts is None:
+            self.values[key] = list(value)
+        else:
+            self.values[key] = [a + b for a, b in zip(counts, value)]
+
+    def samples(self):
+        for key, counts in sorted(self.values.items()):
+            labels = list(zip(self.labels, key))
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                yield '_bucket', labels + [('le', repr(bound))], total
+            yield '_bucket', labels + [('le', '+Inf')], counts[-1]
+            yield '_sum', labels, counts[-2]
+            yield '_count', labels, counts[-1]
+
+class Registry(object):
+    """ The metrics of a process, and their spool file.
+
+        Attrs:
+            directory (string): The spool directory, shared by all the
+                processes of a node. None disables the spooling.
+            flush_interval (float): Seconds between the flushes done by
+                maybe_flush.
+    """
+
+    def __init__(self, directory=None, flush_interval=10):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.metrics = {}
+        self.flushed = 0
+        multiprocessing.util.register_after_fork(self, Registry.reset)
+
+    def register(self, metric):
+        """ Add a metric, returning it. """
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), aggregate=None):
+        return self.register(Gauge(name, help, labels, aggregate))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def reset(self):
+        """ Forget the values, e.g. those inherited by a forked child. """
+        for metric in self.metrics.values():
+            metric.values = {}
+        self.flushed = 0
+
+    def dump(self):
+        """ The values as a JSON serializable dictionary. """
+        result = {}
+        for name, metric in self.metrics.items():
+            with metric.lock:
+                result[name] = [[list(k), v]
+                    for k, v in metric.values.items()]
+        return result
+
+    def flush(self):
+        """ Write the values to the spool file of this process. """
+        self.flushed = time.time()
+        if not self.directory:
+            return
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Made by another process in the meantime.
+                pass
+        write_json(os.path.join(self.directory,
+            '%d.json' % os.getpid()), self.dump())
+
+    def maybe_flush(self):
+        """ Flush, unless done in the last flush_interval seconds. """
+        if time.time() - self.flushed >= self.flush_interval:
+            self.flush()
+
+    def collect(self):
+        """ The metrics of all the processes summed up.
+
+            Returns:
+                A list of metrics, named like the registered ones.
+        """
+        merged = {}
+        for name, metric in self.metrics.items():
+            merged[name] = metric.__class__(name, metric.help,
+                metric.labels)
+            if isinstance(metric, Histogram):
+                merged[name].buckets = metric.buckets
+            if isinstance(metric, Gauge):
+                merged[name].aggregate = metric.aggregate
+        def add(dump, with_gauges=True):
+            for name, values in dump.items():
+                target = merged.get(name)
+                if target is None or (not with_gauges
+                        and isinstance(target, Gauge)):
+                    continue
+                for key, value in values:
+                    target.merge(tuple(key), value)
+        add(self.dump())
+        if self.directory and os.path.isdir(self.directory):
+            self.retire()
+            for filename in os.listdir(self.directory):
+                if (not filename.endswith('.json')
+                        or filename == '%d.json' % os.getpid()):
+                    continue
+                dump = read_json(os.path.join(self.directory, filename))
+                add(dump, with_gauges=filename != RETIRED)
+        return [merged[name] for name in sorted(merged)]
+
+    def retire(self):
+        """ Fold the spool files of finished processes into the
+            retired file.
+        """
+        if fcntl is None:
+            return
+        lock = open(os.path.join(self.directory, 'retire.lock'), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            retired_path = os.path.join(self.directory, RETIRED)
+            retired = read_json(retired_path)
+            dead = []
+            for filename in os.listdir(self.directory):
+                pid = filename[:-len('.json')]
+                if not filename.endswith('.json') or not pid.isdigit():
+                    continue
+                if process_exists(int(pid)):
+                    continue
+                path = os.path.join(self.directory, filename)
+                for name, values in read_json(path).items():
+                    metric = self.metrics.get(name)
+                    if metric is None or isinstance(metric, Gauge):
+                        continue
+                    total = metric.__class__(name, '', metric.labels)
+                    for key, value in retired.get(name, []):
+                        total.merge(tuple(key), value)
+                    for key, value in values:
+                        total.merge(tuple(key), value)
+                    retired[name] = [[list(k), v]
+                        for k, v in total.values.items()]
+                dead.append(path)
+            if dead:
+                write_json(retired_path, retired)
+                for path in dead:
+                    os.unlink(path)
+        finally:
+            lock.close()
+
+    def render(self, extra=()):
+        """ The collected metrics in the Prometheus text format.
+
+            Args:
+                extra (list): More metrics, e.g. gauges computed for
+                    the scrape.
+        """
+        lines = []
+        for metric in self.collect() + list(extra):
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for suffix, labels, value in metric.samples():
+                if labels:
+                    lines.append('%s%s{%s} %s' % (metric.name, suffix,
+                        ','.join('%s="%s"' % (k, escape(v))
+                            for k, v in labels), format_value(value)))
+                else:
+                    lines.append('%s%s %s' % (metric.name, suffix,
+                        format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def timed(self, counter, histogram, **labels):
+        """ Decorator counting the calls of a function and observing
+            their duration.
+        """
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                start = time.time()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    counter.inc(**labels)
+                    histogram.observe(time.time() - start, **labels)
+                    self.maybe_flush()
+            return wrapper
+        return decorator
+
+def process_exists(pid):
+    """ Is there a process with the given pid? """
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+def read_json(path):
+    """ Read a spool file, as an empty dictionary if missing. """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def write_json(path, data):
+    """ Replace a spool file atomically. """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+        prefix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp, path)
+
+def escape(value):
+    """ Escape a label value. """
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n'))
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+#: The registry of this process.
+registry = Registry()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CEZARY KRZYŻANOWSKI OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+"""
+.. module: mule
+    :platform: Unix
+    :synopsis: The extension engine in uwsgi mules.
+
+.. moduleauthor: Cezary Krzyżanowski <cezary.krzyzanowski@gmail.com>
+
+With the 'mule' JOB_BACKEND the extensions run in uwsgi mules instead
+of processes forked by the requests, so uwsgi supervises them. Every
+mule listed in uwsgi.xml runs this file::
+
+    <mule>mule.py</mule>
+    <mule>mule.py</mule>
+
+and in it the lease engine of the daemon, each mule claiming the jobs
+of its own partition. uwsgi starts again a mule that dies or exits,
+and a mule growing over DAEMON_MAX_RSS drains and exits to be
+recycled. The mule of a partition keeps its lease owner name when
+started again, taking over the jobs of the last one right away.
+
+The web processes wake the mule of a job added, through a mule
+message, instead of it waiting for the next poll.
+"""
+
+import signal
+import socket
+import threading
+
+try:
+    import uwsgi
+except ImportError:
+    # Not running under uwsgi, nothing to wake.
+    uwsgi = None
+
+import daemon
+import settings
+import storage
+
+def mules():
+    """ The number of the engine mules. """
+    scripts = uwsgi.opt.get('mule', [])
+    if not isinstance(scripts, list):
+        scripts = [scripts]
+    return len(scripts)
+
+def notify(job_id):
+    """ Wake the mule extending a job. Called by the web processes.
+
+        Args:
+            job_id (int): The id of the job.
+    """
+    if uwsgi is None or not mules():
+        return
+    try:
+        uwsgi.mule_msg('poll', job_id % mules() + 1)
+    except Exception:
+        # The queue of the mule is full or it is starting, the job is
+        # claimed on the next poll anyway.
+        pass
+
+def listen(engine):
+    """ Poll each time a web process sends a message. """
+    while True:
+        uwsgi.mule_get_msg()
+        engine.wake()
+
+def main():
+    """ Run the engine of this mule until uwsgi stops it. """
+    config = settings.from_environment()
+    if config.JOB_BACKEND != 'mule':
+        # Started by a uwsgi.xml with another backend configured.
+        while True:
+            uwsgi.mule_get_msg()
+    daemon.configure(config)
+    count = mules()
+    index = uwsgi.mule_id() - 1
+    engine = daemon.Daemon(
+        storage.create_engine(config.DATABASE_URI, config),
+        config.DAEMON_WEB_URL, config.DAEMON_WORKERS,
+        config.DAEMON_POLL_INTERVAL, config.CHANGES_LIMIT,
+        '%s:mule%d' % (socket.gethostname(), index),
+        config.DAEMON_LEASE_PERIOD, config.DAEMON_MAX_JOBS,
+        (index, count) if count > 1 else None, config.DAEMON_MAX_RSS)
+    listener = threading.Thread(target=listen, args=(engine, ),
+        name='autoshots-mule-listener')
+    listener.daemon = True
+    listener.start()
+    daemon.start_engine()
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, engine.stop)
+    engine.run()
+
+if uwsgi is not None and uwsgi.mule_id():
+    main()
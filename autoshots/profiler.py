@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CEZARY KRZYŻANOWSKI OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+"""
+.. module: profiler
+    :platform: Unix, Windows
+    :synopsis: On demand sampling profiler for running processes.
+
+.. moduleauthor: Cezary Krzyżanowski <cezary.krzyzanowski@gmail.com>
+
+A sampler thread takes the stacks of all the other threads every
+SAMPLE_INTERVAL seconds for a given time and writes them, counted, in
+the collapsed stack format of flamegraph.pl and speedscope.
+
+A sample costs a walk over the stacks of the threads, in the order of
+tens of microseconds for the processes of autoshots, so the default
+interval of 10ms keeps the overhead under 1% of one CPU. The sampler
+stops on its own after at most MAX_SECONDS, and only one runs per
+process at a time.
+
+The web workers are profiled through /admin/profile. The jobs start
+profiling on SIGUSR2, i.e. ``kill -USR2 <pid>``.
+"""
+
+import os
+import signal
+import sys
+import threading
+import time
+
+#: Seconds between the samples.
+SAMPLE_INTERVAL = 0.01
+#: Longest allowed profiling run, in seconds.
+MAX_SECONDS = 300
+#: Seconds profiled on a signal.
+SIGNAL_SECONDS = 30
+
+#: Where the profiles are written.
+directory = None
+
+#: The running sampler of this process.
+running = None
+lock = threading.Lock()
+
+class Sampler(threading.Thread):
+    """ The thread sampling the stacks of the others. """
+
+    def __init__(self, seconds, interval, path):
+        threading.Thread.__init__(self, name='autoshots-profiler')
+        self.daemon = True
+        self.seconds = min(seconds, MAX_SECONDS)
+        self.interval = interval
+        self.path = path
+        #: Sample counts by collapsed stack.
+        self.stacks = {}
+
+    def sample(self):
+        me = threading.current_thread().ident
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append('%s (%s:%d)' % (code.co_name,
+                    os.path.basename(code.co_filename),
+                    code.co_firstlineno))
+                frame = frame.f_back
+            stack = ';'.join(reversed(names))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def run(self):
+        global running
+        try:
+            end = time.time() + self.seconds
+            while time.time() < end:
+                self.sample()
+                time.sleep(self.interval)
+            with open(self.path, 'w') as f:
+                for stack, count in sorted(self.stacks.items()):
+                    f.write('%s %d\n' % (stack, count))
+        finally:
+            with lock:
+                running = None
+
+def start(seconds, interval=SAMPLE_INTERVAL):
+    """ Start profiling this process in the background.
+
+        Args:
+            seconds (float): For how long to sample.
+            interval (float): Seconds between the samples.
+        Returns:
+            Path of the profile to be written, or None if there is a
+            profiling run going on already.
+    """
+    global running
+    # Not blocking, as this runs in signal handlers.
+    if not lock.acquire(False):
+        return None
+    try:
+        if running is not None:
+            return None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, 'profile-%d-%d.collapsed'
+            % (os.getpid(), time.time()))
+        running = Sampler(seconds, interval, path)
+        running.start()
+        return path
+    finally:
+        lock.release()
+
+def on_signal(signum, frame):
+    """ Signal handler starting a SIGNAL_SECONDS profiling run. """
+    start(SIGNAL_SECONDS)
+
+def install_signal_handler():
+    """ Profile this process on SIGUSR2, if it has one and profiling
+        is configured.
+    """
+    if directory and hasattr(signal, 'SIGUSR2'):
+        signal.signal(signal.SIGUSR2, on_signal)
@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CEZARY KRZYŻANOWSKI OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+"""
+.. module: scheduler
+    :platform: Unix, Windows
+    :synopsis: Runs the extension of many jobs on time.
+
+.. moduleauthor: Cezary Krzyżanowski <cezary.krzyzanowski@gmail.com>
+
+The scheduler keeps the jobs in a heap by the time they are due and
+hands those due to a pool of worker threads. A job is due again
+`frequency` seconds after its last extension started, or `retry_delay`
+seconds after a failure.
+
+How late each extension starts relative to its due time (the lag) is
+tracked in a histogram and as the p99 of the last LAG_WINDOW
+extensions, together with the number of jobs waiting for a thread.
+"""
+
+import collections
+import heapq
+import itertools
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import metrics
+
+#: Number of the latest lags the rolling p99 is taken over.
+LAG_WINDOW = 1000
+
+#: Lag of the extensions, from due time to start.
+lag_seconds = metrics.registry.histogram('autoshots_scheduler_lag_seconds',
+    'Lag of the extensions behind their due time.',
+    buckets=(0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0,
+        600.0))
+#: Rolling p99 of the lag, the worst process counting.
+lag_p99 = metrics.registry.gauge('autoshots_scheduler_lag_p99_seconds',
+    'Rolling p99 of the extension lag.', aggregate=max)
+#: Due jobs waiting for a worker thread.
+queue_depth = metrics.registry.gauge('autoshots_scheduler_queue_depth',
+    'Due jobs waiting for a worker thread.')
+
+class Clock(object):
+    """ The real time, as seen by the scheduler. """
+
+    def time(self):
+        return time.time()
+
+    def wait(self, condition, timeout):
+        """ Wait on a held condition.
+
+            Args:
+                condition (Condition): Notified on changes.
+                timeout (float): Seconds to wait at most, None for
+                    no limit.
+        """
+        condition.wait(timeout)
+
+class ScaledClock(Clock):
+    """ Time running factor times faster than the real one, for
+        running the scheduler on a compressed time scale.
+    """
+
+    def __init__(self, factor):
+        self.factor = float(factor)
+        self.origin = time.time()
+
+    def time(self):
+        return self.origin + (time.time() - self.origin) * self.factor
+
+    def wait(self, condition, timeout):
+        if timeout is not None:
+            timeout /= self.factor
+        condition.wait(timeout)
+
+class VirtualClock(Clock):
+    """ Time that passes only when told to, for simulations.
+
+        Attrs:
+            now (float): The current time.
+    """
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def wait(self, condition, timeout):
+        """ Move the time to the end of the wait. """
+        if timeout is None:
+            raise RuntimeError('Waiting forever on a virtual clock')
+        self.now += timeout
+
+class ScheduledJob(object):
+    """ A job in the scheduler. """
+
+    def __init__(self, url, due):
+        #: The browsershots URL to extend.
+        self.url = url
+        #: When (timestamp) the job is to be extended next.
+        self.due = due
+        #: Start (timestamp) of the last successful extension.
+        self.last_success = None
+        #: The trace the job was added in, see tracing.py.
+        self.trace_id = None
+        #: Failures since the last success.
+        self.failures = 0
+        #: The exception the last extension failed with.
+        self.error = None
+        #: Set when the job was removed from the scheduler.
+        self.removed = False
+
+    def __repr__(self):
+        return '<ScheduledJob %r>' % self.url
+
+class Scheduler(object):
+    """ Extends the sessions of the jobs on time.
+
+        Attrs:
+            extend (callable): Extends a ScheduledJob. Returns True if
+                it needs to be extended again, False if finished. An
+                exception means a failure, retried up to max_retries
+                times in a row.
+            done (callable): Called with the ScheduledJob and None when
+                it is finished, or the last exception when it gave up.
+                Optional.
+            workers (int): Number of the worker threads.
+            frequency (float): Seconds between the extensions of a job.
+            retry_delay (float): Seconds to wait after a failure.
+            max_retries (int): Failures in a row tolerated.
+            clock (Clock): The time source.
+            checkpoint (callable): Called with the ScheduledJob after
+                each extension rescheduling it, to save its schedule.
+                Optional.
+    """
+
+    def __init__(self, extend, done=None, workers=4, frequency=540,
+            retry_delay=60, max_retries=3, clock=None, checkpoint=None):
+        self.extend = extend
+        self.done = done
+        self.checkpoint = checkpoint
+        self.workers = workers
+        self.frequency = frequency
+        self.retry_delay = retry_delay
+        self.max_retries = max_retries
+        self.clock = clock or Clock()
+        self.condition = threading.Condition()
+        #: The jobs, by URL.
+        self.jobs = {}
+        self.heap = []
+        self.sequence = itertools.count()
+        #: Jobs handed to the pool, not started yet.
+        self.queued = 0
+        #: The latest lags.
+        self.lags = collections.deque(maxlen=LAG_WINDOW)
+        self.stopped = False
+        self.pool = None
+
+    def add(self, url, due=None):
+        """ Schedule a job, unless it is scheduled already.
+
+            Args:
+                url (string): The browsershots URL to extend.
+                due (float): When to extend first, now by default.
+            Returns:
+                The ScheduledJob.
+        """
+        with self.condition:
+            scheduled = self.jobs.get(url)
+            if scheduled is None:
+                if due is None:
+                    due = self.clock.time()
+                scheduled = self.jobs[url] = ScheduledJob(url, due)
+                self.push(scheduled)
+                self.condition.notify_all()
+            return scheduled
+
+    def remove(self, url):
+        """ Stop extending a job. A running extension is not stopped. """
+        with self.condition:
+            scheduled = self.jobs.pop(url, None)
+            if scheduled is not None:
+                scheduled.removed = True
+
+    def push(self, scheduled):
+        heapq.heappush(self.heap,
+            (scheduled.due, next(self.sequence), scheduled))
+
+    def run_pending(self):
+        """ Dispatch the due jobs. Call with the condition held.
+
+            Returns:
+                Seconds until the next job is due, None if there are
+                no jobs waiting.
+        """
+        now = self.clock.time()
+        while self.heap:
+            due, sequence, scheduled = self.heap[0]
+            if scheduled.removed:
+                heapq.heappop(self.heap)
+                continue
+            if due > now:
+                return due - now
+            heapq.heappop(self.heap)
+            self.queued += 1
+            queue_depth.set(self.queued)
+            self.dispatch(scheduled)
+        return None
+
+    def dispatch(self, scheduled):
+        """ Hand a due job to the worker threads. """
+        if self.pool is None:
+            self.pool = ThreadPool(self.workers)
+        self.pool.apply_async(self.execute, (scheduled, ))
+
+    def execute(self, scheduled):
+        """ Extend a job and schedule it again. Runs in a worker. """
+        started = self.start(scheduled)
+        error = None
+        more = True
+        try:
+            more = self.extend(scheduled)
+        except Exception as e:
+            error = e
+        self.complete(scheduled, started, more, error)
+
+    def start(self, scheduled):
+        """ Note a dispatched job starting its extension.
+
+            Returns:
+                The start time.
+        """
+        started = self.clock.time()
+        with self.condition:
+            self.queued -= 1
+            queue_depth.set(self.queued)
+            self.record_lag(started - scheduled.due)
+        return started
+
+    def complete(self, scheduled, started, more, error):
+        """ Schedule a job after its extension ended. """
+        with self.condition:
+            finished = self.reschedule(scheduled, started, more, error)
+            self.condition.notify_all()
+        # Outside the condition, the callbacks may block for long.
+        if finished:
+            if self.done:
+                self.done(scheduled, scheduled.error)
+        elif self.checkpoint and not scheduled.removed:
+            self.checkpoint(scheduled)
+
+    def record_lag(self, lag):
+        """ Note the lag of an extension. Call with the condition held. """
+        lag = max(lag, 0.0)
+        lag_seconds.observe(lag)
+        self.lags.append(lag)
+        lag_p99.set(self.lag_p99())
+
+    def lag_p99(self):
+        """ The p99 of the latest lags, in seconds. """
+        if not self.lags:
+            return 0.0
+        lags = sorted(self.lags)
+        return lags[int(0.99 * (len(lags) - 1))]
+
+    def reschedule(self, scheduled, started, more, error):
+        """ Schedule a job after an extension. Call with the condition
+            held.
+
+            Returns:
+                True if the job is finished or given up on, done being
+                due with its error.
+        """
+        if scheduled.removed:
+            return False
+        if error is None:
+            scheduled.failures = 0
+            scheduled.error = None
+            if not more:
+                self.finish(scheduled)
+                return True
+            scheduled.last_success = started
+            scheduled.due = started + self.frequency
+        else:
+            scheduled.failures += 1
+            scheduled.error = error
+            if scheduled.failures > self.max_retries:
+                self.finish(scheduled)
+                return True
+            scheduled.due = self.clock.time() + self.retry_delay
+        self.push(scheduled)
+        return False
+
+    def finish(self, scheduled):
+        """ Drop a finished or failed job. Call with the condition
+            held, and done after releasing it.
+        """
+        del self.jobs[scheduled.url]
+        scheduled.removed = True
+
+    def run(self, until_idle=False):
+        """ Dispatch the jobs when due, until stopped.
+
+            Args:
+                until_idle (bool): Return when there are no jobs left.
+        """
+        with self.condition:
+            while not self.stopped:
+                wait = self.run_pending()
+                if until_idle and not self.jobs:
+                    break
+                self.clock.wait(self.condition, wait)
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def stop(self):
+        """ Make run return. Running extensions are finished. """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CEZARY KRZYŻANOWSKI OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+"""
+.. module: settings
+    :platform: Unix, Windows
+    :synopsis: The configuration of the web app and the daemon.
+
+.. moduleauthor: Cezary Krzyżanowski <cezary.krzyzanowski@gmail.com>
+
+Kept apart from the web app, so the daemon reads the same settings
+without importing Flask.
+"""
+
+import os
+import tempfile
+
+class Config(object):
+    """ Default configuration.
+
+        Put all values here, and override in other classes.
+    """
+    #: Run framework in debug mode?
+    DEBUG = False
+    #: Are we testing?
+    TESTING = False
+    #: URI for the database.
+    DATABASE_URI = ('sqlite:///' + os.path.join(os.path.dirname(
+        os.path.abspath( __file__)), 'autoshots.db'))
+    #: URL root
+    URL_ROOT = None
+    #: How many of the newest events are kept for reconnecting
+    #: clients of the event stream.
+    EVENT_BACKLOG = 1000
+    #: How often (seconds) a web process checks the database for
+    #: events recorded by other processes.
+    EVENT_POLL_INTERVAL = 5
+    #: For how long (seconds) a single event stream connection is
+    #: held open. Clients reconnect with their cursor afterwards.
+    EVENT_STREAM_TIMEOUT = 60
+    #: Maximum number of jobs returned by one /changes call.
+    CHANGES_LIMIT = 500
+    #: SQLite journal mode. With WAL readers don't block the writer.
+    SQLITE_JOURNAL_MODE = 'WAL'
+    #: SQLite synchronous level. NORMAL is durable enough with WAL.
+    SQLITE_SYNCHRONOUS = 'NORMAL'
+    #: How long (seconds) SQLite waits for a lock before giving up.
+    SQLITE_BUSY_TIMEOUT = 30
+    #: Connections kept open per process for a server database.
+    DATABASE_POOL_SIZE = 5
+    #: Connections opened over the pool size under load.
+    DATABASE_MAX_OVERFLOW = 10
+    #: Age (seconds) after which pooled connections are reopened.
+    DATABASE_POOL_RECYCLE = 3600
+    #: Age (seconds) after which finished jobs are archived.
+    ARCHIVE_AFTER = 7 * 24 * 3600
+    #: How often (seconds) a web process archives the old jobs.
+    ARCHIVE_INTERVAL = 3600
+    #: How often (seconds) the housekeeping thread of a web process
+    #: checks for periodic tasks due, like the archiving and the
+    #: compaction of the attempts. None turns them off.
+    HOUSEKEEPING_INTERVAL = 60
+    #: Number of jobs moved to the archive in one transaction.
+    ARCHIVE_BATCH = 500
+    #: Number of the newest attempts kept for each job.
+    ATTEMPT_KEEP = 100
+    #: For how many days the daily attempt sums are kept.
+    ATTEMPT_DAYS_KEEP = 365
+    #: How often (seconds) the housekeeping thread of a web process
+    #: compacts the attempts.
+    ATTEMPT_COMPACT_INTERVAL = 3600
+    #: Spool directory where the processes of the node put their
+    #: metrics, summed up by /metrics. None keeps them per process.
+    METRICS_DIR = os.path.join(tempfile.gettempdir(), 'autoshots-metrics')
+    #: How often (seconds) a web process flushes its metrics.
+    METRICS_FLUSH_INTERVAL = 10
+    #: Directory for the trace files of the processes. None turns
+    #: the tracing off.
+    TRACE_DIR = None
+    #: Directory for the profiles. None turns the SIGUSR2 profiling
+    #: of the jobs off.
+    PROFILE_DIR = os.path.join(tempfile.gettempdir(), 'autoshots-profiles')
+    #: Frames kept by tracemalloc for each allocation. 0 turns the
+    #: memory tracing off.
+    MEMORY_TRACE_FRAMES = 0
+    #: Directory for the memory reports of the jobs.
+    MEMORY_DIR = os.path.join(tempfile.gettempdir(), 'autoshots-memory')
+    #: Part of the slack between HAMMER_FREQUENCY and SESSION_TIMEOUT
+    #: the p99 extension lag may take before /health reports degraded.
+    HEALTH_LAG_FRACTION = 0.5
+    #: Due jobs waiting for a thread before /health reports degraded.
+    HEALTH_MAX_QUEUE_DEPTH = 100
+    #: Client addresses allowed to use the /admin pages.
+    ADMIN_ADDRESSES = ('127.0.0.1', '::1')
+    #: Directory where every job records its browsershots traffic
+    #: to a cassette. None turns the recording off.
+    CASSETTE_DIR = None
+    #: (username, password) pairs of the browsershots accounts the
+    #: jobs are spread over. Empty for the one in job.auth_data.
+    BROWSERSHOTS_ACCOUNTS = ()
+    #: Requests per second allowed to each account. None for no limit.
+    ACCOUNT_RATE = None
+    #: Requests an account may make at once after being idle.
+    ACCOUNT_BURST = 4
+    #: How the added jobs are run, a key of job_backends. With
+    #: 'daemon' the autoshots daemon extends them, with 'leader' one
+    #: elected web process of the host does, with 'mule' the uwsgi
+    #: mules do.
+    JOB_BACKEND = 'process'
+    #: Root URL of the web app the daemon, or the leader process,
+    #: reports the jobs to.
+    DAEMON_WEB_URL = 'http://127.0.0.1:5000/'
+    #: Worker threads of the daemon extending the jobs.
+    DAEMON_WORKERS = 16
+    #: How often (seconds) the daemon renews its leases and claims
+    #: new jobs. Keep it well below DAEMON_LEASE_PERIOD.
+    DAEMON_POLL_INTERVAL = 5
+    #: For how long (seconds) a daemon holds a job after a heartbeat.
+    #: The jobs of a crashed daemon move on within this time.
+    DAEMON_LEASE_PERIOD = 60
+    #: Jobs a daemon process leases at most, leaving the rest to the
+    #: others. None for no limit.
+    DAEMON_MAX_JOBS = 2000
+    #: Bytes of memory after which a daemon process drains and exits,
+    #: to be started again. None for no limit.
+    DAEMON_MAX_RSS = None
+    #: Engine processes of the daemon, each extending a partition of
+    #: the jobs. 0 for one per CPU.
+    DAEMON_PROCESSES = 1
+    #: Directory where the engine processes of a host share the
+    #: sessions and rate limits of the browsershots accounts.
+    SESSION_DIR = os.path.join(tempfile.gettempdir(), 'autoshots-sessions')
+    #: Lock file the web processes of a host campaign for, the
+    #: holder running the scheduler with the 'leader' JOB_BACKEND.
+    LEADER_LOCK_FILE = os.path.join(tempfile.gettempdir(),
+        'autoshots-leader.lock')
+    #: How often (seconds) the other processes try to take over.
+    LEADER_RETRY_INTERVAL = 2
+
+class ProductionConfig(Config):
+    """ How we're working on production. """
+    #: This elaborate setting makes the sqlite database file
+    #: reside in the same dir as this file. Needs to be an absolute path.
+    URL_ROOT = '/autoshots'
+    #: The mules of uwsgi.xml extend the jobs.
+    JOB_BACKEND = 'mule'
+    #: The mules report to the loopback HTTP socket of uwsgi.xml,
+    #: unless AUTOSHOTS_WEB_URL names another front-end.
+    DAEMON_WEB_URL = os.getenv('AUTOSHOTS_WEB_URL', 'http://127.0.0.1:13769/')
+    #: Mules over this size are recycled by uwsgi.
+    DAEMON_MAX_RSS = 200 * 2 ** 20
+
+class DevelopmentConfig(Config):
+    """ Developement settings. """
+    DEBUG = True
+
+class TestingConfig(Config):
+    """ Test environemtn settings. """
+    TESTING = True
+    METRICS_DIR = None
+    #: The tests run the periodic tasks themselves.
+    HOUSEKEEPING_INTERVAL = None
+
+#: This maps the correct config class in regard to the environmental mode.
+mode_mapping = {
+    'DEV': DevelopmentConfig,
+    'PROD': ProductionConfig,
+    'TEST': TestingConfig,
+}
+
+def from_environment():
+    """ The config with values depending on the environmental variable
+        AUTOSHOTS_MODE.
+    """
+    return mode_mapping[os.getenv('AUTOSHOTS_MODE', 'DEV')]()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CEZARY KRZYŻANOWSKI OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+"""
+.. module: storage
+    :platform: Unix, Windows
+    :synopsis: Database engine setup for the web app and the jobs.
+
+.. moduleauthor: Cezary Krzyżanowski <cezary.krzyzanowski@gmail.com>
+"""
+
+import os
+
+import sqlalchemy
+from sqlalchemy import exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool
+
+class SQLitePragmas(object):
+    """ Pool events tuning every new SQLite connection.
+
+        The journal mode is stored in the database file, the
+        synchronous level is per connection.
+    """
+
+    def __init__(self, journal_mode, synchronous):
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+
+    def connect(self, dbapi_con, con_record):
+        cursor = dbapi_con.cursor()
+        if self.journal_mode:
+            cursor.execute('PRAGMA journal_mode=%s' % self.journal_mode)
+        if self.synchronous:
+            cursor.execute('PRAGMA synchronous=%s' % self.synchronous)
+        cursor.close()
+
+class ForkGuard(object):
+    """ Pool events keeping connections in the process that made them.
+
+        A forked child inherits the pool of its parent. Using, or even
+        closing, such a connection in the child breaks it for the
+        parent as well. The guard drops inherited connections on
+        checkout without touching them, so the child opens its own.
+    """
+
+    def connect(self, dbapi_con, con_record):
+        con_record.info['pid'] = os.getpid()
+
+    def checkout(self, dbapi_con, con_record, con_proxy):
+        if con_record.info['pid'] != os.getpid():
+            con_record.connection = con_proxy.connection = None
+            raise exc.DisconnectionError('Connection record belongs to'
+                + ' pid %s, attempting to check out in pid %s'
+                % (con_record.info['pid'], os.getpid()))
+
+def engine_options(info, options, config):
+    """ Fill in the create_engine options for the given database.
+
+        SQLite gets the pragmas from the config and waits for locks
+        SQLITE_BUSY_TIMEOUT seconds. As a single file has only one
+        writer anyway, it is not pooled. Server databases get a pool
+        sized by the DATABASE_POOL_* values.
+
+        Args:
+            info (URL): The SQLAlchemy URL of the database.
+            options (dict): The create_engine keyword arguments,
+                updated in place.
+            config (Config): The autoshots configuration.
+    """
+    guard = ForkGuard()
+    events = [(guard.connect, 'connect'), (guard.checkout, 'checkout')]
+    if info.drivername == 'sqlite':
+        options.setdefault('connect_args', {})['timeout'] = \
+            config.SQLITE_BUSY_TIMEOUT
+        if info.database not in (None, '', ':memory:'):
+            options.pop('pool_size', None)
+            options['poolclass'] = NullPool
+        pragmas = SQLitePragmas(config.SQLITE_JOURNAL_MODE,
+            config.SQLITE_SYNCHRONOUS)
+        events.append((pragmas.connect, 'connect'))
+    else:
+        options['pool_size'] = config.DATABASE_POOL_SIZE
+        options['max_overflow'] = config.DATABASE_MAX_OVERFLOW
+        options['pool_recycle'] = config.DATABASE_POOL_RECYCLE
+    options['pool_events'] = events
+    return options
+
+def create_engine(uri, config):
+    """ Create an engine, configured like the one of the web app, for
+        code running outside of it.
+
+        Args:
+            uri (string): The database URI.
+            config (Config): The autoshots configuration.
+    """
+    info = make_url(uri)
+    options = engine_options(info, {'convert_unicode': True}, config)
+    return sqlalchemy.create_engine(info, **options)
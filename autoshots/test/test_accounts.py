@@ -0,0 +1,214 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import urllib2
+dirname = os.path.dirname(__file__)
+onedirup = os.path.normpath(os.path.join(dirname, os.pardir))
+sys.path.insert(0, onedirup)
+sys.path.insert(0, os.path.join(onedirup, os.pardir, 'bench'))
+
+import accounts
+import fakebs
+import job
+import metrics
+
+def _account(name):
+    return accounts.Account([('username', name), ('password', 'secret')])
+
+class TestAccounts:
+    """ Account pool tests. """
+
+    urls = ['http://site%d.example.com/' % i for i in range(3000)]
+
+    def test_balance(self):
+        """ Check that the jobs are spread evenly over the accounts. """
+        pool = accounts.Pool([_account(name) for name in 'abc'])
+        counts = dict.fromkeys('abc', 0)
+        for url in self.urls:
+            counts[pool.account_for(url).username] += 1
+        assert min(counts.values()) > len(self.urls) / 3 * 0.8
+
+    def test_minimal_moves(self):
+        """ Check that adding an account only moves jobs to it. """
+        pool = accounts.Pool([_account(name) for name in 'abc'])
+        before = dict((url, pool.account_for(url).username)
+            for url in self.urls)
+        pool.add(_account('d'))
+        moved = [url for url in self.urls
+            if pool.account_for(url).username != before[url]]
+        assert all(pool.account_for(url).username == 'd' for url in moved)
+        assert len(self.urls) / 4 * 0.7 < len(moved) < len(self.urls) / 4 * 1.3
+        pool.remove('d')
+        assert all(pool.account_for(url).username == before[url]
+            for url in self.urls)
+
+    def test_token_bucket(self):
+        """ Check that a burst is allowed and then the rate kept. """
+        bucket = accounts.TokenBucket(rate=10, burst=2)
+        assert bucket.take() == 0
+        assert bucket.take() == 0
+        assert 0.05 < bucket.take() <= 0.1
+
+    def test_limits(self):
+        """ Check that the rate limit and the login lock of an account
+            give up when they would wait too long.
+        """
+        account = accounts.Account([('username', 'a')], rate=10)
+        assert account.throttle(0)
+        assert not account.throttle(0.05)
+        # The token was left for a later request.
+        assert 0 < account.bucket.take() <= 0.1
+        assert account.lock.acquire(0)
+        held = []
+        waiter = threading.Thread(target=lambda:
+            held.append(account.lock.acquire(0.05)))
+        waiter.start()
+        waiter.join()
+        account.lock.release()
+        assert held == [False]
+        assert account.lock.acquire(0)
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'lock')
+            first, second = accounts.FileLock(path), accounts.FileLock(path)
+            assert first.acquire(0)
+            assert not second.acquire(0.05)
+            first.release()
+            assert second.acquire(0)
+            second.release()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_shared_token_bucket(self):
+        """ Check that buckets sharing a file share the tokens. """
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'bucket')
+            first = accounts.SharedTokenBucket(10, 2, path)
+            second = accounts.SharedTokenBucket(10, 2, path)
+            assert first.take() == 0
+            assert second.take() == 0
+            assert 0.05 < first.take() <= 0.1
+        finally:
+            shutil.rmtree(directory)
+
+class TestSharedSessions:
+    """ Session sharing tests against the fake browsershots. """
+
+    def setup_method(self, method):
+        self.site = fakebs.FakeBrowsershots()
+        self.server = fakebs.serve(self.site)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.base = 'http://127.0.0.1:%d/' % self.server.server_port
+        self.pool = job.pool
+        job.use_browsershots(self.base)
+        job.use_accounts([(fakebs.USERNAME, fakebs.PASSWORD)])
+        self.directory = tempfile.mkdtemp()
+
+    def teardown_method(self, method):
+        self.server.shutdown()
+        shutil.rmtree(self.directory)
+        job.pool = self.pool
+        job.use_browsershots('http://browsershots.org/')
+        # Keep the logins out of the metrics of the other tests.
+        metrics.registry.reset()
+
+    def test_one_login(self):
+        """ Check that the jobs of an account share one login, and that
+            an extension failing with the session kept logs in again.
+        """
+        for i in range(3):
+            job.extend_procedure(self.base + 'http://site%d.com/' % i)
+        assert self.site.requests['signin'] == 1
+        assert self.site.requests['extend'] == 3
+        # The session expires at browsershots.
+        self.site.sessions.clear()
+        attempt = job.AttemptStats()
+        job.extend_procedure(self.base + 'http://site0.com/', attempt)
+        assert self.site.requests['signin'] == 2
+        assert self.site.requests['extend'] == 4
+        assert attempt.error is None
+        job.extend_procedure(self.base + 'http://site1.com/')
+        assert self.site.requests['signin'] == 2
+
+    def test_job_failures(self):
+        """ Check that a finished job, or a failing request, keeps the
+            session for the other jobs.
+        """
+        for i in range(3):
+            job.extend_procedure(self.base + 'http://site%d.com/' % i)
+        self.site.extensions = 1
+        try:
+            job.extend_procedure(self.base + 'http://site0.com/')
+        except job.UnexpectedContentError:
+            pass
+        else:
+            assert False, 'The finished job should have no extend link'
+        self.site.extensions = None
+        self.site.error_rate = 1
+        try:
+            job.extend_procedure(self.base + 'http://site1.com/')
+        except urllib2.HTTPError:
+            pass
+        else:
+            assert False, 'The erroring request should fail'
+        self.site.error_rate = 0
+        for i in range(3):
+            job.extend_procedure(self.base + 'http://site%d.com/' % i)
+        assert self.site.requests['signin'] == 1
+
+    def test_processes(self):
+        """ Check that the engine processes sharing a directory share
+            the login of an account, and that a failed one is dropped
+            for all of them.
+        """
+        job.pool.share(self.directory)
+        job.extend_procedure(self.base + 'http://site0.com/')
+        # A pool of another process.
+        job.use_accounts([(fakebs.USERNAME, fakebs.PASSWORD)])
+        job.pool.share(self.directory)
+        job.extend_procedure(self.base + 'http://site1.com/')
+        assert self.site.requests['signin'] == 1
+        account = job.pool.account_for(self.base)
+        account.sign_out()
+        job.use_accounts([(fakebs.USERNAME, fakebs.PASSWORD)])
+        job.pool.share(self.directory)
+        job.extend_procedure(self.base + 'http://site2.com/')
+        assert self.site.requests['signin'] == 2
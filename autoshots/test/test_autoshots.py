@@ -33,9 +33,11 @@
 
 import datetime
 import itertools
+import json
 import multiprocessing
 import os
 import re
+import shutil
 import sys
 import tempfile
 dirname = os.path.dirname(__file__)
@@ -66,12 +68,23 @@ class TestAutoshots:
         autoshots.app.config['TESTING'] = True
         self.app = autoshots.app.test_client()
         autoshots.db.create_all()
+        autoshots.event_feed.latest = 0
+        autoshots.config.EVENT_STREAM_TIMEOUT = 0
+        # Forked jobs would write to the directories of the tests.
+        autoshots.config.JOB_BACKEND = 'none'
 
     def teardown_method(self, method):
         """ Close the db file. """
+        autoshots.db.session.remove()
+        autoshots.config.JOB_BACKEND = 'process'
         os.close(self.db_fd)
         sqliteurl = autoshots.app.config['SQLALCHEMY_DATABASE_URI']
-        os.unlink(sqliteurl.replace('sqlite:///', ''))
+        dbpath = sqliteurl.replace('sqlite:///', '')
+        os.unlink(dbpath)
+        # Leftovers of the WAL journal.
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(dbpath + suffix):
+                os.unlink(dbpath + suffix)
 
     def _get_now_hour(self):
         return datetime.datetime.utcnow().strftime('%H:%M')
@@ -169,6 +182,7 @@ class TestAutoshots:
         """ Check that the browsershots job process starts
             after adding it via the website.
         """
+        autoshots.config.JOB_BACKEND = 'process'
         # Add some job first.
         rv = self.app.post('/add', data=dict(
             url=self.test_url,
@@ -182,3 +196,265 @@ class TestAutoshots:
         # Termiante all the jobs just in case
         for job in jobs:
             job.terminate()
+
+    def test_no_job_backend(self):
+        """ Check that the none backend only records the job. """
+        self.app.post('/add', data=dict(url=self.test_url))
+        assert autoshots.Job.query.filter_by(url=self.test_url).first()
+        assert not [p for p in multiprocessing.active_children()
+            if p.name == autoshots.PROCESS_NAME + self.test_url]
+
+    def test_events(self):
+        """ Check that job state changes are streamed and that the
+            cursor skips the events already seen.
+        """
+        self.app.post('/add', data=dict(url=self.test_url))
+        self.app.post('/status', data=dict(
+            url=autoshots.BROWSERSHOTS_URL + self.test_url,
+            state=autoshots.STATE_EXTENDED))
+        self.app.post('/done', data=dict(url=self.test_url))
+
+        rv = self.app.get('/events?cursor=0')
+        assert rv.mimetype == 'text/event-stream'
+        assert re.findall(r'^event: (\w+)$', rv.data, re.MULTILINE) == [
+            autoshots.STATE_ADDED, autoshots.STATE_EXTENDED,
+            autoshots.STATE_DONE]
+        assert 'data: ' + self.test_url in rv.data
+
+        rv = self.app.get('/events', headers={'Last-Event-ID': '2'})
+        assert re.findall(r'^id: (\d+)$', rv.data, re.MULTILINE) == ['3']
+
+    def test_event_commit_order(self):
+        """ Check that the stream follows the commit order of the
+            events, not their ids.
+        """
+        self.app.post('/add', data=dict(url=self.test_url))
+        for event_id, url in ((100, 'committed first'),
+                (50, 'committed second')):
+            event = autoshots.Event(url, autoshots.STATE_EXTENDED)
+            event.id = event_id
+            event.sequence = autoshots.next_value('event')
+            autoshots.db.session.add(event)
+            autoshots.db.session.commit()
+        rv = self.app.get('/events', headers={'Last-Event-ID': '2'})
+        assert re.findall(r'^data: (.+)$', rv.data, re.MULTILINE) == [
+            'committed second']
+
+    def test_status_unknown_state(self):
+        """ Check that only the job progress states are accepted. """
+        self.app.post('/add', data=dict(url=self.test_url))
+        rv = self.app.post('/status', data=dict(
+            url=self.test_url, state=autoshots.STATE_DONE))
+        assert rv.status_code == 400
+
+    def test_changes(self):
+        """ Check that only the jobs changed since the given version
+            are returned.
+        """
+        self.app.post('/add', data=dict(url='First URL'))
+        self.app.post('/add', data=dict(url=self.test_url))
+        rv = self.app.get('/changes?since=0')
+        result = json.loads(rv.data)
+        assert [j['url'] for j in result['jobs']] == [
+            'First URL', self.test_url]
+        assert not result['more']
+
+        self.app.post('/done', data=dict(url='First URL'))
+        rv = self.app.get('/changes?since=%d' % result['version'])
+        result = json.loads(rv.data)
+        assert [(j['url'], j['state'], j['running'])
+            for j in result['jobs']] == [
+            ('First URL', autoshots.STATE_DONE, False)]
+
+        rv = self.app.get('/changes?since=%d' % result['version'])
+        assert json.loads(rv.data)['jobs'] == []
+
+    def test_archive(self):
+        """ Checks that old finished jobs are moved to the archive,
+            listed only on demand, and brought back when re-run.
+        """
+        self.test_done()
+        old = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+        assert autoshots.archive_jobs(old) == 1
+        assert autoshots.Job.query.count() == 0
+
+        rv = self.app.get('/')
+        assert self.test_url not in rv.data
+        assert 'history=all' in rv.data
+        rv = self.app.get('/?history=all')
+        assert re.search(self.history_header + '(.+?)'
+            + self.test_url, rv.data, re.DOTALL)
+
+        rv = self.app.post('/add', data=dict(
+            url=self.test_url,
+            ), follow_redirects=True)
+        assert 'Url %s re-run.' % self.test_url in rv.data
+        assert autoshots.ArchivedJob.query.count() == 0
+        assert autoshots.Job.query.filter_by(url=self.test_url,
+            running=True).count() == 1
+
+    def test_archive_unfinished(self):
+        """ Checks that the jobs stopped before the finished time was
+            kept are archived by the time they were added, and that a
+            failing archiving doesn't stop the other periodic tasks.
+        """
+        self.test_done()
+        job = autoshots.Job.query.one()
+        job.finished = None
+        autoshots.db.session.commit()
+        old = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+        assert autoshots.archive_jobs(old) == 1
+
+        ran = []
+        def failing():
+            raise RuntimeError('Failed')
+        tasks = list(autoshots.PERIODIC_TASKS)
+        autoshots.PERIODIC_TASKS[:] = [(failing, 'ARCHIVE_INTERVAL'),
+            (lambda: ran.append(True), 'ARCHIVE_INTERVAL')]
+        try:
+            autoshots.run_periodic_tasks()
+        finally:
+            autoshots.PERIODIC_TASKS[:] = tasks
+        assert ran == [True]
+
+    def _attempt(self, outcome, started):
+        """ A job.AttemptStats dictionary. """
+        return {'started': started, 'outcome': outcome,
+            'phases': {'get_CSRF': 0.5, 'login': 1.0},
+            'bytes': 100, 'error': None, 'failed_phase': None}
+
+    def test_attempts(self):
+        """ Checks that the reported attempts are stored and that the
+            older ones are compacted into daily sums.
+        """
+        self.app.post('/add', data=dict(url=self.test_url))
+        attempts = [self._attempt(autoshots.STATE_EXTENDED, 1000000000),
+            self._attempt(autoshots.STATE_FAILED, 1000000060),
+            self._attempt(autoshots.STATE_EXTENDED, 1000000120)]
+        self.app.post('/status', data=dict(url=self.test_url,
+            state=autoshots.STATE_EXTENDED,
+            attempts=json.dumps(attempts)))
+        assert autoshots.Attempt.query.count() == 3
+        attempt = autoshots.Attempt.query.first()
+        assert attempt.login_time == 1.0
+        assert attempt.extend_time is None
+
+        keep = autoshots.config.ATTEMPT_KEEP
+        days_keep = autoshots.config.ATTEMPT_DAYS_KEEP
+        autoshots.config.ATTEMPT_KEEP = 1
+        autoshots.config.ATTEMPT_DAYS_KEEP = 100000
+        try:
+            assert autoshots.compact_attempts() == 2
+        finally:
+            autoshots.config.ATTEMPT_KEEP = keep
+            autoshots.config.ATTEMPT_DAYS_KEEP = days_keep
+        assert autoshots.Attempt.query.count() == 1
+        day = autoshots.AttemptDay.query.one()
+        assert (day.attempts, day.failures, day.bytes) == (2, 1, 200)
+        assert day.csrf_time == 1.0
+
+    def test_metrics(self):
+        """ Checks that /metrics sums up the spooled metrics of the
+            other processes and keeps those of the finished ones.
+        """
+        spool = tempfile.mkdtemp()
+        autoshots.metrics.registry.directory = spool
+        try:
+            self.app.post('/add', data=dict(url=self.test_url))
+            # A live and a finished job process.
+            for pid in (os.getppid(), 999999999):
+                autoshots.metrics.write_json(
+                    os.path.join(spool, '%d.json' % pid),
+                    {'autoshots_logins_total': [[[], 2]]})
+
+            rv = self.app.get('/metrics')
+            assert 'autoshots_logins_total 4\n' in rv.data
+            assert 'autoshots_active_jobs 1\n' in rv.data
+            assert 'autoshots_jobs{state="added"} 1\n' in rv.data
+            assert ('autoshots_http_requests_total{handler="add"}'
+                in rv.data)
+            files = os.listdir(spool)
+            assert '999999999.json' not in files
+            assert autoshots.metrics.RETIRED in files
+
+            rv = self.app.get('/metrics')
+            assert 'autoshots_logins_total 4\n' in rv.data
+        finally:
+            autoshots.metrics.registry.directory = None
+            shutil.rmtree(spool)
+
+    def test_tracing(self):
+        """ Checks that the handler spans are exported and that the
+            trace id of a job links its /add and /done.
+        """
+        trace_dir = tempfile.mkdtemp()
+        autoshots.tracing.configure(trace_dir)
+        try:
+            self.app.post('/add', data=dict(url=self.test_url))
+            trace_id = autoshots.tracing.context.trace_id
+            self.app.post('/done', data=dict(url=self.test_url,
+                trace_id=trace_id))
+            path = os.path.join(trace_dir, 'out.json')
+            autoshots.tracing.export(trace_dir, path)
+            with open(path) as f:
+                events = json.load(f)['traceEvents']
+        finally:
+            autoshots.tracing.configure(None)
+            shutil.rmtree(trace_dir)
+        spans = [(e['name'], e['args'].get('trace_id')) for e in events
+            if e['ph'] == 'X' and e['pid'] == os.getpid()]
+        assert spans == [('add', trace_id), ('done', trace_id)]
+
+    def test_profile(self):
+        """ Checks that the admin profile page starts a profiling run
+            writing collapsed stacks, for local clients only.
+        """
+        rv = self.app.post('/admin/profile', data=dict(seconds=1),
+            environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        assert rv.status_code == 403
+
+        profile_dir = tempfile.mkdtemp()
+        autoshots.profiler.directory = profile_dir
+        try:
+            rv = self.app.post('/admin/profile', data=dict(seconds=0.1),
+                environ_base={'REMOTE_ADDR': '127.0.0.1'})
+            path = json.loads(rv.data)['path']
+            autoshots.profiler.running.join()
+            with open(path) as f:
+                lines = f.readlines()
+        finally:
+            autoshots.profiler.directory = autoshots.config.PROFILE_DIR
+            shutil.rmtree(profile_dir)
+        assert lines
+        assert all(re.match(r'^\S.* \d+$', line) for line in lines)
+
+    def test_memory_unavailable(self):
+        """ Checks that the memory report refuses to work without
+            memory tracing.
+        """
+        frames = autoshots.memory.frames
+        autoshots.memory.frames = 0
+        try:
+            rv = self.app.post('/admin/memory',
+                environ_base={'REMOTE_ADDR': '127.0.0.1'})
+        finally:
+            autoshots.memory.frames = frames
+        assert rv.status_code == 501
+
+    def test_health(self):
+        """ Checks that /health reports degraded once the extension
+            lag threatens the sessions.
+        """
+        rv = self.app.get('/health')
+        assert rv.status_code == 200
+        assert json.loads(rv.data)['status'] == 'ok'
+
+        lag_p99 = autoshots.metrics.registry.metrics[
+            'autoshots_scheduler_lag_p99_seconds']
+        lag_p99.set(autoshots.job.SESSION_TIMEOUT)
+        try:
+            rv = self.app.get('/health')
+        finally:
+            lag_p99.set(0.0)
+        assert rv.status_code == 503
+        assert json.loads(rv.data)['status'] == 'degraded'
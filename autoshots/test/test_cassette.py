@@ -0,0 +1,95 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import threading
+dirname = os.path.dirname(__file__)
+onedirup = os.path.normpath(os.path.join(dirname, os.pardir))
+sys.path.insert(0, onedirup)
+sys.path.insert(0, os.path.join(onedirup, os.pardir, 'bench'))
+
+import cassette
+import fakebs
+import job
+
+class TestCassette:
+    """ HTTP record and replay tests. """
+
+    def setup_method(self, method):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.cassette')
+        self.site = fakebs.FakeBrowsershots(extensions=1)
+        self.server = fakebs.serve(self.site)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.base = 'http://127.0.0.1:%d/' % self.server.server_port
+        job.use_browsershots(self.base)
+        job.install_opener()
+
+    def teardown_method(self, method):
+        self.server.shutdown()
+        cassette.transport = cassette.urlopen
+        job.use_browsershots('http://browsershots.org/')
+        shutil.rmtree(self.directory)
+
+    def test_record_replay(self):
+        """ Check that a replayed extension gets the recorded responses
+            without the site.
+        """
+        url = self.base + 'http://a.com/'
+        cassette.record(self.path)
+        request_id = job.extend_procedure(url)
+        cassette.transport.close()
+        entries = cassette.read(self.path)
+        assert [e['method'] for e in entries] == ['GET', 'POST', 'GET',
+            'POST']
+        with gzip.open(self.path, 'rb') as recorded:
+            assert fakebs.PASSWORD not in recorded.read()
+        assert 'password=REDACTED' in entries[1]['data']
+        assert cassette.job_url(entries) == url
+
+        self.server.shutdown()
+        cassette.replay(self.path, scale=0)
+        job.pool.sign_out()
+        assert job.extend_procedure(url) == request_id
+        try:
+            job.extend_procedure(url)
+        except cassette.CassetteError:
+            pass
+        else:
+            assert False, 'The cassette should have run out'
@@ -0,0 +1,333 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+
+import os
+import signal
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+dirname = os.path.dirname(__file__)
+onedirup = os.path.normpath(os.path.join(dirname, os.pardir))
+sys.path.insert(0, onedirup)
+
+import sqlalchemy
+
+import daemon
+import job
+import settings
+import storage
+import tracing
+
+class TestDaemon:
+    """ Standalone extension daemon tests. """
+
+    def setup_method(self, method):
+        """ Make a job table in a temporary database. """
+        self.db_fd, self.path = tempfile.mkstemp()
+        self.engine = storage.create_engine('sqlite:///' + self.path,
+            settings.TestingConfig())
+        daemon.metadata.create_all(self.engine)
+        self.daemon = daemon.Daemon(self.engine, 'http://127.0.0.1:1/',
+            workers=1, poll_interval=0, limit=2)
+
+    def teardown_method(self, method):
+        self.engine.dispose()
+        os.close(self.db_fd)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.unlink(self.path + suffix)
+
+    def _job(self, url, running=True, owner=None, expires=None):
+        self.engine.execute(daemon.job_table.insert(), url=url,
+            running=running, version=0, lease_owner=owner,
+            lease_expires=expires)
+
+    def _owners(self):
+        return dict(self.engine.execute(sqlalchemy.select(
+            [daemon.job_table.c.url, daemon.job_table.c.lease_owner])).fetchall())
+
+    def _daemon(self, owner, max_jobs=None):
+        return daemon.Daemon(self.engine, 'http://127.0.0.1:1/',
+            workers=1, poll_interval=0, limit=2, owner=owner,
+            max_jobs=max_jobs)
+
+    def test_claim(self):
+        """ Check that the free running jobs are claimed in batches, up
+            to the fair share of the daemon, and that the jobs spread
+            over the daemons started later.
+        """
+        for url in 'abcde':
+            self._job(url)
+        self._job('f', running=False)
+        self._job('g', owner='other',
+            expires=datetime.utcnow() + timedelta(minutes=1))
+        first = self._daemon('first')
+        assert first.poll()
+        assert first.poll()
+        assert not first.poll()
+        assert first.owned == set('abcde')
+        assert sorted(first.extender.jobs) == [
+            job.BROWSERSHOTS_URL + url for url in 'abcde']
+        second = self._daemon('second')
+        assert not second.poll()
+        assert second.owned == set()
+        # Sheds the jobs over its share for the second.
+        assert not first.poll()
+        assert first.owned == set('abc')
+        assert len(first.extender.jobs) == 3
+        while second.poll():
+            pass
+        assert second.owned == set('de')
+        owners = self._owners()
+        assert [owners[url] for url in 'abcdefg'] == ['first'] * 3 + [
+            'second'] * 2 + [None, 'other']
+
+    def test_max_jobs(self):
+        """ Check that a daemon claims max_jobs at most. """
+        for url in 'abcde':
+            self._job(url)
+        first = self._daemon('first', max_jobs=3)
+        while first.poll():
+            pass
+        assert first.owned == set('abc')
+
+    def test_heartbeat(self):
+        """ Check that a heartbeat renews the leases, drops the stopped
+            jobs and those taken over by another daemon.
+        """
+        self._job('a')
+        self._job('b')
+        self._job('c')
+        first = self._daemon('first')
+        first.poll()
+        first.poll()
+        expired = datetime.utcnow() - timedelta(seconds=1)
+        table = daemon.job_table
+        self.engine.execute(table.update().where(table.c.url == 'a'),
+            running=False)
+        self.engine.execute(table.update().where(table.c.url == 'b'),
+            lease_owner='second')
+        self.engine.execute(table.update().where(table.c.url == 'c'),
+            lease_expires=expired)
+        # Leased under the same name by an earlier run.
+        self._job('d', owner='first', expires=expired)
+        first.heartbeat()
+        assert first.owned == set('cd')
+        assert sorted(first.extender.jobs) == [
+            job.BROWSERSHOTS_URL + 'c', job.BROWSERSHOTS_URL + 'd']
+        assert self._owners() == {'a': None, 'b': 'second', 'c': 'first',
+            'd': 'first'}
+        assert self.engine.execute(sqlalchemy.select(
+            [table.c.lease_expires]).where(table.c.url == 'c')
+            ).scalar() > datetime.utcnow()
+
+    def test_failover(self):
+        """ Check that the jobs of a daemon that stopped renewing its
+            leases move to another one, and that a job given up on is
+            claimed again only after a lease period.
+        """
+        self._job('a')
+        self._job('b')
+        first = self._daemon('first')
+        first.poll()
+        second = self._daemon('second')
+        second.poll()
+        assert second.owned == set()
+        table = daemon.job_table
+        expired = datetime.utcnow() - timedelta(seconds=1)
+        self.engine.execute(table.update(), lease_expires=expired)
+        self.engine.execute(daemon.engine_table.update(), expires=expired)
+        second.poll()
+        assert second.owned == set('ab')
+        second.done(second.extender.jobs[job.BROWSERSHOTS_URL + 'a'],
+            ValueError('Gave up'))
+        assert second.owned == set('b')
+        first.poll()
+        assert first.owned == set()
+
+    def test_partitions(self):
+        """ Check that the processes of a host claim the jobs of their
+            own partitions only.
+        """
+        for url in 'abcde':
+            self._job(url)
+        even = daemon.Daemon(self.engine, 'http://127.0.0.1:1/',
+            workers=1, poll_interval=0, owner='even', partition=(0, 2))
+        odd = daemon.Daemon(self.engine, 'http://127.0.0.1:1/',
+            workers=1, poll_interval=0, owner='odd', partition=(1, 2))
+        even.poll()
+        odd.poll()
+        assert even.owned == set('bd')
+        assert odd.owned == set('ace')
+
+    def test_checkpoints(self):
+        """ Check that a daemon taking the jobs over, or started again,
+            resumes their schedules.
+        """
+        self._job('a')
+        self._job('b')
+        first = self._daemon('first')
+        first.poll()
+        now = time.time()
+        for url, due in (('a', now + 300), ('b', now + 30)):
+            scheduled = first.extender.jobs[job.BROWSERSHOTS_URL + url]
+            scheduled.last_success = due - 540
+            scheduled.due = due
+            first.checkpoint(scheduled)
+        first.poll()
+        assert first.checkpoints == {}
+        table = daemon.job_table
+        self.engine.execute(table.update().where(table.c.url == 'b'),
+            lease_expires=datetime.utcnow() - timedelta(seconds=1))
+        second = self._daemon('second')
+        second.poll()
+        taken = second.extender.jobs[job.BROWSERSHOTS_URL + 'b']
+        assert abs(taken.due - (now + 30)) < 0.01
+        assert abs(taken.last_success - (now - 510)) < 0.01
+        again = self._daemon('first')
+        again.heartbeat()
+        resumed = again.extender.jobs[job.BROWSERSHOTS_URL + 'a']
+        assert abs(resumed.due - (now + 300)) < 0.01
+
+    def test_trace(self):
+        """ Check that a job is extended and reported in the trace of
+            its /add.
+        """
+        self._job('a')
+        self.engine.execute(daemon.job_table.update(), trace_id='abc')
+        self.daemon.claim()
+        scheduled = self.daemon.extender.jobs[job.BROWSERSHOTS_URL + 'a']
+        traces = []
+        extend_job, post_state = job.extend_job, job.post_state
+        def extend(scheduled, report):
+            traces.append(tracing.context.trace_id)
+            report(scheduled, job.STATE_EXTENDED, job.AttemptStats())
+        job.extend_job = extend
+        job.post_state = lambda *args: traces.append(args[-1])
+        try:
+            self.daemon.extend(scheduled)
+            self.daemon.done(scheduled, None)
+        finally:
+            job.extend_job, job.post_state = extend_job, post_state
+        assert traces == ['abc'] * 3
+        assert getattr(tracing.context, 'trace_id', None) is None
+
+    def test_recycle(self):
+        """ Check that a daemon over its memory limit drains. """
+        self.daemon.recycle()
+        assert not self.daemon.stopping.is_set()
+        self.daemon.max_rss = 1
+        self.daemon.recycle()
+        assert self.daemon.stopping.is_set()
+
+    def test_unsent_reports(self):
+        """ Check that the attempts failing to be reported are kept for
+            the next report.
+        """
+        scheduled = self.daemon.extender.add('url')
+        attempt = job.AttemptStats()
+        self.daemon.report(scheduled, job.STATE_EXTENDED, attempt)
+        self.daemon.report(scheduled, job.STATE_EXTENDED, attempt)
+        assert len(self.daemon.pending['url']) == 2
+        for i in range(daemon.PENDING_LIMIT):
+            self.daemon.report(scheduled, job.STATE_EXTENDED, attempt)
+        assert len(self.daemon.pending['url']) == daemon.PENDING_LIMIT
+
+    def test_unsent_done(self):
+        """ Check that a finished job the web app was not told about
+            keeps its lease, and is released once the report goes
+            through.
+        """
+        self._job('a')
+        self.daemon.claim()
+        scheduled = self.daemon.extender.jobs[job.BROWSERSHOTS_URL + 'a']
+        self.daemon.extender.remove(scheduled.url)
+        self.daemon.done(scheduled, None)
+        assert self.daemon.finished == {'a': None}
+        self.daemon.poll()
+        assert self._owners() == {'a': self.daemon.owner}
+        assert not self.daemon.extender.jobs
+        table = daemon.job_table
+        def send(*args, **kwargs):
+            # The web app stops the job.
+            self.engine.execute(table.update(), running=False)
+            return True
+        self.daemon.send = send
+        self.daemon.poll()
+        assert self.daemon.finished == {}
+        assert self._owners() == {'a': None}
+
+    def test_drain(self):
+        """ Check that a stopped daemon returns from run and releases
+            its jobs.
+        """
+        self._job('a', owner=self.daemon.owner,
+            expires=datetime.utcnow() + timedelta(minutes=1))
+        self.daemon.owned.add('a')
+        self.daemon.stop()
+        self.daemon.run()
+        assert self.daemon.extender.stopped
+        assert self._owners() == {'a': None}
+
+    def test_stop_while_restarting(self):
+        """ Check that the partitions stop when the signal comes while
+            an ended engine process waits to be started again.
+        """
+        marker = self.path + '.failed'
+        def serve(options, config, partition):
+            if not os.path.exists(marker):
+                open(marker, 'w').close()
+                sys.exit(1)
+            signal.pause()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.setpgrp()
+                daemon.serve = serve
+                time.sleep = lambda seconds: os.kill(os.getpid(),
+                    signal.SIGTERM)
+                options = type('Options', (), {'owner': 'test'})
+                daemon.serve_partitions(options, None, 1)
+            finally:
+                os._exit(0)
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            if os.waitpid(pid, os.WNOHANG)[0]:
+                break
+            time.sleep(0.1)
+        else:
+            os.killpg(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            assert False, 'the partitions did not stop'
+        os.remove(marker)
@@ -0,0 +1,162 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+
+import os
+import sys
+dirname = os.path.dirname(__file__)
+onedirup = os.path.normpath(os.path.join(dirname, os.pardir))
+sys.path.insert(0, onedirup)
+sys.path.insert(0, os.path.join(onedirup, os.pardir, 'bench'))
+
+import threading
+
+import fakebs
+import job
+import pagecorpus
+import scheduler
+
+class TestJob:
+    """ Browsershots job tests. """
+
+    def setup_method(self, method):
+        self.site = fakebs.FakeBrowsershots(extensions=1)
+        self.server = fakebs.serve(self.site)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.base = 'http://127.0.0.1:%d/' % self.server.server_port
+        job.use_browsershots(self.base)
+        job.install_opener()
+
+    def teardown_method(self, method):
+        self.server.shutdown()
+        job.use_browsershots('http://browsershots.org/')
+
+    def test_extend_job(self):
+        """ Check the extend procedure against the fake browsershots. """
+        scheduled = scheduler.ScheduledJob(self.base + 'http://a.com/', 0)
+        states = []
+        report = lambda scheduled, state, attempt: states.append(state)
+        assert job.extend_job(scheduled, report)
+        assert self.site.requests['extend'] == 1
+        # The page has no extend link any more.
+        scheduled.last_success = 0
+        assert not job.extend_job(scheduled, report)
+        assert states == [job.STATE_EXTENDED, job.STATE_FINISHED]
+
+    def test_failed_extension(self):
+        """ Check that a job failing to extend, its page still offering
+            the extend link, is not taken for finished.
+        """
+        job.extend_procedure(self.base + 'http://b.com/')
+        scheduled = scheduler.ScheduledJob(self.base + 'http://a.com/', 0)
+        scheduled.last_success = 0
+        # Browsershots refuses to extend it.
+        self.site.request_ids['http://a.com/'] = 'unknown'
+        states = []
+        report = lambda scheduled, state, attempt: states.append(state)
+        try:
+            job.extend_job(scheduled, report)
+        except job.UnexpectedContentError:
+            pass
+        else:
+            assert False, 'The extension should fail'
+        assert states == [job.STATE_FAILED]
+
+    def test_deadlines(self):
+        """ Check that a stalled request is given up on when its phase
+            runs out of time, and counted as a timeout.
+        """
+        self.site.stall = 5
+        timeouts = dict(job.PHASE_TIMEOUTS)
+        job.PHASE_TIMEOUTS['get_CSRF'] = 0.2
+        before = job.phase_timeouts.values.get(('get_CSRF', ), 0)
+        attempt = job.AttemptStats()
+        try:
+            job.extend_procedure(self.base + 'http://a.com/', attempt)
+        except job.DeadlineExceeded:
+            pass
+        else:
+            assert False, 'The stalled request should time out'
+        finally:
+            job.PHASE_TIMEOUTS.update(timeouts)
+        assert attempt.failed_phase == 'get_CSRF'
+        assert attempt.phases['get_CSRF'] < 1
+        assert job.phase_timeouts.values[('get_CSRF', )] == before + 1
+
+    def test_trickled_response(self):
+        """ Check that a response trickling in is given up on when its
+            phase runs out of time.
+        """
+        self.site.trickle = 0.05
+        self.site.page_size = 1000
+        timeouts = dict(job.PHASE_TIMEOUTS)
+        job.PHASE_TIMEOUTS['get_CSRF'] = 0.3
+        attempt = job.AttemptStats()
+        try:
+            job.extend_procedure(self.base + 'http://a.com/', attempt)
+        except job.DeadlineExceeded:
+            pass
+        else:
+            assert False, 'The trickled response should time out'
+        finally:
+            job.PHASE_TIMEOUTS.update(timeouts)
+        assert attempt.failed_phase == 'get_CSRF'
+        assert attempt.phases['get_CSRF'] < 1
+
+    def test_parsers(self):
+        """ Check the parsers on the captured pages of the corpus. """
+        for page in pagecorpus.load():
+            if 'generate' in page:
+                continue
+            html = page['html']
+            if page['csrf']:
+                assert job.parse_csrf(html) == page['csrf']
+            if page['request_id']:
+                assert job.parse_request_id(html) == page['request_id']
+            if page['logged_in']:
+                job.parse_logged_in(html)
+            else:
+                try:
+                    job.parse_logged_in(html)
+                except job.UnexpectedContentError:
+                    pass
+                else:
+                    assert False, page['name']
+
+    def test_excerpt(self):
+        """ Check that long pages are cut in the error messages. """
+        assert job.excerpt('short') == 'short'
+        page = 'x' * (job.EXCERPT_LENGTH + 10)
+        assert job.excerpt(page) == ('x' * job.EXCERPT_LENGTH
+            + '\n[10 more bytes]')
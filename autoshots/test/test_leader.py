@@ -0,0 +1,140 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+
+import functools
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+dirname = os.path.dirname(__file__)
+onedirup = os.path.normpath(os.path.join(dirname, os.pardir))
+sys.path.insert(0, onedirup)
+
+import leader
+
+class TestElection:
+    """ Leader election tests. """
+
+    def setup_method(self, method):
+        self.fd, self.path = tempfile.mkstemp()
+
+    def teardown_method(self, method):
+        os.close(self.fd)
+        os.unlink(self.path)
+
+    def test_campaign_at_start(self):
+        """ Check that a web process campaigns without any request. """
+        held = leader.Election(self.path)
+        assert held.campaign()
+        script = '\n'.join([
+            'import os, threading, settings',
+            "settings.TestingConfig.JOB_BACKEND = 'leader'",
+            'settings.TestingConfig.LEADER_LOCK_FILE = %r' % self.path,
+            'import autoshots',
+            'print(autoshots.election.pid == os.getpid() and any(',
+            "    t.name == 'autoshots-leader' for t in threading.enumerate()))",
+        ])
+        env = dict(os.environ, AUTOSHOTS_MODE='TEST')
+        output = subprocess.check_output([sys.executable, '-c', script],
+            cwd=onedirup, env=env)
+        held.resign()
+        assert output.split()[-1] == b'True'
+
+    def test_one_leader(self):
+        """ Check that only one campaign leads at a time. """
+        first = leader.Election(self.path)
+        second = leader.Election(self.path)
+        assert first.campaign()
+        assert first.campaign()
+        assert not second.campaign()
+        first.resign()
+        assert second.campaign()
+        assert not first.campaign()
+        second.resign()
+
+    def test_leader_dying(self):
+        """ Check that the lock of a leader process is released when it
+            dies.
+        """
+        election = leader.Election(self.path)
+        elected, exit = os.pipe(), os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.write(elected[1], str(int(election.campaign())))
+                os.read(exit[0], 1)
+            finally:
+                os._exit(0)
+        assert os.read(elected[0], 1) == '1'
+        assert not election.campaign()
+        os.write(exit[1], 'x')
+        os.waitpid(pid, 0)
+        assert election.campaign()
+        election.resign()
+        for fd in elected + exit:
+            os.close(fd)
+
+    def test_takeover(self):
+        """ Check that a waiting process leads when the leader resigns. """
+        leading = []
+        resign = threading.Event()
+
+        def lead(name):
+            leading.append(name)
+            resign.wait(5)
+            resign.clear()
+
+        elections = dict((name, leader.Election(self.path, interval=0.01))
+            for name in ('first', 'second'))
+        threads = [threading.Thread(target=election.run,
+                args=(functools.partial(lead, name), ))
+            for name, election in elections.items()]
+        for thread in threads:
+            thread.start()
+        deadline = time.time() + 5
+        while not leading and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        assert len(leading) == 1
+        elections[leading[0]].stopping.set()
+        resign.set()
+        while len(leading) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        assert sorted(leading) == ['first', 'second']
+        for election in elections.values():
+            election.stopping.set()
+        resign.set()
+        for thread in threads:
+            thread.join(5)
@@ -0,0 +1,77 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+
+import os
+import sys
+dirname = os.path.dirname(__file__)
+onedirup = os.path.normpath(os.path.join(dirname, os.pardir))
+sys.path.insert(0, onedirup)
+
+import mule
+
+class FakeUwsgi(object):
+    """ The parts of the uwsgi module used by the web processes. """
+
+    def __init__(self, scripts):
+        self.opt = {'mule': scripts}
+        self.messages = []
+
+    def mule_msg(self, message, mule_id):
+        self.messages.append((message, mule_id))
+
+class TestMule:
+    """ uwsgi mule backend tests. """
+
+    def setup_method(self, method):
+        self.uwsgi = mule.uwsgi
+
+    def teardown_method(self, method):
+        mule.uwsgi = self.uwsgi
+
+    def test_outside_uwsgi(self):
+        """ Check that waking the mules does nothing without uwsgi. """
+        mule.uwsgi = None
+        mule.notify(1)
+
+    def test_notify(self):
+        """ Check that the mule of the partition of a job is woken. """
+        mule.uwsgi = FakeUwsgi(['mule.py', 'mule.py', 'mule.py'])
+        for job_id in (3, 4, 8):
+            mule.notify(job_id)
+        assert mule.uwsgi.messages == [('poll', 1), ('poll', 2), ('poll', 3)]
+
+    def test_one_mule(self):
+        """ Check that a single mule, given as a string, is woken. """
+        mule.uwsgi = FakeUwsgi('mule.py')
+        mule.notify(7)
+        assert mule.uwsgi.messages == [('poll', 1)]
@@ -0,0 +1,150 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+
+import os
+import sys
+import threading
+dirname = os.path.dirname(__file__)
+onedirup = os.path.normpath(os.path.join(dirname, os.pardir))
+sys.path.insert(0, onedirup)
+
+import scheduler
+
+class TestScheduler:
+    """ Extension scheduler tests. """
+
+    def setup_method(self, method):
+        """ Collect the extensions and the finished jobs. """
+        self.extended = []
+        self.finished = []
+
+    def _done(self, scheduled, error):
+        self.finished.append((scheduled.url, error))
+
+    def test_until_finished(self):
+        """ Check that a job is extended until it says it's finished,
+            each time with the lag recorded.
+        """
+        def extend(scheduled):
+            self.extended.append(scheduled.url)
+            return len(self.extended) < 3
+        extender = scheduler.Scheduler(extend, self._done, workers=2,
+            frequency=0.01)
+        extender.add('url')
+        extender.run(until_idle=True)
+        assert self.extended == ['url'] * 3
+        assert self.finished == [('url', None)]
+        assert len(extender.lags) == 3
+        assert 0 <= extender.lag_p99() < 1
+
+    def test_retries(self):
+        """ Check that failures are retried max_retries times before
+            giving up.
+        """
+        error = RuntimeError('Failed')
+        def extend(scheduled):
+            self.extended.append(scheduled.url)
+            raise error
+        extender = scheduler.Scheduler(extend, self._done,
+            retry_delay=0.01, max_retries=2)
+        extender.add('url')
+        extender.run(until_idle=True)
+        assert self.extended == ['url'] * 3
+        assert self.finished == [('url', error)]
+
+    def test_blocking_done(self):
+        """ Check that the jobs due are started while the done callback
+            of a finished one blocks.
+        """
+        due = threading.Event()
+        waited = []
+        def extend(scheduled):
+            self.extended.append(scheduled.url)
+            if scheduled.url == 'due':
+                due.set()
+            return scheduled.url == 'due'
+        def done(scheduled, error):
+            # Blocks until the other job is extended.
+            waited.append(due.wait(2))
+            self._done(scheduled, error)
+            extender.stop()
+        extender = scheduler.Scheduler(extend, done, workers=2,
+            frequency=60)
+        extender.add('finished')
+        extender.add('due', extender.clock.time() + 0.1)
+        extender.run()
+        assert waited == [True]
+        assert self.extended == ['finished', 'due']
+        assert self.finished == [('finished', None)]
+
+    def test_due_order(self):
+        """ Check that the jobs are extended in the order they're due. """
+        def extend(scheduled):
+            self.extended.append(scheduled.url)
+            return False
+        extender = scheduler.Scheduler(extend, self._done, workers=1)
+        now = extender.clock.time()
+        extender.add('second', now + 0.02)
+        extender.add('first', now + 0.01)
+        extender.add('removed', now)
+        extender.remove('removed')
+        extender.run(until_idle=True)
+        assert self.extended == ['first', 'second']
+
+    def test_virtual_clock(self):
+        """ Check that a scheduler can be driven step by step on a
+            virtual clock, like the simulator does, checkpointing the
+            jobs rescheduled.
+        """
+        dispatched = []
+        checkpoints = []
+        clock = scheduler.VirtualClock()
+        extender = scheduler.Scheduler(None, self._done, frequency=10,
+            clock=clock, checkpoint=checkpoints.append)
+        extender.dispatch = dispatched.append
+        scheduled = extender.add('url')
+        with extender.condition:
+            assert extender.run_pending() is None
+        assert dispatched == [scheduled]
+        clock.now = 2
+        started = extender.start(scheduled)
+        assert extender.lags[-1] == 2
+        extender.complete(scheduled, started, True, None)
+        assert scheduled.due == 12
+        assert checkpoints == [scheduled]
+        with extender.condition:
+            assert extender.run_pending() == 10
+        clock.wait(extender.condition, 10)
+        with extender.condition:
+            assert extender.run_pending() is None
+        assert dispatched == [scheduled] * 2
@@ -0,0 +1,91 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+
+import os
+import sys
+import tempfile
+dirname = os.path.dirname(__file__)
+onedirup = os.path.normpath(os.path.join(dirname, os.pardir))
+sys.path.insert(0, onedirup)
+
+import storage
+from settings import Config
+
+class TestStorage:
+    """ Engine configuration tests. """
+
+    def setup_method(self, method):
+        """ Make a temporary SQLite database. """
+        self.db_fd, self.path = tempfile.mkstemp()
+        self.engine = storage.create_engine('sqlite:///' + self.path,
+            Config())
+
+    def teardown_method(self, method):
+        """ Remove the database files. """
+        self.engine.dispose()
+        os.close(self.db_fd)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.unlink(self.path + suffix)
+
+    def test_sqlite_pragmas(self):
+        """ Check that SQLite connections get the configured pragmas. """
+        connection = self.engine.connect()
+        assert connection.execute('PRAGMA journal_mode').scalar() == 'wal'
+        # NORMAL is 1.
+        assert connection.execute('PRAGMA synchronous').scalar() == 1
+        connection.close()
+
+    def test_fork_guard(self):
+        """ Check that a connection made in another process is not
+            handed out.
+        """
+        guard = storage.ForkGuard()
+        record = FakeRecord()
+        guard.connect(None, record)
+        guard.checkout(None, record, record)
+
+        record.info['pid'] = -1
+        try:
+            guard.checkout(None, record, record)
+        except storage.exc.DisconnectionError:
+            assert record.connection is None
+        else:
+            assert False, 'An inherited connection was checked out.'
+
+class FakeRecord(object):
+    """ Stands for both the connection record and proxy. """
+
+    def __init__(self):
+        self.info = {}
+        self.connection = object()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CEZARY KRZYŻANOWSKI OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+"""
+.. module: tracing
+    :platform: Unix, Windows
+    :synopsis: Lightweight spans exported in the Chrome trace format.
+
+.. moduleauthor: Cezary Krzyżanowski <cezary.krzyzanowski@gmail.com>
+
+Tracing is off unless configure is given a directory. Each process
+then appends its spans to its own file there, and export merges the
+files into one trace, to be opened in chrome://tracing or Perfetto.
+
+All the spans made for one job, from its /add through every extension
+cycle to its /done, carry the same trace_id argument.
+
+Usage::
+
+    python tracing.py TRACE_DIR trace.json
+"""
+
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+#: Is tracing on?
+enabled = False
+#: Where the processes put their trace files.
+directory = None
+#: Thread local tracing state, i.e. the trace_id.
+context = threading.local()
+
+class NullSpan(object):
+    """ What span returns with tracing off. Does nothing. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+#: The only NullSpan needed.
+NULL_SPAN = NullSpan()
+
+class Span(object):
+    """ A timed section of code, written out when it ends. """
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.time()
+        args = dict(self.args)
+        trace_id = getattr(context, 'trace_id', None)
+        if trace_id:
+            args['trace_id'] = trace_id
+        if exc_info[0] is not None:
+            args['error'] = exc_info[0].__name__
+        writer.write({
+            'name': self.name,
+            'cat': 'autoshots',
+            'ph': 'X',
+            'ts': int(self.start * 1000000),
+            'dur': int((end - self.start) * 1000000),
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+            'args': args,
+        })
+        return False
+
+class TraceWriter(object):
+    """ Appends the events of this process to its trace file.
+
+        The file is a JSON array left open at the end, which the
+        trace viewers accept. A forked child opens a file of its own.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.file = None
+
+    def write(self, event):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.open()
+            self.file.write(json.dumps(event) + ',\n')
+            self.file.flush()
+
+    def open(self):
+        self.pid = os.getpid()
+        self.file = open(os.path.join(directory,
+            'trace-%d.json' % self.pid), 'a')
+        if not self.file.tell():
+            self.file.write('[\n')
+        self.file.write(json.dumps({
+            'name': 'process_name',
+            'ph': 'M',
+            'pid': self.pid,
+            'args': {'name': ' '.join(sys.argv) or 'python'},
+        }) + ',\n')
+
+#: The trace writer of this process.
+writer = TraceWriter()
+
+def configure(trace_dir):
+    """ Turn tracing on, writing to trace_dir, or off with None. """
+    global enabled, directory
+    directory = trace_dir
+    enabled = bool(trace_dir)
+    if enabled and not os.path.isdir(trace_dir):
+        os.makedirs(trace_dir)
+
+def span(name, **args):
+    """ A context manager tracing the code it wraps.
+
+        Args:
+            name (string): Name of the span.
+            args: Arguments shown with the span.
+    """
+    if not enabled:
+        return NULL_SPAN
+    return Span(name, args)
+
+def traced(name):
+    """ Decorator tracing each call of a function as a span.
+
+        The trace_id is reset for each call, so the function sets it
+        when it knows which job it works on.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return f(*args, **kwargs)
+            context.trace_id = None
+            with Span(name, {}):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def new_trace_id():
+    """ Start a new trace in this thread, returning its id. """
+    context.trace_id = uuid.uuid4().hex
+    return context.trace_id
+
+def export(trace_dir, path):
+    """ Merge the trace files of all the processes into one.
+
+        Args:
+            trace_dir (string): The directory with the trace files.
+            path (string): The Chrome trace JSON file to write.
+    """
+    events = []
+    for filename in sorted(os.listdir(trace_dir)):
+        if not (filename.startswith('trace-')
+                and filename.endswith('.json')):
+            continue
+        with open(os.path.join(trace_dir, filename)) as f:
+            for line in f:
+                line = line.strip().rstrip(',')
+                if line in ('', '['):
+                    continue
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # The process was killed mid line.
+                    continue
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return len(events)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit('Usage: %s TRACE_DIR trace.json' % sys.argv[0])
+    print('%d events exported.' % export(sys.argv[1], sys.argv[2]))
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CEZARY KRZYŻANOWSKI OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+"""
+Load benchmark of the extension engine.
+
+Runs the scheduler with the real extend procedure against the fake
+browsershots of fakebs.py, with many jobs at once and the clock
+running `--factor` times faster than the real one, so a 540 seconds
+hammer cycle takes seconds. Each job is extended `--cycles` times and
+is then reported finished by the fake site.
+
+Reports for each number of jobs the requests per second the engine
+made, its CPU time and peak memory, the p99 of the scheduler lag and
+the deadline misses: extensions started after the browsershots session
+of the job would have expired (SESSION_TIMEOUT after the last success,
+in the compressed time).
+
+Usage::
+
+    python bench/bench_engine.py [--jobs 1000,10000,50000]
+        [--workers 16] [--factor 60] [--cycles 2] [--latency 0.05]
+        [--page-size 20000] [--errors 0.0]
+
+Every run happens in a process of its own, the fake site in another.
+"""
+
+import multiprocessing
+import optparse
+import os
+import resource
+import sys
+import threading
+import time
+
+dirname = os.path.dirname(__file__)
+onedirup = os.path.normpath(os.path.join(dirname, os.pardir))
+sys.path.insert(0, onedirup)
+sys.path.insert(0, dirname)
+
+import fakebs
+from autoshots import accounts, job, scheduler
+
+def run_site(options, pipe):
+    """ Serve the fake browsershots, sending the port through the pipe. """
+    server = fakebs.serve(fakebs.FakeBrowsershots(options.latency,
+        options.page_size, options.errors, options.cycles))
+    pipe.send(server.server_port)
+    server.serve_forever()
+
+class Run(object):
+    """ One run of the engine over a number of jobs.
+
+        Attrs:
+            clock (ScaledClock): The compressed time.
+            deadlines (dict): By URL, when the session of the job
+                expires, in the compressed time.
+            misses (int): Extensions started after the deadline.
+            extensions (int): Extensions started.
+            finished (int): Jobs finished.
+            failed (int): Jobs given up on.
+            expired (bool): Set when the run took too long; the
+                remaining extensions are skipped.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.clock = scheduler.ScaledClock(options.factor)
+        self.lock = threading.Lock()
+        self.deadlines = {}
+        self.misses = 0
+        self.extensions = 0
+        self.finished = 0
+        self.failed = 0
+        self.expired = False
+
+    def extend(self, scheduled):
+        if self.expired:
+            return False
+        now = self.clock.time()
+        with self.lock:
+            self.extensions += 1
+            if now > self.deadlines[scheduled.url]:
+                self.misses += 1
+        more = job.extend_job(scheduled)
+        if more:
+            with self.lock:
+                self.deadlines[scheduled.url] = now + job.SESSION_TIMEOUT
+        return more
+
+    def done(self, scheduled, error):
+        with self.lock:
+            if error is None:
+                self.finished += 1
+            else:
+                self.failed += 1
+
+    def __call__(self, base, jobs, results):
+        options = self.options
+        job.use_browsershots(base)
+        job.install_opener()
+        engine = scheduler.Scheduler(self.extend, self.done,
+            workers=options.workers, frequency=job.HAMMER_FREQUENCY,
+            clock=self.clock)
+        # Spread the jobs over the first cycle, as if added over time.
+        start = self.clock.time()
+        for i in range(jobs):
+            url = '%shttp://site%d.example.com/' % (base, i)
+            due = start + job.HAMMER_FREQUENCY * i / float(jobs)
+            self.deadlines[url] = due + job.SESSION_TIMEOUT
+            engine.add(url, due)
+        # Give up when twice the planned time has passed.
+        planned = job.HAMMER_FREQUENCY * (options.cycles + 1) / options.factor
+        timer = threading.Timer(2 * planned, self.expire)
+        timer.daemon = True
+        timer.start()
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        started = time.time()
+        engine.run(until_idle=True)
+        elapsed = time.time() - started
+        timer.cancel()
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        results.put({
+            'jobs': jobs,
+            'seconds': elapsed,
+            'extensions': self.extensions,
+            'finished': self.finished,
+            'failed': self.failed,
+            'misses': self.misses,
+            'requests': sum(accounts.account_requests.values.values()),
+            'expired': self.expired,
+            'lag_p99': engine.lag_p99(),
+            'cpu': (after.ru_utime - usage.ru_utime)
+                + (after.ru_stime - usage.ru_stime),
+            'max_rss': after.ru_maxrss,
+        })
+
+    def expire(self):
+        self.expired = True
+
+def bench(options, jobs):
+    """ Run the engine over a number of jobs against a fresh site. """
+    parent, child = multiprocessing.Pipe()
+    site = multiprocessing.Process(target=run_site, args=(options, child))
+    site.daemon = True
+    site.start()
+    base = 'http://127.0.0.1:%d/' % parent.recv()
+    results = multiprocessing.Queue()
+    engine = multiprocessing.Process(target=Run(options),
+        args=(base, jobs, results))
+    engine.start()
+    result = results.get()
+    engine.join()
+    site.terminate()
+    site.join()
+    return result
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--jobs', default='1000,10000,50000',
+        help='comma separated numbers of concurrent jobs [%default]')
+    parser.add_option('--workers', type='int', default=16,
+        help='scheduler worker threads [%default]')
+    parser.add_option('--factor', type='float', default=60.0,
+        help='how many times faster the clock runs [%default]')
+    parser.add_option('--cycles', type='int', default=2,
+        help='extensions of each job [%default]')
+    parser.add_option('--latency', type='float', default=0.05,
+        help='mean response delay of the site in seconds [%default]')
+    parser.add_option('--page-size', type='int', default=20000,
+        help='bytes of padding in the pages [%default]')
+    parser.add_option('--errors', type='float', default=0.0,
+        help='rate of 500 responses of the site [%default]')
+    options, args = parser.parse_args()
+
+    print('%8s %8s %8s %8s %8s %8s %9s %8s %9s' % ('jobs', 'seconds',
+        'ext', 'req/s', 'cpu', 'rss MB', 'lag p99', 'misses', 'finished'))
+    for jobs in [int(n) for n in options.jobs.split(',')]:
+        result = bench(options, jobs)
+        print('%8d %8.1f %8d %8.1f %8.1f %8.1f %9.1f %8d %9s' % (jobs,
+            result['seconds'], result['extensions'],
+            result['requests'] / result['seconds'], result['cpu'],
+            result['max_rss'] / 1024.0, result['lag_p99'],
+            result['misses'], '%d%s' % (result['finished'],
+                ' (expired)' if result['expired'] else '')))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CEZARY KRZYŻANOWSKI OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+"""
+Microbenchmark of the page parsers of the job.
+
+Runs parse_csrf, parse_logged_in and parse_request_id over every page
+of the corpus (see pagecorpus.py) and reports the time per page and
+the throughput in MB/s. A parser finding something else than the
+manifest says is marked WRONG, so a faster parser has to be a correct
+one as well.
+
+Usage::
+
+    python bench/bench_parsers.py [--corpus 1] [--min-time 0.2]
+        [--parsers csrf,logged_in,request_id] [--pages result,...]
+
+Run it before and after changing a parser to compare.
+"""
+
+import optparse
+import os
+import sys
+import time
+
+dirname = os.path.dirname(__file__)
+onedirup = os.path.normpath(os.path.join(dirname, os.pardir))
+sys.path.insert(0, onedirup)
+sys.path.insert(0, dirname)
+
+import pagecorpus
+from autoshots import job
+
+def parse_csrf(html):
+    try:
+        return job.parse_csrf(html)
+    except job.UnexpectedContentError:
+        return None
+
+def parse_logged_in(html):
+    try:
+        job.parse_logged_in(html)
+    except job.UnexpectedContentError:
+        return False
+    return True
+
+def parse_request_id(html):
+    try:
+        return job.parse_request_id(html)
+    except job.UnexpectedContentError:
+        return None
+
+#: The parsers by the manifest key of their expected result.
+parsers = {
+    'csrf': parse_csrf,
+    'logged_in': parse_logged_in,
+    'request_id': parse_request_id,
+}
+
+def timed(parser, html, min_time):
+    """ Seconds one run of the parser takes, the best of the batches
+        run for at least min_time in total.
+    """
+    number = 1
+    while True:
+        started = time.time()
+        for i in range(number):
+            parser(html)
+        elapsed = time.time() - started
+        if elapsed >= min_time / 5:
+            break
+        number *= 2
+    best = elapsed
+    total = elapsed
+    while total < min_time:
+        started = time.time()
+        for i in range(number):
+            parser(html)
+        elapsed = time.time() - started
+        best = min(best, elapsed)
+        total += elapsed
+    return best / number
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--corpus', type='int', default=pagecorpus.VERSION,
+        help='corpus version [%default]')
+    parser.add_option('--min-time', type='float', default=0.2,
+        help='seconds to run each parser on each page [%default]')
+    parser.add_option('--parsers', default='csrf,logged_in,request_id',
+        help='comma separated parsers to run [%default]')
+    parser.add_option('--pages', help='comma separated pages [all]')
+    options, args = parser.parse_args()
+
+    pages = pagecorpus.load(options.corpus)
+    if options.pages:
+        names = options.pages.split(',')
+        pages = [page for page in pages if page['name'] in names]
+    wrong = 0
+    print('%-20s %-11s %10s %12s %10s' % ('page', 'parser', 'bytes',
+        'us/page', 'MB/s'))
+    for page in pages:
+        for name in options.parsers.split(','):
+            parse = parsers[name]
+            html = page['html']
+            result = parse(html)
+            mark = ''
+            if result != page[name]:
+                mark = '  WRONG: %r, expected %r' % (result, page[name])
+                wrong += 1
+            seconds = timed(parse, html, options.min_time)
+            print('%-20s %-11s %10d %12.1f %10.1f%s' % (page['name'], name,
+                len(html), seconds * 1e6, len(html) / seconds / 1e6, mark))
+    if wrong:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CEZARY KRZYŻANOWSKI OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+"""
+Startup benchmark of the processes.
+
+Starts fresh interpreters importing what a job worker and what a web
+worker need, and reports the median wall time and the peak resident
+memory of each.
+
+Usage::
+
+    python bench/bench_startup.py [--repeat 10]
+"""
+
+import optparse
+import os
+import subprocess
+import sys
+import time
+
+dirname = os.path.dirname(__file__)
+onedirup = os.path.normpath(os.path.join(dirname, os.pardir))
+
+#: What each kind of process imports.
+TARGETS = (
+    ('interpreter', 'pass'),
+    ('job worker', 'import autoshots.job'),
+    ('web worker', 'import autoshots.autoshots'),
+)
+
+def start(code):
+    """ Run an interpreter with code.
+
+        Returns:
+            The wall seconds and the peak RSS in KB.
+    """
+    started = time.time()
+    process = subprocess.Popen([sys.executable, '-c', code], cwd=onedirup)
+    pid, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.time() - started
+    if status:
+        sys.exit('%r failed with status %d' % (code, status))
+    return elapsed, usage.ru_maxrss
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--repeat', type='int', default=10,
+        help='interpreters started for each target [%default]')
+    options, args = parser.parse_args()
+
+    print('%-12s %10s %10s %s' % ('process', 'median ms', 'RSS MB',
+        'modules'))
+    for name, code in TARGETS:
+        runs = [start(code) for i in range(options.repeat)]
+        times = sorted(run[0] for run in runs)
+        rss = max(run[1] for run in runs)
+        modules = subprocess.check_output([sys.executable, '-c',
+            code + '; import sys; print(len(sys.modules))'],
+            cwd=onedirup).strip()
+        print('%-12s %10.1f %10.1f %s' % (name,
+            times[len(times) // 2] * 1000, rss / 1024.0, modules))
+
+if __name__ == '__main__':
+    main()
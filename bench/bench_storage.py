@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CEZARY KRZYŻANOWSKI OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+"""
+Concurrency benchmark of the storage layer.
+
+Runs several processes committing small transactions to one database,
+like the uwsgi workers and the forked jobs do, and reports commits per
+second, latency percentiles and lock errors for each configuration.
+
+The engine is created in the parent and inherited by the forked
+workers, so the fork safety of the pool is exercised as well.
+
+With --web the processes add jobs with /add and finish them with /done
+through the Flask test client instead, and the writes (requests) per
+second and the latencies of each handler are reported. The jobs are
+not started (JOB_BACKEND 'none'), only the web tier and the database
+are measured.
+
+Usage::
+
+    python bench/bench_storage.py [--processes 4] [--commits 200]
+        [--web] [--busy-timeout 30] [--uri postgresql://user@host/db]
+
+Without --uri a temporary SQLite file is used with each of the SQLite
+configurations below; lower --busy-timeout to see how the lock errors
+grow. With --uri the server database is benchmarked with the pool
+configuration of autoshots. It has to be empty: the tables made for
+the benchmark are dropped afterwards.
+"""
+
+import multiprocessing
+import optparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+dirname = os.path.dirname(__file__)
+onedirup = os.path.normpath(os.path.join(dirname, os.pardir))
+sys.path.insert(0, onedirup)
+
+import sqlalchemy
+from sqlalchemy import exc
+
+from autoshots import storage
+from autoshots.settings import Config
+
+#: The SQLite configurations compared, as Config overrides.
+SQLITE_CONFIGS = (
+    ('sqlite-rollback', {'SQLITE_JOURNAL_MODE': 'DELETE',
+        'SQLITE_SYNCHRONOUS': 'FULL'}),
+    ('sqlite-wal', {'SQLITE_JOURNAL_MODE': 'WAL',
+        'SQLITE_SYNCHRONOUS': 'NORMAL'}),
+    ('sqlite-wal-nosync', {'SQLITE_JOURNAL_MODE': 'WAL',
+        'SQLITE_SYNCHRONOUS': 'OFF'}),
+)
+
+#: The table every worker writes to.
+metadata = sqlalchemy.MetaData()
+bench_table = sqlalchemy.Table('bench', metadata,
+    sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column('worker', sqlalchemy.Integer),
+    sqlalchemy.Column('value', sqlalchemy.Integer),
+)
+
+def configured(overrides):
+    """ The default Config with some values overridden. """
+    config = Config()
+    for key, value in overrides.items():
+        setattr(config, key, value)
+    return config
+
+def worker(number, engine, commits, results):
+    """ Commit an insert and an update, commits times. """
+    latencies = []
+    errors = 0
+    for i in range(commits):
+        start = time.time()
+        try:
+            with engine.begin() as connection:
+                connection.execute(bench_table.insert(),
+                    worker=number, value=i)
+                connection.execute(bench_table.update()
+                    .where(bench_table.c.worker == number)
+                    .values(value=i))
+        except exc.OperationalError:
+            errors += 1
+            continue
+        latencies.append(time.time() - start)
+    results.put(({'commit': latencies}, errors))
+
+def web_worker(number, autoshots, jobs, results):
+    """ Add and finish jobs, timing each request. """
+    client = autoshots.app.test_client()
+    latencies = {'add': [], 'done': []}
+    errors = 0
+    for i in range(jobs):
+        url = 'http://worker%d.example.com/%d' % (number, i)
+        for handler, data in (('add', {'url': url}), ('done',
+                {'url': autoshots.BROWSERSHOTS_URL + url})):
+            start = time.time()
+            try:
+                response = client.post('/' + handler, data=data)
+            except (exc.OperationalError, sqlite3.OperationalError):
+                # The pragmas of a new connection raise the bare
+                # sqlite3 error.
+                errors += 1
+                continue
+            finally:
+                autoshots.db.session.remove()
+            if response.status_code >= 500:
+                errors += 1
+                continue
+            latencies[handler].append(time.time() - start)
+    results.put((latencies, errors))
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def measure(name, target, args, processes, unit):
+    """ Run target(number, *args, results) in processes, and print
+        the rate and the latencies of what they timed.
+    """
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=target,
+        args=(n, ) + args + (results, )) for n in range(processes)]
+    start = time.time()
+    for p in workers:
+        p.start()
+    outcomes = [results.get() for p in workers]
+    for p in workers:
+        p.join()
+    elapsed = time.time() - start
+
+    errors = sum(outcome[1] for outcome in outcomes)
+    line = ['%-18s' % name]
+    count = 0
+    for label in sorted(outcomes[0][0]):
+        latencies = sorted(l for outcome in outcomes
+            for l in outcome[0][label])
+        count += len(latencies)
+        line.append('%s p50 %7.2fms p99 %7.2fms' % (label,
+            percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000))
+    line.insert(1, '%9.1f %s/s' % (count / elapsed, unit))
+    line.append('lock errors %d' % errors)
+    print('  '.join(line))
+
+def run(name, uri, config, options):
+    """ Benchmark the commits of one configuration. """
+    engine = storage.create_engine(uri, config)
+    metadata.create_all(engine)
+    try:
+        # Make sure the parent holds a connection the workers inherit.
+        engine.execute(bench_table.select()).fetchall()
+        measure(name, worker, (engine, options.commits),
+            options.processes, 'commits')
+    finally:
+        metadata.drop_all(engine)
+        engine.dispose()
+
+def run_web(name, uri, config, options):
+    """ Benchmark the writing handlers of one configuration, in a
+        process of its own for the settings of the web app.
+    """
+    os.environ.setdefault('AUTOSHOTS_MODE', 'TEST')
+    from autoshots import autoshots
+    for key in dir(config):
+        if key.isupper():
+            setattr(autoshots.config, key, getattr(config, key))
+    autoshots.config.JOB_BACKEND = 'none'
+    autoshots.app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    autoshots.db.create_all()
+    autoshots.db.session.remove()
+    try:
+        measure(name, web_worker, (autoshots, options.commits),
+            options.processes, 'writes')
+    finally:
+        autoshots.db.drop_all()
+
+def bench(name, uri, config, options):
+    if not options.web:
+        run(name, uri, config, options)
+        return
+    process = multiprocessing.Process(target=run_web,
+        args=(name, uri, config, options))
+    process.start()
+    process.join()
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--processes', type='int', default=4,
+        help='number of writing processes [%default]')
+    parser.add_option('--commits', type='int', default=200,
+        help='commits, or jobs added and finished, per process '
+            '[%default]')
+    parser.add_option('--web', action='store_true', default=False,
+        help='write through the /add and /done handlers')
+    parser.add_option('--busy-timeout', type='float',
+        default=Config.SQLITE_BUSY_TIMEOUT,
+        help='seconds SQLite waits for a lock [%default]')
+    parser.add_option('--uri', help='server database URI to benchmark')
+    options, args = parser.parse_args()
+
+    if options.uri:
+        engine = storage.create_engine(options.uri, Config())
+        tables = engine.table_names()
+        engine.dispose()
+        if tables:
+            parser.error('the database at --uri has tables (%s), '
+                'benchmark an empty one' % ', '.join(tables))
+        bench('server', options.uri, Config(), options)
+        return
+
+    for name, overrides in SQLITE_CONFIGS:
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            bench(name, 'sqlite:///' + path, configured(dict(overrides,
+                SQLITE_BUSY_TIMEOUT=options.busy_timeout)), options)
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.unlink(path + suffix)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CEZARY KRZYŻANOWSKI OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+"""
+Benchmark of the home page at scale.
+
+Seeds the job table of a temporary SQLite database with the given
+numbers of rows, a `--running` fraction of them running and the rest
+history spread over the last year, and requests the home page through
+the Flask test client. Reports for each size the median and p95
+latency, the memory the requests took on top of the seeded process
+and the size of the response.
+
+Usage::
+
+    python bench/bench_web.py [--rows 1000,10000,100000,1000000]
+        [--repeat 5] [--running 0.01] [--save baseline.json]
+        [--compare baseline.json] [--threshold 0.2]
+
+--save writes the results as JSON. --compare reads such a file and
+flags every measure more than --threshold (a fraction) worse than the
+baseline, exiting with status 1 if there are any. Baselines are
+specific to the machine they were taken on.
+
+Every size is measured in a process of its own.
+"""
+
+import datetime
+import json
+import multiprocessing
+import optparse
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+dirname = os.path.dirname(__file__)
+onedirup = os.path.normpath(os.path.join(dirname, os.pardir))
+sys.path.insert(0, onedirup)
+
+os.environ.setdefault('AUTOSHOTS_MODE', 'TEST')
+from autoshots import autoshots
+
+#: Version of the baseline file format.
+BASELINE_VERSION = 1
+
+#: The measures compared against a baseline; all are worse when larger.
+MEASURES = ('latency_median', 'latency_p95', 'memory_kb', 'bytes')
+
+#: Rows inserted in one statement when seeding.
+SEED_BATCH = 10000
+
+def seed(rows, running):
+    """ Fill the job table with rows, the newest `running` fraction of
+        them running.
+    """
+    now = datetime.datetime.utcnow()
+    running_rows = int(rows * running)
+    insert = autoshots.Job.__table__.insert()
+    for start in range(0, rows, SEED_BATCH):
+        batch = []
+        for i in range(start, min(start + SEED_BATCH, rows)):
+            timestamp = now - datetime.timedelta(
+                seconds=365 * 24 * 3600 * i / rows)
+            is_running = i < running_rows
+            batch.append({
+                'url': 'http://site%d.example.com/page' % i,
+                'timestamp': timestamp,
+                'running': is_running,
+                'state': (autoshots.STATE_EXTENDED if is_running
+                    else autoshots.STATE_DONE),
+                'version': rows - i,
+                'finished': None if is_running else timestamp,
+            })
+        autoshots.db.engine.execute(insert, batch)
+
+def current_rss():
+    """ Resident memory of this process, in KB. """
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * resource.getpagesize() // 1024
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(fraction * (len(values) - 1))]
+
+def measure(rows, options, results):
+    """ Seed a database and time the home page. Runs in a process. """
+    fd, path = tempfile.mkstemp()
+    try:
+        autoshots.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+        autoshots.db.create_all()
+        seed(rows, options.running)
+        client = autoshots.app.test_client()
+        rss = current_rss()
+        latencies = []
+        for i in range(options.repeat):
+            started = time.time()
+            response = client.get('/')
+            latencies.append(time.time() - started)
+            assert response.status_code == 200
+            size = len(response.data)
+            autoshots.db.session.remove()
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        results.put({
+            'latency_median': percentile(latencies, 0.5),
+            'latency_p95': percentile(latencies, 0.95),
+            'memory_kb': max(peak - rss, 0),
+            'bytes': size,
+        })
+    finally:
+        os.close(fd)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+def bench(rows, options):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure,
+        args=(rows, options, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+def compare(results, baseline, threshold):
+    """ The measures worse than the baseline by more than threshold.
+
+        Returns:
+            A list of (rows, measure, baseline value, value) tuples.
+    """
+    regressions = []
+    for rows, result in sorted(results.items(), key=lambda i: int(i[0])):
+        old = baseline['results'].get(rows)
+        if old is None:
+            continue
+        for name in MEASURES:
+            if old[name] and result[name] > old[name] * (1 + threshold):
+                regressions.append((rows, name, old[name], result[name]))
+    return regressions
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--rows', default='1000,10000,100000,1000000',
+        help='comma separated numbers of job rows [%default]')
+    parser.add_option('--repeat', type='int', default=5,
+        help='requests per size [%default]')
+    parser.add_option('--running', type='float', default=0.01,
+        help='fraction of the jobs running [%default]')
+    parser.add_option('--save', help='write the results to this file')
+    parser.add_option('--compare', help='baseline file to compare with')
+    parser.add_option('--threshold', type='float', default=0.2,
+        help='tolerated fraction above the baseline [%default]')
+    options, args = parser.parse_args()
+
+    results = {}
+    print('%9s %10s %10s %10s %10s' % ('rows', 'median ms', 'p95 ms',
+        'memory KB', 'bytes'))
+    for rows in [int(n) for n in options.rows.split(',')]:
+        result = results[str(rows)] = bench(rows, options)
+        print('%9d %10.1f %10.1f %10d %10d' % (rows,
+            result['latency_median'] * 1000, result['latency_p95'] * 1000,
+            result['memory_kb'], result['bytes']))
+
+    if options.save:
+        with open(options.save, 'w') as baseline:
+            json.dump({
+                'version': BASELINE_VERSION,
+                'created': datetime.datetime.utcnow().isoformat(),
+                'python': platform.python_version(),
+                'machine': platform.node(),
+                'repeat': options.repeat,
+                'running': options.running,
+                'results': results,
+            }, baseline, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('version') != BASELINE_VERSION:
+            sys.exit('Unknown baseline version %r' % baseline.get('version'))
+        regressions = compare(results, baseline, options.threshold)
+        for rows, name, old, new in regressions:
+            print('REGRESSION %s rows %s: %s -> %s' % (rows, name, old, new))
+        if regressions:
+            sys.exit(1)
+        print('No regressions above %d%%' % (options.threshold * 100))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CEZARY KRZYŻANOWSKI OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+"""
+A local stand-in for browsershots.org.
+
+Serves the pages and calls the extension job uses: the home page with
+the CSRF token, the sign in, the result pages with the extend link and
+the extend AJAX call. Every response can be delayed, padded to a given
+size and failed at a given rate, to load test the engine.
+
+A result page stops offering the extend link after `extensions`
+extensions of its URL, so jobs finish like on the real site.
+
+Usage::
+
+    python bench/fakebs.py [--port 8000] [--latency 0.05] [--errors 0.01]
+
+and point the job at it with job.use_browsershots.
+"""
+
+import optparse
+import random
+import threading
+import time
+import urlparse
+import uuid
+from Cookie import SimpleCookie
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import (make_server, WSGIServer,
+    WSGIRequestHandler)
+
+#: The credentials accepted by the sign in.
+USERNAME = 'cz4rny'
+PASSWORD = 'pieprzonyptasiu'
+
+HOME_PAGE = '''<html><head><title>Browsershots</title></head><body>
+<form action="/accounts/signin" method="post">
+<input type='hidden' name='csrfmiddlewaretoken' value='%(csrf)s' />
+<input type="text" name="username" />
+</form>
+%(padding)s
+</body></html>'''
+
+SIGNED_IN_PAGE = '''<html><head><title>Browsershots</title></head><body>
+<a class="menu" href="/accounts/logout">Sign out</a>
+%(padding)s
+</body></html>'''
+
+RESULT_PAGE = '''<html><head><title>Screenshots of %(url)s</title></head>
+<body>
+%(logout)s
+%(extend)s
+%(padding)s
+</body></html>'''
+
+LOGOUT_LINK = '<a class="menu" href="/accounts/logout">Sign out</a>'
+
+EXTEND_LINK = ('<a href="#" id="%(id)s" class="extend" '
+    'rel="extend">Extend</a>')
+
+class FakeBrowsershots(object):
+    """ The WSGI application.
+
+        Attrs:
+            latency (float): Mean seconds each response is delayed,
+                exponentially distributed.
+            page_size (int): Bytes the HTML pages are padded to.
+            error_rate (float): Probability of a 500 response.
+            extensions (int): Extensions of a URL before its page stops
+                offering the extend link. None for never.
+            stall (float): Seconds every response hangs before being
+                sent, like a stuck connection.
+            trickle (float): Seconds between the bytes of every
+                response body, like a slow connection.
+    """
+
+    def __init__(self, latency=0.0, page_size=0, error_rate=0.0,
+            extensions=None, seed=None, stall=0.0, trickle=0.0):
+        self.latency = latency
+        self.stall = stall
+        self.trickle = trickle
+        self.page_size = page_size
+        self.error_rate = error_rate
+        self.extensions = extensions
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        #: Valid CSRF tokens.
+        self.tokens = set()
+        #: Signed in session ids.
+        self.sessions = set()
+        #: Request ids by URL, and URLs by request id.
+        self.request_ids = {}
+        self.urls = {}
+        #: Extensions by URL.
+        self.extended = {}
+        #: Requests served, by kind.
+        self.requests = dict.fromkeys(
+            ('home', 'signin', 'result', 'extend', 'error'), 0)
+
+    def __call__(self, environ, start_response):
+        if self.latency:
+            time.sleep(self.random.expovariate(1.0 / self.latency))
+        if self.stall:
+            time.sleep(self.stall)
+        path = environ.get('PATH_INFO', '/')
+        if self.random.random() < self.error_rate:
+            return self.respond(start_response, 'error',
+                '500 Internal Server Error', 'Error')
+        cookies = SimpleCookie(environ.get('HTTP_COOKIE', ''))
+        session = cookies.get('sessionid')
+        signed_in = session is not None and session.value in self.sessions
+        if path == '/':
+            return self.home(start_response)
+        if path == '/accounts/signin':
+            return self.signin(environ, start_response)
+        if path == '/ajax/requests/extend':
+            return self.extend(environ, start_response, signed_in)
+        return self.result(environ, start_response, signed_in)
+
+    def respond(self, start_response, kind, status, body, headers=()):
+        with self.lock:
+            self.requests[kind] += 1
+        start_response(status, [('Content-Type', 'text/html'),
+            ('Content-Length', str(len(body)))] + list(headers))
+        if self.trickle:
+            return self.trickled(body)
+        return [body]
+
+    def trickled(self, body):
+        for byte in body:
+            time.sleep(self.trickle)
+            yield byte
+
+    def padding(self):
+        return 'x' * self.page_size
+
+    def form(self, environ):
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        return dict(urlparse.parse_qsl(environ['wsgi.input'].read(length)))
+
+    def home(self, start_response):
+        csrf = uuid.uuid4().hex
+        with self.lock:
+            self.tokens.add(csrf)
+        return self.respond(start_response, 'home', '200 OK',
+            HOME_PAGE % {'csrf': csrf, 'padding': self.padding()},
+            [('Set-Cookie', 'csrftoken=%s; Path=/' % csrf)])
+
+    def signin(self, environ, start_response):
+        form = self.form(environ)
+        with self.lock:
+            valid = form.get('csrfmiddlewaretoken') in self.tokens
+            self.tokens.discard(form.get('csrfmiddlewaretoken'))
+        if (not valid or form.get('username') != USERNAME
+                or form.get('password') != PASSWORD):
+            return self.respond(start_response, 'signin', '200 OK',
+                HOME_PAGE % {'csrf': '', 'padding': self.padding()})
+        session = uuid.uuid4().hex
+        with self.lock:
+            self.sessions.add(session)
+        return self.respond(start_response, 'signin', '200 OK',
+            SIGNED_IN_PAGE % {'padding': self.padding()},
+            [('Set-Cookie', 'sessionid=%s; Path=/' % session)])
+
+    def result(self, environ, start_response, signed_in):
+        url = environ.get('PATH_INFO', '/')[1:]
+        with self.lock:
+            request_id = self.request_ids.get(url)
+            if request_id is None:
+                request_id = self.request_ids[url] = uuid.uuid4().hex
+                self.urls[request_id] = url
+            finished = (self.extensions is not None
+                and self.extended.get(url, 0) >= self.extensions)
+        extend = '' if finished else EXTEND_LINK % {'id': request_id}
+        return self.respond(start_response, 'result', '200 OK',
+            RESULT_PAGE % {'url': url, 'extend': extend,
+                'logout': LOGOUT_LINK if signed_in else '',
+                'padding': self.padding()})
+
+    def extend(self, environ, start_response, signed_in):
+        request_id = self.form(environ).get('request_group_id')
+        with self.lock:
+            url = self.urls.get(request_id)
+            if signed_in and url is not None:
+                self.extended[url] = self.extended.get(url, 0) + 1
+        if not signed_in or url is None:
+            body = '{"success": false}'
+        else:
+            body = '{"success": true}'
+        return self.respond(start_response, 'extend', '200 OK', body)
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """ Serves each request in a thread of its own. """
+    daemon_threads = True
+    request_queue_size = 1024
+
+class QuietHandler(WSGIRequestHandler):
+    """ Doesn't log every request. """
+
+    def log_message(self, *args):
+        pass
+
+def serve(app, host='127.0.0.1', port=0):
+    """ Make a threaded server for the application.
+
+        Returns:
+            The server, call serve_forever on it. With port 0 the
+            actual port is server.server_port.
+    """
+    return make_server(host, port, app, ThreadingWSGIServer,
+        QuietHandler)
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--port', type='int', default=8000)
+    parser.add_option('--latency', type='float', default=0.0,
+        help='mean response delay in seconds [%default]')
+    parser.add_option('--page-size', type='int', default=0,
+        help='bytes of padding in the pages [%default]')
+    parser.add_option('--errors', type='float', default=0.0,
+        help='rate of 500 responses [%default]')
+    parser.add_option('--extensions', type='int',
+        help='extensions before a job is finished [never]')
+    parser.add_option('--stall', type='float', default=0.0,
+        help='seconds every response hangs [%default]')
+    parser.add_option('--trickle', type='float', default=0.0,
+        help='seconds between the bytes of every response [%default]')
+    options, args = parser.parse_args()
+    server = serve(FakeBrowsershots(options.latency, options.page_size,
+        options.errors, options.extensions, stall=options.stall,
+        trickle=options.trickle),
+        port=options.port)
+    print('Serving on http://127.0.0.1:%d/' % server.server_port)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CEZARY KRZYŻANOWSKI OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+"""
+The corpus of browsershots pages the parsers of the job are measured on.
+
+The pages are kept in corpus/v<version>/ with a manifest.json listing
+each page with what the parsers should find on it: the CSRF token, if
+the user is logged in and the extension request id (null for none).
+A new capture or a changed page makes a new version, so results stay
+comparable.
+
+The large and pathological pages are generated from a captured one,
+as named by the "generate" key of the manifest, up to "size" bytes:
+
+thumbnails
+    More rows of screenshots, one tag per line, like a request for
+    hundreds of browsers.
+minified
+    The page on a single line, padded with rows as well. The regexes
+    don't cross lines, so this is the worst case for their
+    backtracking.
+"""
+
+import json
+import os
+import re
+
+dirname = os.path.dirname(os.path.abspath(__file__))
+
+#: The newest corpus version.
+VERSION = 1
+
+#: A row of the screenshot table, repeated by the generators.
+THUMBNAIL_ROW = ('<tr class="even">\n<td>linux</td><td>Firefox 9.0</td>\n'
+    '<td><a href="/png/512/%(n)02x/%(n)08x.png"><img '
+    'src="/png/160/%(n)02x/%(n)08x.png" alt="Firefox 9.0" /></a></td>\n'
+    '<td>finished</td>\n</tr>\n')
+
+#: Where the generated rows go, after the table header.
+TABLE_HEADER = re.compile(r'<tr><th>.*?</tr>\n', re.DOTALL)
+
+def thumbnails(page, size):
+    """ Pad the screenshot table of a page to size bytes. """
+    match = TABLE_HEADER.search(page)
+    rows = []
+    length = len(page)
+    n = 0
+    while length < size:
+        row = THUMBNAIL_ROW % {'n': n}
+        rows.append(row)
+        length += len(row)
+        n += 1
+    return page[:match.end()] + ''.join(rows) + page[match.end():]
+
+def minified(page, size):
+    """ The padded page on a single line. """
+    return thumbnails(page, size).replace('\r', '').replace('\n', '')
+
+#: The generators by the names used in the manifest.
+generators = {
+    'thumbnails': thumbnails,
+    'minified': minified,
+}
+
+def load(version=VERSION):
+    """ Read the pages of a corpus version.
+
+        Returns:
+            A list of the manifest entries, each with the page in 'html'.
+    """
+    directory = os.path.join(dirname, 'corpus', 'v%d' % version)
+    with open(os.path.join(directory, 'manifest.json')) as manifest:
+        pages = json.load(manifest)['pages']
+    for page in pages:
+        with open(os.path.join(directory, page['file']), 'rb') as html:
+            page['html'] = html.read()
+        if 'generate' in page:
+            page['html'] = generators[page['generate']](page['html'],
+                page['size'])
+    return pages
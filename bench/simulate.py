@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Cezary Krzyżanowski. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#    1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 
+#    2. Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY CEZARY KRZYŻANOWSKI ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL CEZARY KRZYŻANOWSKI OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed
+"""
+Capacity simulator of the extension scheduler.
+
+Runs the real Scheduler, with its due order, lag tracking and retries,
+on a VirtualClock against a model of browsershots, so days of
+extensions take seconds. Answers how many jobs a host can keep alive:
+it predicts the outbound request rate, the deadline misses (extensions
+starting after the browsershots session expired) and how busy the
+worker threads are.
+
+The model: the jobs are spread over `--accounts` accounts with the
+hash ring of the real pool. An extension requests the result page and
+the extend call, after the home page and the sign in when the session
+of its account is older than accounts.SESSION_TTL or its login failed.
+Browsershots drops a session after `--site-ttl`; the extension then
+finds the result page signed out, logs in again and visits the page
+again, like extend_procedure. The other failures keep the session.
+The requests are made one after another, each taking a latency drawn
+from the given distribution and failing with the error rate. Requests
+over the rate limit of an account in a second fail too. A job is
+offered `--extensions` extensions; the visit after that finds no
+extend link and finishes the job.
+
+Usage::
+
+    python bench/simulate.py [--jobs 1000] [--workers 4]
+        [--arrival burst | uniform:3600 | poisson:0.5]
+        [--latency exp:0.5 | lognormal:-1,0.5 | const:0.3]
+        [--errors 0.01] [--accounts 1] [--rate-limit 20]
+        [--extensions 10] [--site-ttl 1800]
+        [--duration 86400] [--seed 1]
+
+Times are in seconds, rates per second.
+"""
+
+import collections
+import heapq
+import itertools
+import optparse
+import os
+import random
+import sys
+import time
+
+dirname = os.path.dirname(__file__)
+onedirup = os.path.normpath(os.path.join(dirname, os.pardir))
+sys.path.insert(0, onedirup)
+
+from autoshots import accounts, job, scheduler
+
+#: Requests of a login, of an extension, and of the visit finding the
+#: job finished.
+LOGIN_REQUESTS = 2
+EXTEND_REQUESTS = 2
+FINISH_REQUESTS = 1
+
+#: Window (seconds) the peak request rate is measured over.
+PEAK_WINDOW = 60
+
+class SiteError(Exception):
+    """ A modelled browsershots request failed. """
+
+class Browsershots(object):
+    """ The model of the site.
+
+        Attrs:
+            latency (callable): Draws the seconds a request takes.
+            error_rate (float): Probability of a request failing.
+            rate_limit (float): Requests per second served to an
+                account, None for no limit.
+            extensions (int): Extensions offered for each job.
+            pool (Pool): The accounts.
+            site_ttl (float): Seconds browsershots keeps a session,
+                None for longer than accounts.SESSION_TTL.
+    """
+
+    def __init__(self, latency, error_rate, rate_limit, extensions, rng,
+            accounts_count=1, site_ttl=None):
+        self.latency = latency
+        self.site_ttl = site_ttl
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.extensions = extensions
+        self.random = rng
+        self.pool = accounts.Pool([accounts.Account(
+                [('username', 'account%d' % i), ('password', '')])
+            for i in range(accounts_count)])
+        #: Requests by the second they were made in.
+        self.per_second = collections.Counter()
+        #: Requests by account and the second they were made in.
+        self.account_seconds = collections.Counter()
+        #: Requests by account.
+        self.account_requests = collections.Counter()
+        #: When the accounts logged in, by username.
+        self.signed_in = {}
+        #: Logins made.
+        self.logins = 0
+        #: Extensions done, by URL.
+        self.extended = collections.Counter()
+
+    def extend(self, url, now):
+        """ Model an extension of a job starting at now.
+
+            Returns:
+                (seconds, requests, more, error) of the extension.
+        """
+        account = self.pool.account_for(url).username
+        finished = self.extended[url] >= self.extensions
+        requests = FINISH_REQUESTS if finished else EXTEND_REQUESTS
+        signed_in = self.signed_in.get(account)
+        # Requests made before the session is valid.
+        login = 0
+        if signed_in is None or now - signed_in >= accounts.SESSION_TTL:
+            login = LOGIN_REQUESTS
+        elif self.site_ttl is not None and now - signed_in >= self.site_ttl:
+            # The result page signed out, visited again after a login.
+            login = 1 + LOGIN_REQUESTS
+        if login:
+            requests += login
+            self.logins += 1
+            self.signed_in[account] = now
+        seconds = 0.0
+        for made in range(1, requests + 1):
+            second = int(now + seconds)
+            self.per_second[second] += 1
+            self.account_seconds[account, second] += 1
+            self.account_requests[account] += 1
+            seconds += self.latency()
+            error = None
+            if (self.rate_limit is not None and
+                    self.account_seconds[account, second] > self.rate_limit):
+                error = SiteError('Rate limited')
+            elif self.random.random() < self.error_rate:
+                error = SiteError('Server error')
+            if error is not None:
+                if made <= login:
+                    # A failed login drops the session.
+                    self.signed_in.pop(account, None)
+                return seconds, made, True, error
+        if finished:
+            return seconds, requests, False, None
+        self.extended[url] += 1
+        return seconds, requests, True, None
+
+class SimulatedScheduler(scheduler.Scheduler):
+    """ Hands the due jobs to the simulation instead of threads. """
+
+    def __init__(self, simulation, **kwargs):
+        scheduler.Scheduler.__init__(self, None, **kwargs)
+        self.simulation = simulation
+
+    def dispatch(self, scheduled):
+        self.simulation.waiting.append(scheduled)
+
+class Simulation(object):
+    """ The event loop moving the virtual clock.
+
+        Attrs:
+            site (Browsershots): The modelled site.
+            engine (SimulatedScheduler): The real scheduling logic.
+            waiting (deque): Due jobs waiting for a worker.
+            events (list): Heap of (time, sequence, callable, args).
+    """
+
+    def __init__(self, site, workers, retry_delay=60, max_retries=3):
+        self.site = site
+        self.clock = scheduler.VirtualClock()
+        self.engine = SimulatedScheduler(self, done=self.done,
+            workers=workers, frequency=job.HAMMER_FREQUENCY,
+            retry_delay=retry_delay, max_retries=max_retries,
+            clock=self.clock)
+        self.waiting = collections.deque()
+        self.events = []
+        self.sequence = itertools.count()
+        self.free = workers
+        self.busy = 0.0
+        self.deadlines = {}
+        self.lags = []
+        self.extensions = 0
+        self.requests = 0
+        self.misses = 0
+        self.failures = 0
+        self.finished = 0
+        self.failed = 0
+
+    def at(self, when, action, *args):
+        heapq.heappush(self.events, (when, next(self.sequence), action, args))
+
+    def arrive(self, url):
+        scheduled = self.engine.add(url)
+        self.deadlines[url] = scheduled.due + job.SESSION_TIMEOUT
+
+    def start_waiting(self):
+        """ Start the extensions of the waiting jobs on free workers. """
+        while self.free and self.waiting:
+            scheduled = self.waiting.popleft()
+            self.free -= 1
+            started = self.engine.start(scheduled)
+            self.lags.append(started - scheduled.due)
+            self.extensions += 1
+            if started > self.deadlines[scheduled.url]:
+                self.misses += 1
+            seconds, requests, more, error = self.site.extend(
+                scheduled.url, started)
+            self.requests += requests
+            self.busy += seconds
+            self.at(started + seconds, self.complete, scheduled, started,
+                more, error)
+
+    def complete(self, scheduled, started, more, error):
+        self.free += 1
+        if error is None and more:
+            self.deadlines[scheduled.url] = started + job.SESSION_TIMEOUT
+        elif error is not None:
+            self.failures += 1
+        self.engine.complete(scheduled, started, more, error)
+
+    def done(self, scheduled, error):
+        if error is None:
+            self.finished += 1
+        else:
+            self.failed += 1
+
+    def run(self, duration=None):
+        """ Run until there is nothing to do or duration has passed. """
+        while True:
+            with self.engine.condition:
+                wait = self.engine.run_pending()
+            self.start_waiting()
+            upcoming = []
+            if self.events:
+                upcoming.append(self.events[0][0])
+            if wait is not None:
+                upcoming.append(self.clock.now + wait)
+            if not upcoming:
+                break
+            now = min(upcoming)
+            if duration is not None and now > duration:
+                self.clock.now = duration
+                break
+            self.clock.now = now
+            while self.events and self.events[0][0] <= now:
+                when, sequence, action, args = heapq.heappop(self.events)
+                action(*args)
+
+def distribution(spec, rng):
+    """ A function drawing from the distribution named by spec, e.g.
+        exp:0.5 (the mean), lognormal:-1,0.5 (mu, sigma) or const:0.3.
+    """
+    name, params = spec.split(':')
+    params = [float(p) for p in params.split(',')]
+    if name == 'exp':
+        return lambda: rng.expovariate(1.0 / params[0])
+    if name == 'lognormal':
+        return lambda: rng.lognormvariate(*params)
+    if name == 'const':
+        return lambda: params[0]
+    raise ValueError('Unknown distribution %r' % spec)
+
+def arrivals(spec, jobs, rng):
+    """ The arrival times of the jobs, by the pattern named by spec:
+        burst (all at once), uniform:SECONDS (spread evenly) or
+        poisson:RATE (jobs per second).
+    """
+    name, _, param = spec.partition(':')
+    if name == 'burst':
+        return [0.0] * jobs
+    if name == 'uniform':
+        return [float(param) * i / jobs for i in range(jobs)]
+    if name == 'poisson':
+        times = []
+        now = 0.0
+        for i in range(jobs):
+            now += rng.expovariate(float(param))
+            times.append(now)
+        return times
+    raise ValueError('Unknown arrival pattern %r' % spec)
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(fraction * (len(values) - 1))]
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--jobs', type='int', default=1000,
+        help='number of jobs [%default]')
+    parser.add_option('--workers', type='int', default=4,
+        help='scheduler worker threads [%default]')
+    parser.add_option('--arrival', default='uniform:3600',
+        help='arrival pattern of the jobs [%default]')
+    parser.add_option('--latency', default='exp:0.5',
+        help='latency distribution of a request [%default]')
+    parser.add_option('--errors', type='float', default=0.01,
+        help='error rate of a request [%default]')
+    parser.add_option('--accounts', type='int', default=1,
+        help='browsershots accounts [%default]')
+    parser.add_option('--rate-limit', type='float',
+        help='requests per second served to an account [none]')
+    parser.add_option('--extensions', type='int', default=10,
+        help='extensions offered for each job [%default]')
+    parser.add_option('--site-ttl', type='float',
+        help='seconds browsershots keeps a session [longer than ours]')
+    parser.add_option('--retry-delay', type='float', default=60,
+        help='seconds to wait after a failure [%default]')
+    parser.add_option('--max-retries', type='int', default=3,
+        help='failures in a row tolerated [%default]')
+    parser.add_option('--duration', type='float',
+        help='simulated seconds to stop after [until all finish]')
+    parser.add_option('--seed', type='int', default=1,
+        help='random seed [%default]')
+    options, args = parser.parse_args()
+
+    rng = random.Random(options.seed)
+    site = Browsershots(distribution(options.latency, rng), options.errors,
+        options.rate_limit, options.extensions, rng, options.accounts,
+        options.site_ttl)
+    simulation = Simulation(site, options.workers, options.retry_delay,
+        options.max_retries)
+    for i, when in enumerate(arrivals(options.arrival, options.jobs, rng)):
+        simulation.at(when, simulation.arrive, 'http://site%d.example.com/' % i)
+
+    started = time.time()
+    simulation.run(options.duration)
+    wall = time.time() - started
+
+    simulated = simulation.clock.now or 1.0
+    windows = collections.Counter()
+    for second, count in site.per_second.items():
+        windows[second // PEAK_WINDOW] += count
+    peak = max(windows.values() or [0]) / float(PEAK_WINDOW)
+    print('simulated        %12.0f s (%.1f h) in %.1f s of wall time'
+        % (simulated, simulated / 3600, wall))
+    print('jobs             %12d finished, %d failed, %d unfinished'
+        % (simulation.finished, simulation.failed, options.jobs
+            - simulation.finished - simulation.failed))
+    print('extensions       %12d (%d failed)' % (simulation.extensions,
+        simulation.failures))
+    print('requests         %12d, %.2f/s mean, %.2f/s peak (%ds)'
+        % (simulation.requests, simulation.requests / simulated, peak,
+            PEAK_WINDOW))
+    print('logins           %12d' % site.logins)
+    print('per account      %12d requests min, %d max'
+        % (min(site.account_requests.values() or [0]),
+            max(site.account_requests.values() or [0])))
+    print('deadline misses  %12d (%.2f%% of the extensions)'
+        % (simulation.misses, 100.0 * simulation.misses
+            / max(simulation.extensions, 1)))
+    print('lag              %12.1f s p50, %.1f s p99, %.1f s max'
+        % (percentile(simulation.lags, 0.5),
+            percentile(simulation.lags, 0.99), max(simulation.lags or [0])))
+    print('utilisation      %12.1f%% of %d workers' % (100 * simulation.busy
+        / (simulated * options.workers), options.workers))
+
+if __name__ == '__main__':
+    main()
@@ -52,7 +52,7 @@ setup(
 
     entry_points={
         'console_scripts': [
-            'autoshots=autoshots.job:main',
+            'autoshots=autoshots.daemon:main',
         ],
     },
     classifiers=[